@@ -1,23 +1,22 @@
 import logging
 import os
-from logging.handlers import RotatingFileHandler
 
-from flask import Flask, request
+import click
+from flask import Flask
 from flask_cors import CORS
-from flask_migrate import Migrate
 
+from devmateback import artifacts, cache, events, leases, logs, metrics, profiler, slowlog, startup, state, storage
 from devmateback.models import db
-from devmateback.devices import devices_bp
+from devmateback.devices import devices_bp, init_wait_slots, REVISION_HEADER
 from devmateback.cli import cli_bp
 
-# Set up logging
-handler = RotatingFileHandler('devmate.log', maxBytes=1024 * 1024, backupCount=3)
-formatter = logging.Formatter('[%(asctime)s.%(msecs)03d] [%(name)s] [%(levelname)s] :  %(message)s',
-                              datefmt='%d.%m.%Y %H:%M:%S')
-handler.setFormatter(formatter)
+# Set up logging, see devmateback/logs.py for the settings
+log_settings = logs.load_settings()
+if log_settings is None:
+    print("Invalid logging settings!")
+    exit(1)
+log_pipeline = logs.LogPipeline(log_settings)
 logger = logging.getLogger('devmate')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
 
 
 def init_db(app_to_setup):
@@ -38,13 +37,32 @@ def init_db(app_to_setup):
     db_path = os.path.join(db_dir, 'devices.db')
     logger.debug(f"Using database file {db_path}")
     app_to_setup.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app_to_setup.config['DB_DIR'] = db_dir
+
+    storage_settings = storage.load_profile()
+    if storage_settings is None:
+        return None
+
+    # How the schema is set up, see devmateback/startup.py
+    schema_mode = os.environ.get('DB_SCHEMA', 'create')
+    if schema_mode not in startup.SCHEMA_MODES:
+        logger.error(f"Invalid DB_SCHEMA {schema_mode}, expected one of {', '.join(startup.SCHEMA_MODES)}")
+        return None
+    app_to_setup.config['SQLALCHEMY_ENGINE_OPTIONS'] = storage.engine_options(storage_settings)
 
     # Initialize the database
     db.init_app(app_to_setup)
 
     # Create the database tables
     with app_to_setup.app_context():
-        db.create_all()
+        storage.register_pragmas(db.engine, storage_settings)
+        if not slowlog.init_slow_query_log(app_to_setup, db.engine):
+            return None
+        try:
+            startup.prepare_schema(app_to_setup, db_dir, schema_mode)
+        except Exception as error:
+            logger.error(f'Failed to prepare the database schema: {error}')
+            return None
 
     return True
 
@@ -67,7 +85,8 @@ def init_cli_storage(app_to_setup):
 
     # Set up the CLI binary directory
     app_to_setup.config['CLI_BINARY_PATH'] = cli_dir
-    return True
+    # The size and digest of each binary, see devmateback/artifacts.py
+    return artifacts.init_artifact_index(app_to_setup, cli_dir)
 
 
 def create_app():
@@ -75,11 +94,34 @@ def create_app():
     new_app = Flask(__name__)
 
     # Enable CORS (Cross-Origin Resource Sharing). This is needed to allow the frontend to access the backend.
-    CORS(new_app)
+    # The Web UI reads the revision of the list, to know which events it already has.
+    CORS(new_app, expose_headers=[REVISION_HEADER])
 
     if not init_db(new_app):
         return None
 
+    if not state.init_state_engine(new_app, new_app.config['DB_DIR']):
+        return None
+
+    # The in-memory state engine doesn't need the read cache, its lists are read from memory
+    if state.EXTENSION not in new_app.extensions and not cache.init_read_cache(new_app):
+        return None
+
+    # The limits of the requests which hold a thread while they wait
+    if not events.init_stream_slots(new_app) or not init_wait_slots(new_app):
+        return None
+
+    if not leases.init_lease_scheduler(new_app):
+        return None
+
+    with new_app.app_context():
+        if not metrics.init_metrics(new_app, db.engine):
+            return None
+
+    # Only when PROFILER_TOKEN or PROFILER_EVERY_N is set
+    if not profiler.init_profiler(new_app, new_app.config['DB_DIR']):
+        return None
+
     if not init_cli_storage(new_app):
         logger.error("Failed to initialize CLI binary storage!")
 
@@ -87,6 +129,8 @@ def create_app():
     new_app.register_blueprint(devices_bp, url_prefix='/devices')
     new_app.register_blueprint(cli_bp, url_prefix='/cli')
 
+    startup.init_readiness(new_app)
+
     return new_app
 
 
@@ -95,19 +139,12 @@ if app is None:
     print("Failed to create the Flask app!")
     exit(1)
 
-migrate = Migrate(app, db)
-
-
-@app.before_request
-def before_request():
-    # Log the request details, including the method, path and query string arguments
-    logger.debug(f'REQUEST: {request.method} - {request.path} - {request.get_json(silent=True)} ')
-
+# The flask db commands need the migrations, the server imports them only with DB_SCHEMA=migrate
+if 'migrate' not in app.extensions and click.get_current_context(silent=True) is not None:
+    startup.init_migrations(app)
 
-@app.after_request
-def after_request(response):
-    logger.debug(f'HANDLED: {response.status}')
-    return response
+# One structured line per request, with its id and duration
+logs.init_request_logging(app, log_settings)
 
 
 @app.route('/health', methods=['GET'])
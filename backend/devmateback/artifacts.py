@@ -0,0 +1,283 @@
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from datetime import datetime, timezone
+
+from devmateback import deltas
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Index of the CLI binaries served by /cli/get: the size, modification time and sha256 of the binary of each
+# platform, in CLI_BINARY_PATH/devmatecli-<platform>-latest/. The index is built when the app starts. A lookup
+# stats the file, and the digest is computed again only when the file has changed (size, mtime or inode), e.g.
+# after a new CLI version is copied to the directory, so a download or an update check doesn't read the file.
+# The sha256 is the strong ETag of the binary, the clients which have it get a 304.
+#
+# When a binary is indexed, it's also compressed with each of CLI_ENCODINGS (br and zstd need the brotli and
+# zstandard packages), next to the binary: devmate.<sha256 prefix>.gz, so the workers which index the same binary
+# share the files, and an old one is never served for a new binary. /cli/get sends the best one the client
+# accepts, unless it's not smaller than the binary.
+# With CLI_ACCEL_REDIRECT set to an internal nginx location of CLI_DIR, the requests that come through nginx (with
+# the X-Devmate-Accel header) are answered with X-Accel-Redirect, and nginx sends the file, see webui/nginx.conf.
+# The previous versions of each binary are kept, with the deltas from them to the latest one, see
+# devmateback/deltas.py.
+# The compression and the deltas take a while for a big binary, so they're made by a background thread, one
+# binary at a time, and the binary itself is served (and listed in /cli/manifest without encodings and deltas)
+# until they're ready. Only the digest is computed on the request path. The thread doesn't survive a fork, so a
+# worker forked while the files of the preloaded master were being made starts it again, and reuses the files
+# already written.
+
+EXTENSION = 'devmate_artifacts'
+PLATFORMS = ['linux', 'macos', 'windows']
+HASH_CHUNK_SIZE = 1024 * 1024
+# Content encoding, file suffix, in the order of preference when the client accepts several
+ENCODINGS = [('br', '.br'), ('zstd', '.zst'), ('gzip', '.gz')]
+DEFAULT_ENCODINGS = 'br,zstd,gzip'
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+BROTLI_QUALITY = 9
+VARIANT_DIGEST_LENGTH = 16
+
+
+def file_name(platform):
+    return 'devmate.exe' if platform == 'windows' else 'devmate'
+
+
+def artifact_path(cli_dir, platform):
+    return os.path.join(cli_dir, f'devmatecli-{platform}-latest', file_name(platform))
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def encoding_available(encoding):
+    return {'br': brotli is not None, 'zstd': zstandard is not None, 'gzip': True}[encoding]
+
+
+def compress(encoding, source, target):
+    if encoding == 'gzip':
+        # No file name and time in the header, the same binary always gives the same file
+        with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=GZIP_LEVEL, filename='', mtime=0) as f:
+            for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+                f.write(chunk)
+    elif encoding == 'zstd':
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(source, target)
+    else:
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            target.write(compressor.process(chunk))
+        target.write(compressor.finish())
+
+
+def write_variant(encoding, path, variant_path):
+    # Written under a temporary name, the other workers see the whole file or none
+    with open(path, 'rb') as source, tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.compressing-',
+                                                                 delete=False) as target:
+        try:
+            compress(encoding, source, target)
+        except BaseException:
+            target.close()
+            os.remove(target.name)
+            raise
+    os.replace(target.name, variant_path)
+
+
+class Variant(object):
+    # The binary compressed with one content encoding
+
+    def __init__(self, encoding, path, sha256, base_sha256):
+        self.encoding = encoding
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.sha256 = sha256
+        self.etag = f'{base_sha256}-{encoding}'
+
+
+class Artifact(object):
+
+    def __init__(self, platform, path, stat, sha256):
+        self.platform = platform
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.stat_key = stat_key(stat)
+        self.sha256 = sha256
+        # Filled by the background thread, the binary is served without them meanwhile
+        self.variants = {}
+        self.deltas = {}
+        self.ready = threading.Event()
+        self.prepared_by = None
+
+    def precompress(self, encodings):
+        # Returns the variants smaller than the binary by the encoding
+        variants = {}
+        for encoding, suffix in ENCODINGS:
+            if encoding not in encodings:
+                continue
+            prefix = f'{self.path}.'
+            variant_path = f'{prefix}{self.sha256[:VARIANT_DIGEST_LENGTH]}{suffix}'
+            try:
+                if not os.path.exists(variant_path):
+                    write_variant(encoding, self.path, variant_path)
+                variant = Variant(encoding, variant_path, file_digest(variant_path), self.sha256)
+            except OSError as error:
+                logger.warning(f'Failed to compress the CLI binary {self.path} with {encoding}: {error}')
+                continue
+            # The files of the older binaries, not the ones of a newer binary indexed by another worker meanwhile
+            for old_path in glob.glob(f'{glob.escape(prefix)}*{suffix}'):
+                try:
+                    if old_path != variant_path and os.path.getmtime(old_path) < self.mtime:
+                        os.remove(old_path)
+                except OSError:
+                    pass
+            if variant.size < self.size:
+                variants[encoding] = variant
+        return variants
+
+    def download_size(self):
+        return min([self.size] + [variant.size for variant in self.variants.values()])
+
+    def select_variant(self, accept_encodings):
+        # The compressed variant with the highest quality for the client, the smallest one on a tie, or None
+        best = None
+        best_quality = 0
+        for encoding, _ in ENCODINGS:
+            variant = self.variants.get(encoding)
+            if variant is None:
+                continue
+            quality = accept_encodings.quality(encoding)
+            if quality > best_quality or (quality == best_quality and best is not None
+                                          and variant.size < best.size):
+                best, best_quality = variant, quality
+        return best
+
+    def as_dict(self):
+        return {'platform': self.platform,
+                'file': self.file_name,
+                'size': self.size,
+                'mtime': datetime.fromtimestamp(self.mtime, timezone.utc).isoformat(),
+                'sha256': self.sha256,
+                'encodings': {encoding: variant.size for encoding, variant in self.variants.items()},
+                'deltas': {base_sha256: delta.size for base_sha256, delta in self.deltas.items()},
+                'url': f'/cli/get?platform={self.platform}'}
+
+
+def stat_key(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class ArtifactIndex(object):
+
+    def __init__(self, cli_dir, encodings=(), delta_versions=0):
+        self.cli_dir = cli_dir
+        self.encodings = encodings
+        self.delta_versions = delta_versions
+        self.artifacts = {}
+        self.lock = threading.Lock()
+        # One binary is prepared at a time, the history of the deltas is updated in the order of the versions
+        self.prepare_lock = threading.Lock()
+
+    def refresh(self):
+        for platform in PLATFORMS:
+            self.get(platform)
+
+    def get(self, platform):
+        # Returns the artifact of the platform, or None if it has no binary
+        path = artifact_path(self.cli_dir, platform)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.artifacts.pop(platform, None)
+            return None
+        artifact = self.artifacts.get(platform)
+        if artifact is not None and artifact.stat_key == stat_key(stat) and (
+                artifact.ready.is_set() or artifact.prepared_by == os.getpid()):
+            return artifact
+
+        with self.lock:
+            artifact = self.artifacts.get(platform)
+            if artifact is None or artifact.stat_key != stat_key(stat):
+                try:
+                    artifact = Artifact(platform, path, stat, file_digest(path))
+                except OSError as error:
+                    logger.error(f'Failed to index the CLI binary {path}: {error}')
+                    return None
+                self.artifacts[platform] = artifact
+                logger.info(f'Indexed the {platform} CLI binary: {artifact.size} bytes, sha256 {artifact.sha256}')
+            if not artifact.ready.is_set() and artifact.prepared_by != os.getpid():
+                artifact.prepared_by = os.getpid()
+                threading.Thread(target=self.prepare, args=(artifact,), name=f'devmate-cli-{platform}',
+                                 daemon=True).start()
+            return artifact
+
+    def prepare(self, artifact):
+        # Makes the compressed variants and the deltas of the binary, in the background
+        with self.prepare_lock:
+            # Replaced by a newer binary meanwhile
+            if self.artifacts.get(artifact.platform) is not artifact:
+                return
+            artifact.variants = artifact.precompress(self.encodings)
+            if self.delta_versions > 0:
+                try:
+                    artifact.deltas = deltas.update_history(
+                        deltas.history_dir(self.cli_dir, artifact.platform), artifact.path, artifact.sha256,
+                        self.delta_versions, artifact.download_size())
+                except (OSError, deltas.DeltaError) as error:
+                    logger.warning(f'Failed to compute the deltas to the CLI binary {artifact.path}: {error}')
+            artifact.ready.set()
+        sizes = ', '.join(f'{encoding} {variant.size}' for encoding, variant in artifact.variants.items())
+        logger.info(f'Prepared the {artifact.platform} CLI binary {artifact.sha256}: {sizes or "not compressed"}, '
+                    f'{len(artifact.deltas)} deltas')
+
+    def manifest(self):
+        return {platform: artifact.as_dict() for platform, artifact in
+                ((platform, self.get(platform)) for platform in PLATFORMS) if artifact is not None}
+
+
+def init_artifact_index(app_to_setup, cli_dir):
+    encodings = [encoding.strip() for encoding in os.environ.get('CLI_ENCODINGS', DEFAULT_ENCODINGS).split(',')
+                 if encoding.strip()]
+    known = [encoding for encoding, _ in ENCODINGS]
+    for encoding in encodings:
+        if encoding not in known:
+            logger.error(f"Invalid CLI_ENCODINGS {encoding}, expected some of {', '.join(known)}")
+            return None
+    unavailable = [encoding for encoding in encodings if not encoding_available(encoding)]
+    if unavailable:
+        logger.info(f"The CLI binaries aren't compressed with {', '.join(unavailable)}, the package is not installed")
+
+    try:
+        delta_versions = int(os.environ.get('CLI_DELTA_VERSIONS', deltas.DEFAULT_VERSIONS))
+    except ValueError as error:
+        logger.error(f'Invalid CLI_DELTA_VERSIONS: {error}')
+        return None
+
+    accel_prefix = os.environ.get('CLI_ACCEL_REDIRECT')
+    if accel_prefix:
+        app_to_setup.config['CLI_ACCEL_REDIRECT'] = accel_prefix.rstrip('/') + '/'
+
+    index = ArtifactIndex(cli_dir, [encoding for encoding in encodings if encoding not in unavailable], delta_versions)
+    index.refresh()
+    app_to_setup.extensions[EXTENSION] = index
+    return True
@@ -0,0 +1,338 @@
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+from flask import Response
+
+from devmateback import asyncdb, events
+from devmateback.devices import with_revision
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Asyncio serving mode: an ASGI app around the Flask app, run with any ASGI server, e.g.
+#   uvicorn devmateback.asgi:app
+#   gunicorn -k uvicorn.workers.UvicornWorker devmateback.asgi:app
+#
+# The requests which wait for the fleet to change, the /devices/changes long polls and the /devices/events
+# streams, are served on the event loop: they wait on one revision watcher per process, which polls the revision
+# row only while somebody waits, so an idle connection costs a coroutine instead of a thread, and thousands of
+# them fit in one process. The revision, the changes and the events are read with an async engine (aiosqlite, see
+# devmateback/asyncdb.py), and the responses are the same as the ones of the Flask views. They go through the
+# Flask hooks as well, before_request and after_request around the coroutine: the request log, the metrics and
+# CORS see them like the other requests. Every other request runs the Flask app in a thread pool of ASGI_THREADS
+# threads.
+
+DEFAULT_THREADS = 32
+
+
+class RevisionWatcher(object):
+    # Polls the fleet revision on behalf of all the waiting requests of the process
+
+    def __init__(self, flask_app, reader):
+        self.flask_app = flask_app
+        self.reader = reader
+        self.revision = None
+        self.waiters = 0
+        self.changed = None
+        self.task = None
+
+    async def poll(self):
+        while True:
+            async with self.changed:
+                # Nobody waits, nothing to read
+                await self.changed.wait_for(lambda: self.waiters > 0)
+            try:
+                revision = await self.reader.get_revision()
+            except Exception:
+                logger.exception('Failed to read the fleet revision')
+            else:
+                async with self.changed:
+                    if revision != self.revision:
+                        self.revision = revision
+                        self.changed.notify_all()
+            await asyncio.sleep(self.flask_app.config.get('EVENTS_POLL_INTERVAL', events.DEFAULT_POLL_INTERVAL))
+
+    async def wait_for(self, revision, timeout):
+        # Waits until the fleet is changed after the revision or the timeout passes, returns the last revision seen
+        if self.task is None or self.task.done():
+            self.changed = asyncio.Condition()
+            self.task = asyncio.get_running_loop().create_task(self.poll())
+        async with self.changed:
+            if self.waiters == 0:
+                # Read while nobody was waiting, it may be old
+                self.revision = None
+            self.waiters += 1
+            self.changed.notify_all()
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: (self.revision or 0) > revision), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiters -= 1
+            return self.revision
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+class AsgiApp(object):
+
+    def __init__(self, flask_app, threads=DEFAULT_THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='devmate-wsgi')
+        self.reader = asyncdb.create_reader(flask_app, self.run)
+        self.watcher = RevisionWatcher(flask_app, self.reader)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['method'] == 'GET' and scope['path'] == '/devices/changes':
+                await self.long_poll_changes(scope, receive, send)
+            elif scope['method'] == 'GET' and scope['path'] == '/devices/events':
+                await self.stream_events(scope, receive, send)
+            else:
+                await self.call_flask(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.watcher.stop()
+                await self.reader.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def serve_natively(self, scope, receive, send, view):
+        # Runs the view coroutine between the Flask hooks, it returns the response and an async iterator of the
+        # chunks of its body, or None
+        with self.flask_app.request_context(wsgi_environ(scope, b'')):
+            response, chunks = self.flask_app.preprocess_request(), None
+            if response is None:
+                response, chunks = await view()
+            response = self.flask_app.process_response(self.flask_app.make_response(response))
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                for key, value in response.headers.to_wsgi_list()]})
+        if chunks is None:
+            await send({'type': 'http.response.body', 'body': response.get_data(), 'more_body': False})
+            return
+        try:
+            async for chunk in chunks:
+                await send_chunk(send, chunk)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError:
+            # The client has gone away while sending
+            pass
+        finally:
+            await chunks.aclose()
+
+    # The requests waiting for changes
+
+    async def long_poll_changes(self, scope, receive, send):
+        args = dict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        try:
+            since = int(args['since'])
+            wait = float(args.get('wait', 0))
+        except (KeyError, ValueError):
+            # Answered by the view
+            await self.call_flask(scope, receive, send)
+            return
+
+        async def view():
+            # The same as devices.list_changes
+            epoch, revision = await self.reader.get_version()
+            if since > revision:
+                message = 'Revision is newer than the current one, the whole list must be re-read'
+            elif not await self.reader.is_resumable(since, revision):
+                message = 'Revision is too old, the whole list must be re-read'
+            else:
+                message = None
+            if message is not None:
+                response = self.flask_app.json.response({'message': message, 'revision': revision})
+                response.status_code = HTTPStatus.GONE
+                return with_revision(response, epoch, revision), None
+            if revision == since and wait > 0:
+                await self.watcher.wait_for(since, min(wait, self.flask_app.config.get(
+                    'CHANGES_MAX_WAIT', events.DEFAULT_MAX_WAIT)))
+                revision = await self.reader.get_revision()
+            devices, deleted = await self.reader.get_changes_since(since)
+            response = self.flask_app.json.response({'revision': revision, 'devices': devices, 'deleted': deleted})
+            return with_revision(response, epoch, revision), None
+
+        await self.serve_natively(scope, receive, send, view)
+
+    async def stream_events(self, scope, receive, send):
+        headers = dict((key.decode('latin-1').lower(), value.decode('latin-1')) for key, value in scope['headers'])
+        last_event_id = headers.get('last-event-id', dict(parse_qsl(scope['query_string'].decode('latin-1')))
+                                    .get('last_event_id'))
+        last_revision = None
+        if last_event_id:
+            try:
+                last_revision = int(last_event_id)
+            except ValueError:
+                # Answered by the view
+                await self.call_flask(scope, receive, send)
+                return
+
+        async def view():
+            # The same headers as devices.stream_events, without its limit of the streams
+            response = Response(mimetype='text/event-stream')
+            response.cache_control.no_cache = True
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response, self.event_chunks(last_revision, receive)
+
+        await self.serve_natively(scope, receive, send, view)
+
+    async def event_chunks(self, last_revision, receive):
+        # The same stream as events.event_stream, until the client disconnects
+        disconnected = asyncio.get_running_loop().create_task(wait_for_disconnect(receive))
+        try:
+            yield f"retry: {events.RECONNECT_DELAY_MS}\n\n"
+            current_revision = await self.reader.get_revision()
+            if last_revision is None or not await self.reader.is_resumable(last_revision, current_revision):
+                logger.debug(f'Cannot resume the stream from {last_revision}, resetting to {current_revision}')
+                last_revision = current_revision
+                yield events.format_event(current_revision, events.RESET, json.dumps({'revision': current_revision}))
+            last_sent = time.monotonic()
+            while not disconnected.done():
+                heartbeat_interval = self.flask_app.config.get('EVENTS_HEARTBEAT_INTERVAL',
+                                                               events.DEFAULT_HEARTBEAT_INTERVAL)
+                timeout = max(heartbeat_interval - (time.monotonic() - last_sent), 0)
+                waiting = asyncio.ensure_future(self.watcher.wait_for(last_revision, timeout))
+                await asyncio.wait([waiting, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    break
+                seen_revision = waiting.result() or 0
+                if seen_revision > last_revision:
+                    rows = await self.reader.get_events_since(last_revision)
+                    for revision, action, data in rows:
+                        last_revision = revision
+                        yield events.format_event(revision, action, data)
+                    if not rows:
+                        # Nothing to send for the revision, don't read it again
+                        last_revision = seen_revision
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= heartbeat_interval:
+                    yield ": heartbeat\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            disconnected.cancel()
+
+    # Everything else
+
+    async def call_flask(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+
+        environ = wsgi_environ(scope, bytes(body))
+        # The Flask context of a streamed response stays pushed between its chunks, which any thread of the pool
+        # may generate: each request runs in a context of its own instead of the one of the thread
+        context = contextvars.Context()
+        chunks = await self.run(context.run, self.flask_app.wsgi_app, environ, start_response)
+        iterator = iter(chunks)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            # The streamed responses are generated in the thread pool, chunk by chunk
+            while True:
+                chunk = await self.run(context.run, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(chunks, 'close'):
+                await self.run(context.run, chunks.close)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            name = f'HTTP_{name}'
+            environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+def create_asgi_app(flask_app=None):
+    if flask_app is None:
+        from devmateback.app import app as flask_app
+    try:
+        threads = int(os.environ.get('ASGI_THREADS', DEFAULT_THREADS))
+    except ValueError as error:
+        logger.error(f'Invalid ASGI_THREADS: {error}')
+        return None
+    return AsgiApp(flask_app, threads)
+
+
+app = create_asgi_app()
+if app is None:
+    print("Failed to create the ASGI app!")
+    exit(1)
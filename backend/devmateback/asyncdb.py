@@ -0,0 +1,133 @@
+import logging
+
+from sqlalchemy import func, select
+from sqlalchemy.pool import NullPool
+
+from devmateback import events, listing, metrics, storage
+from devmateback.models import db, Device, DeviceEvent, FleetRevision
+from devmateback.revision import get_version
+
+try:
+    import aiosqlite
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:
+    aiosqlite = None
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# The database reads of the requests the ASGI app serves on the event loop (see devmateback/asgi.py): the fleet
+# version, the events and the changed devices. With the aiosqlite package (and greenlet, for the asyncio extension
+# of SQLAlchemy) they're made with an async engine on the database of the Flask app, so a waiting request never
+# takes a thread of the pool. Without them, the same reads run in the thread pool with the Flask session.
+#
+# The async engine doesn't pool its connections: they belong to the event loop which opened them, and these reads
+# are few, the revision once per poll interval for the whole process and the events once per change.
+
+# The same limit as the WSGI stream
+EVENTS_LIMIT = 1000
+
+
+class AsyncReader(object):
+    # The reads made with the async engine
+
+    def __init__(self, url, storage_settings=None, query_metrics=None):
+        self.engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'), poolclass=NullPool)
+        if storage_settings:
+            storage.register_pragmas(self.engine.sync_engine, storage_settings)
+        if query_metrics is not None:
+            metrics.register_query_events(self.engine.sync_engine, query_metrics)
+
+    async def get_version(self):
+        async with self.engine.connect() as connection:
+            row = (await connection.execute(
+                select(FleetRevision.epoch, FleetRevision.revision)
+                .where(FleetRevision.id == FleetRevision.ROW_ID))).first()
+        if row is None:
+            return '', 0
+        return row.epoch or '', row.revision or 0
+
+    async def get_revision(self):
+        _, revision = await self.get_version()
+        return revision
+
+    async def is_resumable(self, revision, current_revision):
+        if revision > current_revision:
+            return False
+        if revision == current_revision:
+            return True
+        async with self.engine.connect() as connection:
+            oldest = (await connection.execute(select(func.min(DeviceEvent.revision)))).scalar()
+        return oldest is not None and oldest <= revision + 1
+
+    async def get_events_since(self, revision):
+        # The events as (revision, action, data)
+        async with self.engine.connect() as connection:
+            rows = (await connection.execute(
+                select(DeviceEvent.revision, DeviceEvent.action, DeviceEvent.data)
+                .where(DeviceEvent.revision > revision).order_by(DeviceEvent.revision).limit(EVENTS_LIMIT))).all()
+        return [tuple(row) for row in rows]
+
+    async def get_changes_since(self, revision):
+        # The devices changed after the revision, and the names of the deleted ones
+        changed = select(DeviceEvent.device).where(DeviceEvent.revision > revision).distinct()
+        async with self.engine.connect() as connection:
+            names = set((await connection.execute(changed)).scalars())
+            if not names:
+                return [], []
+            rows = (await connection.execute(
+                listing.LIST_SELECT.where(Device.name.in_(changed)).order_by(Device.id))).all()
+        # The same dicts as Device.as_dict gives
+        devices = listing.serialize_rows(rows)
+        return devices, sorted(names - {device['name'] for device in devices})
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+class ThreadReader(object):
+    # The same reads with the Flask session, in the thread pool of the ASGI app
+
+    def __init__(self, flask_app, run):
+        self.flask_app = flask_app
+        self.run = run
+
+    def read_in_app(self, function, *args):
+        with self.flask_app.app_context():
+            try:
+                return function(*args)
+            finally:
+                db.session.remove()
+
+    async def get_version(self):
+        return await self.run(self.read_in_app, get_version)
+
+    async def get_revision(self):
+        _, revision = await self.get_version()
+        return revision
+
+    async def is_resumable(self, revision, current_revision):
+        return await self.run(self.read_in_app, events.is_resumable, revision, current_revision)
+
+    async def get_events_since(self, revision):
+        return await self.run(self.read_in_app, lambda: [(event.revision, event.action, event.data) for event
+                                                         in events.get_events_since(revision, EVENTS_LIMIT)])
+
+    async def get_changes_since(self, revision):
+        def read():
+            devices, deleted = events.get_changes_since(revision)
+            return [device.as_dict() for device in devices], deleted
+        return await self.run(self.read_in_app, read)
+
+    async def close(self):
+        pass
+
+
+def create_reader(flask_app, run):
+    # The async reader if aiosqlite is installed, the threaded one otherwise
+    if aiosqlite is None:
+        logger.info('The ASGI app reads the database in its thread pool, aiosqlite is not installed')
+        return ThreadReader(flask_app, run)
+    with flask_app.app_context():
+        url = db.engine.url
+    return AsyncReader(url, storage.load_profile(), flask_app.extensions.get(metrics.EXTENSION))
+
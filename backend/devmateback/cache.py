@@ -0,0 +1,179 @@
+import collections
+import logging
+import os
+import threading
+
+from sqlalchemy import select
+
+from devmateback.models import db, Device, DeviceEvent
+from devmateback import events, listing
+from devmateback.revision import get_version
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Per-process read cache of the serialized device lists and of the device rows looked up by name.
+#
+# Every change of the fleet bumps the revision row in the same transaction, by whatever worker makes it, so the
+# cache only has to compare the version (the epoch and the revision of the row) it was filled at with the current
+# one, which is a primary key read. A recreated or restored database has another epoch, and drops everything.
+# When the revision moves, the lists are dropped, and only the devices named by the events since the cached
+# revision are evicted from the rows, so the rest of them stay warm across writes. If those events have
+# already been pruned, everything is dropped.
+#
+# The revision must always be read before the data it's cached with: then the data is never older than its
+# revision, and anything changed after it is named by a later event. A change made behind the back of the
+# revision row (e.g. with the sqlite3 shell) isn't seen until the next bump, the same as with the list ETag.
+
+EXTENSION = 'devmate_read_cache'
+# Defaults, can be overridden with READ_CACHE_MAX_LISTS, READ_CACHE_MAX_BYTES and READ_CACHE_MAX_DEVICES.
+# Zero lists disables the cache.
+DEFAULT_MAX_LISTS = 64
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_DEVICES = 10000
+
+
+class ReadCache(object):
+
+    def __init__(self, max_lists=DEFAULT_MAX_LISTS, max_bytes=DEFAULT_MAX_BYTES, max_devices=DEFAULT_MAX_DEVICES):
+        self.max_lists = max_lists
+        self.max_bytes = max_bytes
+        self.max_devices = max_devices
+        self.lock = threading.Lock()
+        # The epoch and the revision
+        self.version = None
+        # Query string -> (status, body), and device name -> row, or None for a missing device.
+        # Both are in LRU order.
+        self.lists = collections.OrderedDict()
+        self.list_bytes = 0
+        self.devices = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.lists.clear()
+            self.list_bytes = 0
+            self.devices.clear()
+
+    def validate(self, version):
+        # Must be called with the current version before the cache is used
+        with self.lock:
+            cached_version = self.version
+            if cached_version == version:
+                return
+            has_devices = bool(self.devices)
+
+        changed = None
+        if cached_version is not None and cached_version[0] == version[0] and cached_version[1] < version[1] \
+                and has_devices:
+            changed = changed_since(cached_version[1], version[1])
+
+        with self.lock:
+            if self.version != cached_version:
+                # Another thread got here first, the changes it has seen may be different
+                changed = None
+            self.lists.clear()
+            self.list_bytes = 0
+            if changed is None:
+                self.devices.clear()
+                self.stats['resets'] += 1
+            else:
+                for name in changed:
+                    self.devices.pop(name, None)
+            self.version = version
+
+    def get_list(self, version, key):
+        with self.lock:
+            entry = self.lists.get(key) if version == self.version else None
+            if entry is None:
+                self.stats['list_misses'] += 1
+                return None
+            self.lists.move_to_end(key)
+            self.stats['list_hits'] += 1
+            return entry
+
+    def put_list(self, version, key, status, body):
+        size = len(body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if version != self.version or key in self.lists:
+                return
+            self.lists[key] = (status, body)
+            self.list_bytes += size
+            while len(self.lists) > self.max_lists or self.list_bytes > self.max_bytes:
+                _, (_, evicted_body) = self.lists.popitem(last=False)
+                self.list_bytes -= len(evicted_body)
+
+    def get_devices(self, version, names):
+        # Returns the cached rows by name, and the names which have to be read
+        found = {}
+        missing = []
+        with self.lock:
+            current = version == self.version
+            for name in names:
+                if current and name in self.devices:
+                    self.devices.move_to_end(name)
+                    found[name] = self.devices[name]
+                else:
+                    missing.append(name)
+            self.stats['device_hits'] += len(found)
+            self.stats['device_misses'] += len(missing)
+        return found, missing
+
+    def put_devices(self, version, rows):
+        with self.lock:
+            if version != self.version:
+                return
+            self.devices.update(rows)
+            while len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update(version=self.version, lists=len(self.lists), list_bytes=self.list_bytes,
+                         devices=len(self.devices))
+        return stats
+
+
+def changed_since(cached_revision, revision):
+    # The names of the devices changed after the cached revision, or None if some of the events are gone
+    if not events.is_resumable(cached_revision, revision):
+        return None
+    return set(db.session.execute(
+        select(DeviceEvent.device).where(DeviceEvent.revision > cached_revision, DeviceEvent.revision <= revision)
+        .distinct()).scalars())
+
+
+def lookup_devices(read_cache, names):
+    # Returns the rows of the devices by name, None for the missing ones
+    version = get_version()
+    read_cache.validate(version)
+    rows, missing = read_cache.get_devices(version, names)
+    if missing:
+        found = {row.name: row for row in
+                 db.session.execute(listing.LIST_SELECT.where(Device.name.in_(missing)))}
+        read_rows = {name: found.get(name) for name in missing}
+        read_cache.put_devices(version, read_rows)
+        rows.update(read_rows)
+    return rows
+
+
+def list_key(args):
+    # The same query in any parameter order is the same list
+    return tuple(sorted(args.items(multi=True)))
+
+
+def init_read_cache(app_to_setup):
+    try:
+        max_lists = int(os.environ.get('READ_CACHE_MAX_LISTS', DEFAULT_MAX_LISTS))
+        max_bytes = int(os.environ.get('READ_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        max_devices = int(os.environ.get('READ_CACHE_MAX_DEVICES', DEFAULT_MAX_DEVICES))
+    except ValueError as error:
+        logger.error(f'Invalid read cache setting: {error}')
+        return None
+    if max_lists > 0:
+        app_to_setup.extensions[EXTENSION] = ReadCache(max_lists, max_bytes, max_devices)
+        logger.debug(f'Read cache enabled: {max_lists} lists, {max_bytes} bytes, {max_devices} devices')
+    return True
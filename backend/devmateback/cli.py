@@ -1,11 +1,27 @@
+import base64
 import logging
+import os
 
-from flask import Blueprint, request, jsonify, send_from_directory, current_app
+from urllib.parse import quote
+
+from flask import Blueprint, request, jsonify, send_file, current_app
 from http import HTTPStatus
 
+from devmateback import artifacts
+
+DELTA_ENCODING = 'devmate-delta'
+
 cli_bp = Blueprint('cli', __name__)
 logger = logging.getLogger(f"devmate.{__name__}")
 
+# The binaries are served with their sha256 as a strong ETag (see devmateback/artifacts.py): the clients which
+# already have the binary send it in If-None-Match and get a 304, and the interrupted downloads are resumed with
+# Range (and If-Range). The responses must be revalidated, the latest binary changes with each release.
+# A whole download is sent precompressed when the client accepts it, with the ETag <sha256>-<encoding>. The sha256
+# of the binary itself still matches in If-None-Match, it's the same binary once decoded.
+# A client which sends A-IM: devmate-delta and the sha256 of its binary in If-None-Match gets the delta from its
+# version to the latest one, if there is one (226 IM Used, RFC 3229), see devmateback/deltas.py.
+
 
 @cli_bp.route('/get', methods=['GET'])
 def download_cli():
@@ -17,7 +33,6 @@ def download_cli():
     platform = request.args.get('platform')
     logger.debug(f"Platform from request: {platform}")
 
-    file_name = "devmate"
     if not platform:
         logger.debug("No platform specified, trying to guess from user agent")
         user_agent = request.headers.get('User-Agent', '').lower()
@@ -29,21 +44,84 @@ def download_cli():
         elif 'linux' in user_agent.lower():
             platform = 'linux'
 
-    if platform not in ['linux', 'macos', 'windows']:
+    if platform not in artifacts.PLATFORMS:
         return jsonify({"message": "Invalid platform"}), HTTPStatus.BAD_REQUEST
 
-    if platform == 'windows':
-        file_name += '.exe'
-
     logger.debug(f"Platform: {platform}")
-    logger.debug(f"File name: {file_name}")
 
-    platform_path = f"{cli_dir}/devmatecli-{platform}-latest/"
+    index = current_app.extensions.get(artifacts.EXTENSION)
+    artifact = index.get(platform) if index is not None else None
+    if artifact is None:
+        return jsonify({"message": "CLI binary not found"}), HTTPStatus.NOT_FOUND
+
+    # A resumed download continues the binary itself
+    variant = None if request.range else artifact.select_variant(request.accept_encodings)
+    path, etag, sha256 = (variant.path, variant.etag, variant.sha256) if variant else \
+        (artifact.path, artifact.sha256, artifact.sha256)
+
+    if request.if_none_match.contains(artifact.sha256) or request.if_none_match.contains(etag):
+        response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+        response.set_etag(etag)
+        return with_download_headers(response, variant, sha256)
+
+    if DELTA_ENCODING in request.headers.get('A-IM', '') and not request.range:
+        delta = next((artifact.deltas[base] for base in request.if_none_match if base in artifact.deltas), None)
+        if delta is not None:
+            return send_delta(artifact, delta)
+
+    accel_prefix = current_app.config.get('CLI_ACCEL_REDIRECT')
+    if accel_prefix and request.headers.get('X-Devmate-Accel'):
+        # nginx sends the file, and handles the ranges
+        response = current_app.response_class(mimetype='application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_prefix + quote(os.path.relpath(path, cli_dir))
+        response.headers.set('Content-Disposition', 'attachment', filename=artifact.file_name)
+        response.set_etag(etag)
+        return with_download_headers(response, variant, sha256)
 
     try:
-        return send_from_directory(platform_path, file_name, as_attachment=True)
+        response = send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                             download_name=artifact.file_name, etag=etag, last_modified=artifact.mtime,
+                             conditional=True)
     except FileNotFoundError:
         return jsonify({"message": "CLI binary not found"}), HTTPStatus.NOT_FOUND
     except Exception as e:
         logger.error(f"Failed to send CLI binary: {str(e)}")
         return jsonify({"message": "Failed to download CLI binary"}), HTTPStatus.INTERNAL_SERVER_ERROR
+    return with_download_headers(response, variant, sha256)
+
+
+def send_delta(artifact, delta):
+    # Sent by the backend, nginx would answer 200 instead of 226. The deltas are small.
+    try:
+        response = send_file(delta.path, mimetype='application/octet-stream', etag=False, conditional=False)
+    except FileNotFoundError:
+        return jsonify({"message": "CLI binary not found"}), HTTPStatus.NOT_FOUND
+    response.status_code = HTTPStatus.IM_USED
+    response.headers['IM'] = DELTA_ENCODING
+    response.headers['Delta-Base'] = f'"{delta.base_sha256}"'
+    response.set_etag(artifact.sha256)
+    response.vary.update(['A-IM', 'If-None-Match'])
+    return with_download_headers(response, None, artifact.sha256)
+
+
+def with_download_headers(response, variant, sha256):
+    if variant is not None:
+        response.headers['Content-Encoding'] = variant.encoding
+    response.headers['Repr-Digest'] = f"sha-256=:{base64.b64encode(bytes.fromhex(sha256)).decode()}:"
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
+
+
+@cli_bp.route('/manifest', methods=['GET'])
+def cli_manifest():
+    # The binaries of all the platforms, for the update checks
+    index = current_app.extensions.get(artifacts.EXTENSION)
+    if index is None:
+        logger.error("CLI getting interface not set up!")
+        return jsonify({"message": "CLI binary directory doesn't exist!"}), HTTPStatus.INTERNAL_SERVER_ERROR
+
+    response = jsonify(index.manifest())
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
@@ -0,0 +1,197 @@
+import glob
+import hashlib
+import logging
+import lzma
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Binary deltas between the versions of a CLI binary, so a client updates with the changes only.
+#
+# Each indexed binary is kept in CLI_DIR/devmatecli-<platform>-history/<sha256>, the last CLI_DELTA_VERSIONS of
+# them. When a new binary is indexed, a delta from each kept version to it is computed, once, in the same
+# directory: <base sha256 prefix>-<target sha256 prefix>.delta. /cli/get sends it to a client which has the base
+# version (RFC 3229 delta encoding: A-IM: devmate-delta and If-None-Match with the sha256 of its binary).
+#
+# The delta: both versions are cut into chunks where the content has a given pattern (so an insertion only
+# changes the chunks around it), the chunks of the new version found in the old one are copied from it, and the
+# others are added. The operations are compressed with lzma.
+#   header: DMDELTA1, sha256 of the base, sha256 of the target, size of the target
+#   operations: C <offset> <length> copies from the base, A <length> <bytes> adds
+# devmatecli/client.py applies it, the format must stay the same.
+
+MAGIC = b'DMDELTA1'
+HEADER = struct.Struct('>8s32s32sQ')
+COPY = b'C'
+ADD = b'A'
+COPY_OPERATION = struct.Struct('>QI')
+ADD_OPERATION = struct.Struct('>I')
+# Two bytes with a 1/256 chance in random data, a chunk is at least MIN_CHUNK_SIZE long
+CHUNK_BOUNDARY = re.compile(rb'[\x01-\x10][\x80-\x8f]', re.DOTALL)
+MIN_CHUNK_SIZE = 64
+MAX_CHUNK_SIZE = 64 * 1024
+LZMA_PRESET = 6
+DEFAULT_VERSIONS = 5
+DIGEST_PREFIX_LENGTH = 16
+
+
+class DeltaError(Exception):
+    pass
+
+
+def chunks(data):
+    # Yields the (start, end) of the chunks
+    start = 0
+    for match in CHUNK_BOUNDARY.finditer(data):
+        end = match.end()
+        if end - start < MIN_CHUNK_SIZE:
+            continue
+        while end - start > MAX_CHUNK_SIZE:
+            yield start, start + MAX_CHUNK_SIZE
+            start += MAX_CHUNK_SIZE
+        yield start, end
+        start = end
+    while start < len(data):
+        yield start, min(start + MAX_CHUNK_SIZE, len(data))
+        start += MAX_CHUNK_SIZE
+
+
+def chunk_key(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def encode(base, target):
+    base_chunks = {}
+    for start, end in chunks(base):
+        base_chunks.setdefault(chunk_key(base[start:end]), start)
+
+    # [operation, offset, length], the adjacent copies and adds are merged
+    operations = []
+    for start, end in chunks(target):
+        data = target[start:end]
+        offset = base_chunks.get(chunk_key(data))
+        if offset is not None and base[offset:offset + len(data)] == data:
+            if operations and operations[-1][0] == COPY and operations[-1][1] + operations[-1][2] == offset:
+                operations[-1][2] += len(data)
+            else:
+                operations.append([COPY, offset, len(data)])
+        elif operations and operations[-1][0] == ADD:
+            operations[-1][2] += len(data)
+        else:
+            operations.append([ADD, start, len(data)])
+
+    body = bytearray()
+    for operation, offset, length in operations:
+        if operation == COPY:
+            body += COPY + COPY_OPERATION.pack(offset, length)
+        else:
+            body += ADD + ADD_OPERATION.pack(length) + target[offset:offset + length]
+    header = HEADER.pack(MAGIC, hashlib.sha256(base).digest(), hashlib.sha256(target).digest(), len(target))
+    return header + lzma.compress(bytes(body), preset=LZMA_PRESET)
+
+
+def apply(base, delta):
+    try:
+        magic, base_digest, target_digest, target_size = HEADER.unpack_from(delta)
+        body = lzma.decompress(delta[HEADER.size:])
+    except (struct.error, lzma.LZMAError) as error:
+        raise DeltaError(f'Invalid delta: {error}')
+    if magic != MAGIC:
+        raise DeltaError('Invalid delta: not a devmate delta')
+    if hashlib.sha256(base).digest() != base_digest:
+        raise DeltaError('The delta is not for this version')
+
+    target = bytearray()
+    position = 0
+    while position < len(body):
+        operation = body[position:position + 1]
+        position += 1
+        if operation == COPY:
+            offset, length = COPY_OPERATION.unpack_from(body, position)
+            position += COPY_OPERATION.size
+            target += base[offset:offset + length]
+        elif operation == ADD:
+            length, = ADD_OPERATION.unpack_from(body, position)
+            position += ADD_OPERATION.size
+            target += body[position:position + length]
+            position += length
+        else:
+            raise DeltaError(f'Invalid delta operation {operation}')
+    if len(target) != target_size or hashlib.sha256(target).digest() != target_digest:
+        raise DeltaError('The patched binary has a wrong digest')
+    return bytes(target)
+
+
+def write_atomically(path, write):
+    # The other workers see the whole file or none
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.writing-', delete=False) as f:
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+class Delta(object):
+
+    def __init__(self, base_sha256, path):
+        self.base_sha256 = base_sha256
+        self.path = path
+        self.size = os.path.getsize(path)
+
+
+def history_dir(cli_dir, platform):
+    return os.path.join(cli_dir, f'devmatecli-{platform}-history')
+
+
+def update_history(directory, path, sha256, versions, max_size):
+    # Keeps the binary in the history and returns the deltas to it by the base sha256, the ones smaller than
+    # max_size (what a whole download would take)
+    os.makedirs(directory, exist_ok=True)
+    kept_path = os.path.join(directory, sha256)
+    if not os.path.exists(kept_path):
+        with open(path, 'rb') as source:
+            write_atomically(kept_path, lambda target: shutil.copyfileobj(source, target))
+    else:
+        # The newest versions are kept, an older version which is the latest again counts as new
+        os.utime(kept_path)
+
+    kept = sorted((kept_path for kept_path in glob.glob(os.path.join(directory, '[0-9a-f]' * 64))),
+                  key=os.path.getmtime, reverse=True)
+    for old_path in kept[versions:]:
+        os.remove(old_path)
+    bases = [os.path.basename(kept_path) for kept_path in kept[1:versions]]
+
+    deltas = {}
+    target = None
+    target_prefix = sha256[:DIGEST_PREFIX_LENGTH]
+    for base_sha256 in bases:
+        delta_path = os.path.join(directory, f'{base_sha256[:DIGEST_PREFIX_LENGTH]}-{target_prefix}.delta')
+        if not os.path.exists(delta_path):
+            if target is None:
+                with open(kept_path, 'rb') as f:
+                    target = f.read()
+            with open(os.path.join(directory, base_sha256), 'rb') as f:
+                base = f.read()
+            delta = encode(base, target)
+            write_atomically(delta_path, lambda f: f.write(delta))
+            logger.info(f'Delta from {base_sha256[:DIGEST_PREFIX_LENGTH]} to {target_prefix}: {len(delta)} bytes')
+        delta = Delta(base_sha256, delta_path)
+        if delta.size < max_size:
+            deltas[base_sha256] = delta
+
+    # The deltas to the older versions and from the removed ones
+    wanted = set(f'{base_sha256[:DIGEST_PREFIX_LENGTH]}-{target_prefix}.delta' for base_sha256 in bases)
+    for delta_path in glob.glob(os.path.join(directory, '*.delta')):
+        if os.path.basename(delta_path) not in wanted:
+            try:
+                os.remove(delta_path)
+            except OSError:
+                pass
+    return deltas
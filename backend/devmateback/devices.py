@@ -1,26 +1,244 @@
 import logging
-
-from datetime import datetime, timezone
-from flask import Blueprint, request, jsonify
+import os
+from flask import Blueprint, request, jsonify, make_response, Response, stream_with_context, current_app
 from http import HTTPStatus
 
-from devmateback.app import db
-from devmateback.models import Device
+from devmateback import cache, events, leases, listing, operations, state
+from devmateback.revision import get_version, revision_etag
 from devmateback.validation import validate_request
 
 devices_bp = Blueprint('devices', __name__)
 logger = logging.getLogger(f"devmate.{__name__}")
 
+REVISION_HEADER = 'X-Fleet-Revision'
+
+# /devices/batch modes: all or nothing, or each operation on its own
+BATCH_ATOMIC = 'atomic'
+BATCH_BEST_EFFORT = 'best_effort'
+# Keeps the device names of a batch within the SQLite limit of query parameters
+BATCH_MAX_SIZE = 500
+# Largest gang reservation of /devices/reserve_any
+RESERVE_ANY_MAX_COUNT = 100
+# How often a waiting reservation checks its place in the queue, can be overridden in the app config.
+# The longest wait is CHANGES_MAX_WAIT, like for the other long-polls.
+DEFAULT_RESERVE_POLL_INTERVAL = 0.2
+# A waiting reservation holds a thread of the worker, so only RESERVE_MAX_WAITERS of them wait at once. The
+# others are answered at once, as without wait.
+WAITERS_EXTENSION = 'devmate_reserve_waiters'
+DEFAULT_MAX_WAITERS = 8
+
+
+def store():
+    # The in-memory state engine when it's enabled, the database otherwise. Both have the same operations.
+    return current_app.extensions.get(state.EXTENSION, operations)
+
+
+@devices_bp.before_app_request
+def start_lease_scheduler():
+    scheduler = current_app.extensions.get(leases.EXTENSION)
+    if scheduler is not None:
+        scheduler.ensure_started()
+
+
+def schedule_leases(names, lease_expires):
+    scheduler = current_app.extensions.get(leases.EXTENSION)
+    if scheduler is not None and lease_expires is not None:
+        for name in names:
+            scheduler.schedule(name, lease_expires)
+
+
+@devices_bp.teardown_app_request
+def rollback_unfinished(exception):
+    # A request which failed halfway must not keep the state engine locked
+    engine = current_app.extensions.get(state.EXTENSION)
+    if engine is not None:
+        engine.rollback()
+
+
+def with_revision(response, epoch, revision):
+    response.set_etag(revision_etag(epoch, revision))
+    # The revision to ask /devices/changes from
+    response.headers[REVISION_HEADER] = str(revision)
+    # Let the browsers keep the list, but revalidate it on every poll
+    response.cache_control.no_cache = True
+    return response
+
 
 @devices_bp.route('/list', methods=['GET'])
 def list_devices():
     logger.debug('Listing devices')
-    devices = Device.query.all()
-    if not devices:
+    # Read the revision before the devices: the ETag may be older than the data sent, but never newer
+    version = store().get_list_version()
+    epoch, revision = version
+    if request.if_none_match.contains(revision_etag(epoch, revision)):
+        logger.debug('Devices not modified')
+        return with_revision(make_response('', HTTPStatus.NOT_MODIFIED), epoch, revision)
+
+    # The same list at the same revision is served from the cache, without reading the devices.
+    # The in-memory state engine reads its lists from memory anyway.
+    read_cache = current_app.extensions.get(cache.EXTENSION) if store() is operations else None
+    if read_cache is not None:
+        read_cache.validate(version)
+        cache_key = cache.list_key(request.args)
+        cached = read_cache.get_list(version, cache_key)
+        if cached is not None:
+            status, body = cached
+            logger.debug('Devices served from the cache')
+            return with_revision(current_app.response_class(body, status=status, mimetype='application/json'),
+                                 epoch, revision)
+
+    params, error_message = listing.parse_list_args(request.args)
+    if error_message:
+        logger.error(f'Invalid request: {error_message}')
+        return jsonify({'message': error_message}), HTTPStatus.BAD_REQUEST
+
+    if params.stream:
+        # The rows are read and sent in chunks, so the memory doesn't grow with the fleet
+        chunks = store().stream_list(
+            params, current_app.config.get('LIST_STREAM_CHUNK_SIZE', listing.DEFAULT_STREAM_CHUNK_SIZE))
+        if chunks is None:
+            logger.debug('No devices found')
+            return with_revision(make_response('', HTTPStatus.NO_CONTENT), epoch, revision)
+        logger.debug(f'Streaming devices as {params.format}')
+        return with_revision(listing.streamed_response(params, chunks), epoch, revision)
+
+    rows = store().list_rows(params)
+    rows, next_cursor = listing.paginate(rows, params)
+    if not rows:
         logger.debug('No devices found')
-        return '', HTTPStatus.NO_CONTENT
-    logger.debug(f'Found {len(devices)} devices')
-    return jsonify({"devices": [device.as_dict() for device in devices]}), HTTPStatus.OK
+        if read_cache is not None:
+            read_cache.put_list(version, cache_key, HTTPStatus.NO_CONTENT, b'')
+        return with_revision(make_response('', HTTPStatus.NO_CONTENT), epoch, revision)
+    logger.debug(f'Found {len(rows)} devices')
+    result = {"devices": listing.serialize_rows(rows)}
+    if next_cursor:
+        result['next_cursor'] = next_cursor
+    response = listing.json_response(result)
+    if read_cache is not None:
+        read_cache.put_list(version, cache_key, HTTPStatus.OK, response.get_data())
+    return with_revision(response, epoch, revision)
+
+
+@devices_bp.route('/changes', methods=['GET'])
+def list_changes():
+    logger.debug('Listing device changes')
+    try:
+        since = int(request.args['since'])
+        wait = float(request.args.get('wait', 0))
+    except KeyError:
+        logger.error('Invalid request')
+        return jsonify({'message': 'Missing parameters: since'}), HTTPStatus.BAD_REQUEST
+    except ValueError:
+        logger.error('Invalid request')
+        return jsonify({'message': 'Invalid since or wait value'}), HTTPStatus.BAD_REQUEST
+
+    epoch, revision = get_version()
+    if since > revision:
+        # A revision of a database before it was restored or recreated
+        logger.debug(f'Changes since {since} asked, but the fleet is at revision {revision}')
+        return with_revision(jsonify({'message': 'Revision is newer than the current one, '
+                                                 'the whole list must be re-read',
+                                      'revision': revision}), epoch, revision), HTTPStatus.GONE
+    if not events.is_resumable(since, revision):
+        logger.debug(f'Changes since {since} are not available anymore')
+        return with_revision(jsonify({'message': 'Revision is too old, the whole list must be re-read',
+                                      'revision': revision}), epoch, revision), HTTPStatus.GONE
+
+    if revision == since and wait > 0:
+        wait = min(wait, current_app.config.get('CHANGES_MAX_WAIT', events.DEFAULT_MAX_WAIT))
+        revision = events.wait_for_revision(
+            since, wait, poll_interval=current_app.config.get('EVENTS_POLL_INTERVAL', events.DEFAULT_POLL_INTERVAL))
+
+    devices, deleted = events.get_changes_since(since)
+    logger.debug(f'Found {len(devices)} changed and {len(deleted)} deleted devices since {since}')
+    return with_revision(jsonify({'revision': revision,
+                                  'devices': [device.as_dict() for device in devices],
+                                  'deleted': deleted}), epoch, revision), HTTPStatus.OK
+
+
+@devices_bp.route('/events', methods=['GET'])
+def stream_events():
+    logger.debug('Streaming device events')
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    last_revision = None
+    if last_event_id:
+        try:
+            last_revision = int(last_event_id)
+        except ValueError:
+            logger.error(f'Invalid Last-Event-ID {last_event_id}')
+            return jsonify({'message': 'Invalid Last-Event-ID'}), HTTPStatus.BAD_REQUEST
+
+    slots = current_app.extensions.get(events.STREAMS_EXTENSION)
+    if slots is not None and not slots.acquire():
+        logger.warning('Too many open event streams, rejecting a new one')
+        response = jsonify({'message': 'Too many open event streams, retry later'})
+        response.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+        response.headers['Retry-After'] = str(events.STREAM_RETRY_AFTER)
+        return response
+
+    stream = events.event_stream(
+        last_revision,
+        poll_interval=current_app.config.get('EVENTS_POLL_INTERVAL', events.DEFAULT_POLL_INTERVAL),
+        heartbeat_interval=current_app.config.get('EVENTS_HEARTBEAT_INTERVAL', events.DEFAULT_HEARTBEAT_INTERVAL))
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Ask the proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    if slots is not None:
+        # When the client goes away and the server closes the stream
+        response.call_on_close(slots.release)
+    return response
+
+
+def parse_wait(value):
+    # Returns the seconds to wait, 0 for no waiting, and None, or None and the error message
+    if not value:
+        return 0, None
+    try:
+        wait = float(value[:-1] if value.endswith('s') else value)
+    except ValueError:
+        wait = -1
+    if not wait >= 0:
+        return None, 'Invalid wait, expected a number of seconds, e.g. 30 or 30s'
+    return min(wait, current_app.config.get('CHANGES_MAX_WAIT', events.DEFAULT_MAX_WAIT)), None
+
+
+def wait_in_queue(devices, username, lease, wait, device=None, model=None):
+    # Queues the reservation and blocks until a device is handed to it or the wait is over.
+    # Returns the name of the device and the end of its lease, or None.
+    slots = current_app.extensions.get(WAITERS_EXTENSION)
+    if slots is not None and not slots.acquire():
+        logger.warning(f'Too many waiting reservations, {username} is not queued')
+        return None
+    try:
+        waiter_id = devices.enqueue(username, lease, wait, device=device, model=model)
+        devices.commit()
+        grant = devices.wait_for_grant(
+            waiter_id, wait, current_app.config.get('RESERVE_POLL_INTERVAL', DEFAULT_RESERVE_POLL_INTERVAL))
+    finally:
+        if slots is not None:
+            slots.release()
+    if grant is None:
+        logger.debug(f'{username} has waited for {wait} seconds in vain')
+        return None
+    schedule_leases([grant[0]], grant[1])
+    return grant
+
+
+def init_wait_slots(app_to_setup):
+    try:
+        max_waiters = int(os.environ.get('RESERVE_MAX_WAITERS', DEFAULT_MAX_WAITERS))
+    except ValueError as error:
+        logger.error(f'Invalid RESERVE_MAX_WAITERS: {error}')
+        return None
+    app_to_setup.extensions[WAITERS_EXTENSION] = events.RequestSlots(max_waiters)
+    return True
+
+
+def operation_response(body, status):
+    if body is None:
+        return '', status
+    return jsonify(body), status
 
 
 @devices_bp.route('/reserve', methods=['POST'])
@@ -33,23 +251,96 @@ def reserve_device():
 
     device = request.json['device']
     username = request.json['username']
+    lease_expires, error_message = leases.parse_lease(request.json.get('lease'))
+    if not error_message:
+        wait, error_message = parse_wait(request.args.get('wait'))
+    if error_message:
+        logger.error(f'Invalid request: {error_message}')
+        return jsonify({'message': error_message}), HTTPStatus.BAD_REQUEST
 
-    device = Device.query.filter_by(name=device).first()
-    if device:
-        if device.status == Device.FREE:
-            device.status = Device.RESERVED
-            device.user = username
-            device.reservation_time = datetime.utcnow().replace(tzinfo=timezone.utc).astimezone(timezone.utc)
-            db.session.commit()
-            logger.info(f'Device {device} reserved by {username}')
-            return jsonify({'message': 'Device reserved'})
-        else:
-            logger.debug(f'Device {device} not available for reservation')
-            return jsonify({'message': 'Device not available for reservation',
-                            'reserved_by': device.user}), HTTPStatus.CONFLICT
+    devices = store()
+    body, status = devices.reserve(device, username, lease_expires)
+    devices.commit()
+    if status == HTTPStatus.CONFLICT and wait:
+        # Instead of retrying, the client gets the device as soon as it's its turn
+        grant = wait_in_queue(devices, username, request.json.get('lease'), wait, device=device)
+        if grant is not None:
+            return operation_response(operations.reserved_body(grant[1]), HTTPStatus.OK)
+        # Nobody may be waiting for the device now, so it may be free
+        lease_expires, _ = leases.parse_lease(request.json.get('lease'))
+        body, status = devices.reserve(device, username, lease_expires)
+        devices.commit()
+    if status == HTTPStatus.OK:
+        schedule_leases([device], lease_expires)
+    return operation_response(body, status)
+
+
+@devices_bp.route('/reserve_any', methods=['POST'])
+def reserve_any_device():
+    logger.debug('Reserving any device of a model')
+    is_valid, error_response, status_code = validate_request(request, ['model', 'username'])
+    if not is_valid:
+        logger.error(f'Invalid request')
+        return error_response, status_code
+
+    count = request.json.get('count', 1)
+    # JSON true is an int for Python
+    if not isinstance(count, int) or isinstance(count, bool) or not 0 < count <= RESERVE_ANY_MAX_COUNT:
+        logger.error(f'Invalid count {count}')
+        return jsonify({'message': f'Invalid count, expected 1 to {RESERVE_ANY_MAX_COUNT}'}), HTTPStatus.BAD_REQUEST
+
+    lease_expires, error_message = leases.parse_lease(request.json.get('lease'))
+    if not error_message:
+        wait, error_message = parse_wait(request.args.get('wait'))
+    if not error_message and wait and (count != 1 or request.json.get('info')):
+        error_message = 'Only a single device without info can be waited for'
+    if error_message:
+        logger.error(f'Invalid request: {error_message}')
+        return jsonify({'message': error_message}), HTTPStatus.BAD_REQUEST
+
+    model = request.json['model']
+    username = request.json['username']
+    devices = store()
+    body, status = reserve_any_once(devices, model, username, count, request.json.get('info'), lease_expires)
+    if status == HTTPStatus.CONFLICT and wait:
+        grant = wait_in_queue(devices, username, request.json.get('lease'), wait, model=model)
+        if grant is not None:
+            return operation_response(operations.reserved_body(grant[1], [grant[0]]), HTTPStatus.OK)
+        lease_expires, _ = leases.parse_lease(request.json.get('lease'))
+        body, status = reserve_any_once(devices, model, username, count, None, lease_expires)
+    return operation_response(body, status)
+
+
+def reserve_any_once(devices, model, username, count, info, lease_expires):
+    body, status = devices.reserve_any(model, username, count, info, lease_expires)
+    if operations.is_failure(status):
+        devices.rollback()
     else:
-        logger.error(f'Device {device} not found')
-        return jsonify({'message': 'Device not found'}), HTTPStatus.NOT_FOUND
+        devices.commit()
+        schedule_leases(body['devices'], lease_expires)
+    return body, status
+
+
+@devices_bp.route('/renew', methods=['POST'])
+def renew_device():
+    logger.debug('Renewing device lease')
+    is_valid, error_response, status_code = validate_request(request, ['device', 'username', 'lease'])
+    if not is_valid:
+        logger.error(f'Invalid request')
+        return error_response, status_code
+
+    device = request.json['device']
+    lease_expires, error_message = leases.parse_lease(request.json['lease'])
+    if error_message:
+        logger.error(f'Invalid request: {error_message}')
+        return jsonify({'message': error_message}), HTTPStatus.BAD_REQUEST
+
+    devices = store()
+    body, status = devices.renew(device, request.json['username'], lease_expires)
+    devices.commit()
+    if status == HTTPStatus.OK:
+        schedule_leases([device], lease_expires)
+    return operation_response(body, status)
 
 
 @devices_bp.route('/release', methods=['POST'])
@@ -61,21 +352,10 @@ def release_device():
         return error_response, status_code
 
     device = request.json['device']
-    device = Device.query.filter_by(name=device).first()
-    if device:
-        if device.status == Device.RESERVED:
-            device.status = Device.FREE
-            device.user = None
-            device.reservation_time = None
-            db.session.commit()
-            logger.info(f'Device {device} released')
-            return jsonify({'message': 'Device released'})
-        else:
-            logger.debug(f'Device {device} not reserved')
-            return jsonify({'message': 'Device is not reserved'}), HTTPStatus.NOT_MODIFIED
-    else:
-        logger.error(f'Device {device} not found')
-        return jsonify({'message': 'Device not found'}), HTTPStatus.NOT_FOUND
+    devices = store()
+    body, status = devices.release(device)
+    devices.commit()
+    return operation_response(body, status)
 
 
 @devices_bp.route('/add', methods=['POST'])
@@ -92,16 +372,10 @@ def add_device():
     else:
         info = None
 
-    existing_device = Device.query.filter_by(name=device).first()
-    if existing_device:
-        logger.debug(f'Device {device} already exists')
-        return jsonify({"message": "Device with this name already exists"}), HTTPStatus.CONFLICT
-
-    new_device = Device(name=device, model=model, status=Device.FREE, info=info)
-    db.session.add(new_device)
-    db.session.commit()
-    logger.info(f'Device {device} added')
-    return jsonify({'message': 'Device added'}), HTTPStatus.CREATED
+    devices = store()
+    body, status = devices.add(device, model, info)
+    devices.commit()
+    return operation_response(body, status)
 
 
 @devices_bp.route('/offline', methods=['POST'])
@@ -112,22 +386,10 @@ def set_device_offline():
         return error_response, status_code
 
     device = request.json['device']
-    device = Device.query.filter_by(name=device).first()
-
-    if device:
-        if device.status != Device.OFFLINE:
-            device.status = Device.OFFLINE
-            device.user = None
-            device.reservation_time = None
-            db.session.commit()
-            logger.info(f'Device {device} set to offline')
-            return jsonify({'message': 'Device set to offline'}), HTTPStatus.OK
-        else:
-            logger.debug(f'Device {device} already offline')
-            return '', HTTPStatus.NOT_MODIFIED
-    else:
-        logger.error(f'Device {device} not found')
-        return jsonify({'message': 'Device not found'}), HTTPStatus.NOT_FOUND
+    devices = store()
+    body, status = devices.set_offline(device)
+    devices.commit()
+    return operation_response(body, status)
 
 
 @devices_bp.route('/online', methods=['POST'])
@@ -138,20 +400,10 @@ def set_device_free():
         return error_response, status_code
 
     device = request.json['device']
-    device = Device.query.filter_by(name=device).first()
-
-    if device:
-        if device.status == Device.OFFLINE:
-            device.status = Device.FREE
-            db.session.commit()
-            logger.info(f'Device {device} set to available')
-            return jsonify({'message': 'Device set to available'}), HTTPStatus.OK
-        else:
-            logger.debug(f'Device {device} already available')
-            return '', HTTPStatus.NOT_MODIFIED
-    else:
-        logger.error(f'Device {device} not found')
-        return jsonify({'message': 'Device not found'}), HTTPStatus.NOT_FOUND
+    devices = store()
+    body, status = devices.set_online(device)
+    devices.commit()
+    return operation_response(body, status)
 
 
 @devices_bp.route('/delete/', defaults={'device': None}, methods=['DELETE'])
@@ -161,12 +413,89 @@ def delete_device(device):
         logger.error(f'Invalid request')
         return jsonify({"message": "Device name missing"}), HTTPStatus.BAD_REQUEST
 
-    device = Device.query.filter_by(name=device).first()
-    if device:
-        db.session.delete(device)
-        db.session.commit()
-        logger.info(f'Device {device} deleted')
-        return '', HTTPStatus.NO_CONTENT
-    else:
-        logger.error(f'Device {device} not found')
-        return jsonify({'message': 'Device not found'}), HTTPStatus.NOT_FOUND
+    devices = store()
+    body, status = devices.delete(device)
+    devices.commit()
+    return operation_response(body, status)
+
+
+@devices_bp.route('/batch', methods=['POST'])
+def batch_devices():
+    logger.debug('Running batch of device operations')
+    is_valid, error_response, status_code = validate_request(request, ['operations'])
+    if not is_valid:
+        logger.error(f'Invalid request')
+        return error_response, status_code
+
+    batch = request.json['operations']
+    mode = request.json.get('mode', BATCH_ATOMIC)
+    if mode not in [BATCH_ATOMIC, BATCH_BEST_EFFORT]:
+        logger.error(f'Invalid batch mode {mode}')
+        return jsonify({'message': f'Invalid mode, expected {BATCH_ATOMIC} or {BATCH_BEST_EFFORT}'}), \
+            HTTPStatus.BAD_REQUEST
+    error_message = validate_batch(batch)
+    if error_message:
+        logger.error(f'Invalid batch: {error_message}')
+        return jsonify({'message': error_message}), HTTPStatus.BAD_REQUEST
+
+    # Check which devices of the batch exist with one query, so the missing ones and the duplicates are
+    # answered without touching the table. The set is kept up to date by the adds and deletes of the batch.
+    names = {item['device'] for item in batch}
+    devices = store()
+    existing = devices.existing_names(names)
+
+    results = []
+    failed = False
+    for item in batch:
+        action, name = item['action'], item['device']
+        operation_name, required_fields, optional_fields = operations.BATCH_OPERATIONS[action]
+        fields = [item[field] for field in required_fields] + [item.get(field) for field in optional_fields]
+        if action == events.ADD:
+            if name in existing:
+                body, status = devices.already_exists(name)
+            else:
+                body, status = devices.add(name, *fields, check_existing=False)
+                existing.add(name)
+        elif name not in existing:
+            body, status = devices.not_found(name)
+        else:
+            body, status = getattr(devices, operation_name)(name, *fields)
+            if action == events.DELETE:
+                existing.discard(name)
+
+        result = {'action': action, 'device': name, 'status': int(status)}
+        result.update(body or {})
+        results.append(result)
+        if operations.is_failure(status):
+            failed = True
+            if mode == BATCH_ATOMIC:
+                break
+
+    if failed and mode == BATCH_ATOMIC:
+        devices.rollback()
+        logger.info(f'Batch of {len(batch)} operations rolled back')
+        return jsonify({'message': 'Batch rolled back', 'committed': False, 'results': results}), \
+            HTTPStatus.CONFLICT
+
+    devices.commit()
+    logger.info(f'Batch of {len(batch)} operations committed')
+    return jsonify({'message': 'Batch committed', 'committed': True, 'results': results}), HTTPStatus.OK
+
+
+def validate_batch(batch):
+    if not isinstance(batch, list):
+        return 'Operations must be a list'
+    if len(batch) > BATCH_MAX_SIZE:
+        return f'Too many operations, at most {BATCH_MAX_SIZE} are allowed'
+    for index, item in enumerate(batch):
+        if not isinstance(item, dict) or item.get('action') not in operations.BATCH_OPERATIONS:
+            return f'Operation {index}: invalid action'
+        _, required_fields, optional_fields = operations.BATCH_OPERATIONS[item['action']]
+        missing_fields = [field for field in ['device'] + required_fields if not item.get(field)]
+        if missing_fields:
+            return f"Operation {index}: missing or empty parameters: {', '.join(missing_fields)}"
+        invalid_fields = [field for field in ['device'] + required_fields + optional_fields
+                          if item.get(field) is not None and not isinstance(item[field], str)]
+        if invalid_fields:
+            return f"Operation {index}: parameters must be strings: {', '.join(invalid_fields)}"
+    return None
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime, timezone
+from sqlalchemy import delete, func, select
+
+from devmateback.models import db, Device, DeviceEvent
+from devmateback.revision import bump_revision, get_revision
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Actions reported in the events
+ADD = 'add'
+RESERVE = 'reserve'
+RELEASE = 'release'
+OFFLINE = 'offline'
+ONLINE = 'online'
+DELETE = 'delete'
+RENEW = 'renew'
+EXPIRE = 'expire'
+# Sent instead of the events when the client can't be resumed and has to re-read the whole list
+RESET = 'reset'
+
+# How many events to keep in the database, and how often to drop the older ones
+EVENT_RETENTION = 10000
+PRUNE_EVERY = 100
+
+# Stream settings, can be overridden in the app config
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_HEARTBEAT_INTERVAL = 15.0
+RECONNECT_DELAY_MS = 3000
+# Longest time a /devices/changes request may be held, can be overridden in the app config
+DEFAULT_MAX_WAIT = 60.0
+
+# A /devices/events stream holds a thread of the worker for as long as it's open, so a WSGI worker takes only
+# EVENTS_MAX_STREAMS of them and answers the rest with 503, to keep threads for the other requests. The Web UI
+# then polls /devices/changes, which takes a thread only for the read, and opens the stream again after
+# Retry-After. The ASGI app (devmateback/asgi.py) serves the streams without threads, with no limit: run it for
+# hundreds of open dashboards.
+STREAMS_EXTENSION = 'devmate_event_streams'
+DEFAULT_MAX_STREAMS = 8
+STREAM_RETRY_AFTER = 30
+
+
+def record_event(action, device_name, data):
+    # Must be called in the same transaction as the change of the device, before the commit
+    revision = bump_revision()
+    db.session.add(DeviceEvent(revision=revision, action=action, device=device_name, data=json.dumps(data),
+                               time=datetime.now(timezone.utc).replace(tzinfo=None)))
+    if revision % PRUNE_EVERY == 0:
+        db.session.execute(delete(DeviceEvent).where(DeviceEvent.revision <= revision - EVENT_RETENTION))
+    logger.debug(f'Event {action} for {device_name} recorded with revision {revision}')
+    return revision
+
+
+def get_events_since(revision, limit=1000):
+    return db.session.execute(
+        select(DeviceEvent).where(DeviceEvent.revision > revision).order_by(DeviceEvent.revision).limit(limit)
+    ).scalars().all()
+
+
+def get_oldest_event_revision():
+    return db.session.execute(select(func.min(DeviceEvent.revision))).scalar()
+
+
+def is_resumable(revision, current_revision):
+    # The client can be resumed only if no events after its revision have been pruned yet
+    if revision > current_revision:
+        return False
+    if revision == current_revision:
+        return True
+    oldest = get_oldest_event_revision()
+    return oldest is not None and oldest <= revision + 1
+
+
+def get_changes_since(revision):
+    # Returns the current rows of the devices changed after the revision, and the names of the deleted ones
+    changed = select(DeviceEvent.device).where(DeviceEvent.revision > revision).distinct()
+    names = set(db.session.execute(changed).scalars())
+    if not names:
+        return [], []
+    devices = Device.query.filter(Device.name.in_(changed)).order_by(Device.id).all()
+    deleted = sorted(names - {device.name for device in devices})
+    return devices, deleted
+
+
+def wait_for_revision(revision, timeout, poll_interval=DEFAULT_POLL_INTERVAL):
+    # Blocks until the fleet is changed after the revision or the timeout passes, returns the current revision
+    deadline = time.monotonic() + timeout
+    current_revision = get_revision()
+    while current_revision <= revision and time.monotonic() < deadline:
+        # Don't keep the connection and the read transaction while sleeping
+        db.session.remove()
+        time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+        current_revision = get_revision()
+    return current_revision
+
+
+def format_event(revision, action, data):
+    return f"id: {revision}\nevent: {action}\ndata: {data}\n\n"
+
+
+def event_stream(last_revision, poll_interval=DEFAULT_POLL_INTERVAL,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+    # The events are read from the database, so the stream sees the changes made by any worker.
+    # Only the revision row is read while nothing changes.
+    yield f"retry: {RECONNECT_DELAY_MS}\n\n"
+
+    current_revision = get_revision()
+    if last_revision is None or not is_resumable(last_revision, current_revision):
+        logger.debug(f'Cannot resume the stream from {last_revision}, resetting to {current_revision}')
+        last_revision = current_revision
+        yield format_event(current_revision, RESET, json.dumps({'revision': current_revision}))
+    last_sent = time.monotonic()
+
+    while True:
+        if get_revision() > last_revision:
+            for event in get_events_since(last_revision):
+                last_revision = event.revision
+                yield format_event(event.revision, event.action, event.data)
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= heartbeat_interval:
+            yield ": heartbeat\n\n"
+            last_sent = time.monotonic()
+        # Don't keep the connection and the read transaction while sleeping
+        db.session.remove()
+        time.sleep(poll_interval)
+
+
+class RequestSlots(object):
+    # Counts the requests of a kind held open by the process
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Returns False if all the slots are taken
+        with self.lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.used -= 1
+
+
+def init_stream_slots(app_to_setup):
+    try:
+        max_streams = int(os.environ.get('EVENTS_MAX_STREAMS', DEFAULT_MAX_STREAMS))
+    except ValueError as error:
+        logger.error(f'Invalid EVENTS_MAX_STREAMS: {error}')
+        return None
+    app_to_setup.extensions[STREAMS_EXTENSION] = RequestSlots(max_streams)
+    return True
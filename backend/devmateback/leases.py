@@ -0,0 +1,155 @@
+import heapq
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from devmateback import operations, state
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Reservation leases and their expiry.
+#
+# Each worker keeps a min-heap of (deadline, device name) and its thread sleeps until the earliest deadline, so
+# nothing is scanned while no lease ends. The leases the worker grants are pushed right away, and the ones granted
+# by the other workers are picked up from the lease index on start and on every resync. A heap entry is only a
+# hint: the release is conditional on the lease in the database having ended, so a lease renewed meanwhile
+# (maybe by another worker) is just pushed again with its new deadline, and a lease expired by another worker
+# is skipped. All the leases due at a wake-up are expired in one transaction, each one published as an event.
+
+EXTENSION = 'devmate_leases'
+# Longest lease, in seconds
+MAX_LEASE = 7 * 24 * 3600
+# How often the leases of the other workers are re-read from the database, can be overridden with
+# LEASE_RESYNC_INTERVAL
+DEFAULT_RESYNC_INTERVAL = 300.0
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_lease(value):
+    # Returns the deadline of a lease of the given seconds (None if there is no lease) and None, or None and
+    # the error message
+    if value is None:
+        return None, None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 < value <= MAX_LEASE:
+        return None, f'Invalid lease, expected a number of seconds up to {MAX_LEASE}'
+    return utc_now() + timedelta(seconds=value), None
+
+
+class LeaseScheduler(object):
+
+    def __init__(self, app, resync_interval=DEFAULT_RESYNC_INTERVAL):
+        self.app = app
+        self.resync_interval = resync_interval
+        self.heap = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.stopped = False
+
+    def store(self):
+        return self.app.extensions.get(state.EXTENSION, operations)
+
+    def ensure_started(self):
+        # The thread is started in the worker itself, threads don't survive a fork
+        if self.pid == os.getpid():
+            return
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.heap = []
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, name='devmate-lease-scheduler', daemon=True)
+            self.thread.start()
+        logger.debug('Lease scheduler started')
+
+    def schedule(self, name, deadline):
+        with self.condition:
+            heapq.heappush(self.heap, (deadline, name))
+            # Wake up the thread only if it sleeps past the new deadline
+            if self.heap[0] == (deadline, name):
+                self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        next_resync = time.monotonic()
+        while True:
+            if time.monotonic() >= next_resync:
+                try:
+                    self.resync()
+                except Exception:
+                    logger.exception('Failed to read the leases')
+                next_resync = time.monotonic() + self.resync_interval
+
+            with self.condition:
+                if self.stopped:
+                    return
+                timeout = next_resync - time.monotonic()
+                if self.heap:
+                    timeout = min(timeout, (self.heap[0][0] - utc_now()).total_seconds())
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+
+            try:
+                self.expire_due()
+            except Exception:
+                # The leases are still in the database, the next resync schedules them again
+                logger.exception('Failed to expire the leases')
+
+    def resync(self):
+        with self.app.app_context():
+            leases = [(deadline, name) for name, deadline in self.store().get_leases()]
+        with self.condition:
+            self.heap = list(set(self.heap).union(leases))
+            heapq.heapify(self.heap)
+            self.condition.notify()
+        logger.debug(f'{len(leases)} leases scheduled')
+
+    def pop_due(self, now):
+        names = set()
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                names.add(heapq.heappop(self.heap)[1])
+        return sorted(names)
+
+    def expire_due(self, now=None):
+        # Expires the leases ended by now, returns the names of the released devices
+        now = now or utc_now()
+        names = self.pop_due(now)
+        if not names:
+            return []
+        with self.app.app_context():
+            devices = self.store()
+            try:
+                expired, renewed = devices.expire_leases(names, now)
+                devices.commit()
+            except Exception:
+                devices.rollback()
+                raise
+        for name, deadline in renewed.items():
+            self.schedule(name, deadline)
+        return expired
+
+
+def init_lease_scheduler(app_to_setup):
+    try:
+        resync_interval = float(os.environ.get('LEASE_RESYNC_INTERVAL', DEFAULT_RESYNC_INTERVAL))
+    except ValueError as error:
+        logger.error(f'Invalid lease resync interval: {error}')
+        return None
+    app_to_setup.extensions[EXTENSION] = LeaseScheduler(app_to_setup, resync_interval)
+    return True
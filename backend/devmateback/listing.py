@@ -0,0 +1,232 @@
+import base64
+import binascii
+import json
+import logging
+
+from flask import current_app, stream_with_context
+from sqlalchemy import DateTime, select, tuple_
+
+from devmateback.models import db, Device
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# The list is read as plain rows instead of the ORM objects. The projection is built once: the columns of
+# Device.as_dict in the same order, and the positions of the datetime ones, which are sent as ISO strings.
+# The id goes first, it's needed for the pagination only.
+LIST_COLUMNS = [column for column in Device.__table__.columns if column.name != 'id']
+LIST_COLUMN_NAMES = tuple(column.name for column in LIST_COLUMNS)
+LIST_DATETIME_INDEXES = tuple(index for index, column in enumerate(LIST_COLUMNS)
+                              if isinstance(column.type, DateTime))
+LIST_SELECT = select(Device.__table__.c.id, *LIST_COLUMNS)
+
+# Filtering, sorting and keyset pagination of /devices/list.
+# Only the columns that can't be NULL are sortable, so a page always continues right after the last row of
+# the previous one. The device id breaks the ties.
+SORT_COLUMNS = {
+    'name': Device.name,
+    'model': Device.model,
+    'status': Device.status,
+}
+DEFAULT_SORT = 'id'
+MAX_LIMIT = 1000
+# Formats of the list. NDJSON is always streamed, one device per line.
+FORMAT_JSON = 'json'
+FORMAT_NDJSON = 'ndjson'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Rows read from the database at once while streaming, can be overridden in the app config
+DEFAULT_STREAM_CHUNK_SIZE = 1000
+# Greater than any character, so name < prefix + PREFIX_END matches all the names starting with the prefix
+PREFIX_END = chr(0x10FFFF)
+
+
+class ListParams(object):
+    def __init__(self):
+        self.statuses = None
+        self.model = None
+        self.user = None
+        self.prefix = None
+        self.sort = DEFAULT_SORT
+        self.descending = False
+        self.limit = None
+        self.after = None
+        self.format = FORMAT_JSON
+        self.stream = False
+
+    @property
+    def sort_column(self):
+        return SORT_COLUMNS.get(self.sort)
+
+
+def encode_cursor(params, device_row):
+    sort_value = getattr(device_row, params.sort) if params.sort_column is not None else None
+    cursor = json.dumps([params.sort, params.descending, sort_value, device_row.id])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        sort, descending, sort_value, device_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    # The values go to the keyset query, a tampered cursor must not get there. The sortable columns are strings.
+    if sort != DEFAULT_SORT and sort not in SORT_COLUMNS:
+        return None
+    if not isinstance(descending, bool) or not isinstance(device_id, int) or isinstance(device_id, bool):
+        return None
+    if (sort_value is None) != (sort == DEFAULT_SORT) or not isinstance(sort_value, (str, type(None))):
+        return None
+    return sort, descending, sort_value, device_id
+
+
+def parse_list_args(args):
+    # Returns the parameters and None, or None and the error message
+    params = ListParams()
+
+    if args.get('status'):
+        params.statuses = args['status'].split(',')
+        invalid_statuses = [status for status in params.statuses if status not in Device.STATUS_CHOICES]
+        if invalid_statuses:
+            return None, f"Invalid status: {', '.join(invalid_statuses)}"
+    params.model = args.get('model') or None
+    params.user = args.get('user') or None
+    params.prefix = args.get('prefix') or None
+
+    sort = args.get('sort')
+    if sort:
+        params.descending = sort.startswith('-')
+        params.sort = sort.lstrip('-')
+        if params.sort not in SORT_COLUMNS and params.sort != DEFAULT_SORT:
+            return None, f"Invalid sort, expected one of: {', '.join([DEFAULT_SORT] + list(SORT_COLUMNS))}"
+
+    if args.get('limit'):
+        try:
+            params.limit = int(args['limit'])
+        except ValueError:
+            params.limit = 0
+        if not 0 < params.limit <= MAX_LIMIT:
+            return None, f"Invalid limit, expected 1 to {MAX_LIMIT}"
+
+    if args.get('cursor'):
+        cursor = decode_cursor(args['cursor'])
+        if cursor is None or cursor[0] != params.sort or cursor[1] != params.descending:
+            return None, "Invalid cursor"
+        params.after = cursor[2:]
+
+    params.format = args.get('format', FORMAT_JSON)
+    if params.format not in [FORMAT_JSON, FORMAT_NDJSON]:
+        return None, f"Invalid format, expected {FORMAT_JSON} or {FORMAT_NDJSON}"
+    params.stream = params.format == FORMAT_NDJSON or args.get('stream', '').lower() in ['1', 'true', 'yes']
+    if params.stream and (params.limit or params.after):
+        return None, "The streamed list can't be paginated"
+
+    return params, None
+
+
+def apply_list_params(query, params):
+    # Works both for the ORM queries and the Core selects
+    if params.statuses:
+        query = query.where(Device.status.in_(params.statuses))
+    if params.model:
+        query = query.where(Device.model == params.model)
+    if params.user:
+        query = query.where(Device.user == params.user)
+    if params.prefix:
+        # A range instead of LIKE, so the unique index of the name is used
+        query = query.where(Device.name >= params.prefix, Device.name < params.prefix + PREFIX_END)
+
+    sort_column = params.sort_column
+    if sort_column is not None:
+        order_columns = [sort_column, Device.id]
+        after = params.after
+    else:
+        order_columns = [Device.id]
+        after = params.after[1:] if params.after else None
+    if after:
+        if params.descending:
+            query = query.where(tuple_(*order_columns) < tuple_(*after))
+        else:
+            query = query.where(tuple_(*order_columns) > tuple_(*after))
+    query = query.order_by(*[column.desc() if params.descending else column for column in order_columns])
+
+    if params.limit:
+        # One more row tells if there is a next page
+        query = query.limit(params.limit + 1)
+    return query
+
+
+def paginate(rows, params):
+    # Returns the rows of the page and the cursor of the next one, if there is one
+    if not params.limit or len(rows) <= params.limit:
+        return rows, None
+    rows = rows[:params.limit]
+    return rows, encode_cursor(params, rows[-1])
+
+
+def serialize_rows(rows):
+    # The same dicts as Device.as_dict gives, made from the rows of LIST_SELECT
+    names = LIST_COLUMN_NAMES
+    datetime_indexes = LIST_DATETIME_INDEXES
+    devices = []
+    for row in rows:
+        values = list(row[1:])
+        for index in datetime_indexes:
+            if values[index] is not None:
+                values[index] = values[index].isoformat()
+        devices.append(dict(zip(names, values)))
+    return devices
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def json_response(data):
+    return current_app.response_class(dumps(data), mimetype='application/json')
+
+
+def stream_rows(statement, chunk_size):
+    # Returns a generator of the serialized chunks of rows, or None if there are no rows at all.
+    # The first chunk is read right away, so an empty list can still be answered with 204.
+    chunks = db.session.execute(statement.execution_options(yield_per=chunk_size)).partitions()
+    first_chunk = next(chunks, None)
+    if not first_chunk:
+        return None
+
+    def generate():
+        yield serialize_rows(first_chunk)
+        for chunk in chunks:
+            yield serialize_rows(chunk)
+    return generate()
+
+
+def generate_json(chunks):
+    # The same document as the regular list, written chunk by chunk
+    yield b'{"devices":['
+    separator = b''
+    for devices in chunks:
+        yield separator + dumps(devices)[1:-1]
+        separator = b','
+    yield b']}'
+
+
+def generate_ndjson(chunks):
+    for devices in chunks:
+        yield b''.join(dumps(device) + b'\n' for device in devices)
+
+
+def streamed_response(params, chunks):
+    if params.format == FORMAT_NDJSON:
+        response = current_app.response_class(stream_with_context(generate_ndjson(chunks)), mimetype=NDJSON_MIMETYPE)
+    else:
+        response = current_app.response_class(stream_with_context(generate_json(chunks)),
+                                              mimetype='application/json')
+    # Ask the proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,213 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+import uuid
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Logging of the app and of its requests.
+#
+# The request threads only put the records in a bounded queue, and a listener thread formats and writes them, so
+# no file I/O (or rotation) happens on the request path. When the writer can't keep up, the records are dropped
+# and counted instead of blocking the requests. Every request gets an id, taken from X-Request-ID if the client
+# sends one and returned in the same header, and it's added to all the records logged while serving it.
+# A forked process (a gunicorn worker of the preloaded app) gets a queue and a listener of its own, the ones of the
+# parent are left alone: a lock of the queue may have been held by a thread of the parent at the fork, and the
+# records in it are written by the parent.
+#
+# Settings, from the environment:
+#   LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT - the rotated log file
+#   LOG_LEVEL - level of the devmate loggers
+#   LOG_FORMAT - json (one object per line) or text
+#   LOG_ASYNC - 0 to write from the request threads, as before
+#   LOG_QUEUE_SIZE - records waiting for the writer, the newer ones are dropped when it's full
+#   LOG_SAMPLE_RATE - share of the successful requests logged, the failed ones are always logged
+#   LOG_REQUEST_BODY - 1 to log the JSON bodies of the requests, off by default as they can be large
+# The slow statements go through a pipeline of their own, to their own file, see devmateback/slowlog.py.
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+DEFAULT_SETTINGS = {
+    'LOG_FILE': 'devmate.log',
+    'LOG_MAX_BYTES': 50 * 1024 * 1024,
+    'LOG_BACKUP_COUNT': 3,
+    'LOG_LEVEL': 'DEBUG',
+    'LOG_FORMAT': 'json',
+    'LOG_ASYNC': True,
+    'LOG_QUEUE_SIZE': 10000,
+    'LOG_SAMPLE_RATE': 1.0,
+    'LOG_REQUEST_BODY': False,
+}
+TEXT_FORMAT = '[%(asctime)s.%(msecs)03d] [%(name)s] [%(levelname)s] :  %(message)s'
+TEXT_DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+# The attributes every record has, the others are the extra fields of the call
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def load_settings():
+    # Returns the settings, or None if some of them are invalid
+    settings = dict(DEFAULT_SETTINGS)
+    for key, default in DEFAULT_SETTINGS.items():
+        value = os.environ.get(key)
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            settings[key] = value.lower() in ['1', 'true', 'yes']
+            continue
+        try:
+            settings[key] = type(default)(value)
+        except ValueError:
+            print(f"Invalid {key}: {value}")
+            return None
+    settings['LOG_LEVEL'] = settings['LOG_LEVEL'].upper()
+    if not isinstance(logging.getLevelName(settings['LOG_LEVEL']), int):
+        print(f"Invalid LOG_LEVEL: {settings['LOG_LEVEL']}")
+        return None
+    if settings['LOG_FORMAT'] not in ['json', 'text']:
+        print(f"Invalid LOG_FORMAT: {settings['LOG_FORMAT']}, expected json or text")
+        return None
+    return settings
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    # Adds the id of the request being served to the records, runs in the thread which logs
+
+    def filter(self, record):
+        if has_request_context() and 'request_id' in g and not hasattr(record, 'request_id'):
+            record.request_id = g.request_id
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+
+    def __init__(self, records_queue):
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only what the writer needs, in a form that can't change after the call: the message with its
+        # arguments and the traceback as text. The extra fields are kept for the JSON lines.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+    # Writes the records of the logger (and of its children) to the file of the settings
+
+    def __init__(self, settings, logger_name='devmate'):
+        self.settings = settings
+        self.file_handler = RotatingFileHandler(settings['LOG_FILE'], maxBytes=settings['LOG_MAX_BYTES'],
+                                                backupCount=settings['LOG_BACKUP_COUNT'])
+        if settings['LOG_FORMAT'] == 'json':
+            self.file_handler.setFormatter(JsonFormatter())
+        else:
+            self.file_handler.setFormatter(logging.Formatter(TEXT_FORMAT, datefmt=TEXT_DATE_FORMAT))
+
+        self.listener = None
+        self.stopped = False
+        if settings['LOG_ASYNC']:
+            self.handler = NonBlockingQueueHandler(None)
+            self.start_listener()
+            # Threads don't survive a fork, the worker needs its own writer
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self.restart_after_fork)
+        else:
+            self.handler = self.file_handler
+        self.handler.addFilter(RequestIdFilter())
+
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(settings['LOG_LEVEL'])
+        self.logger.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def start_listener(self):
+        self.handler.queue = queue.Queue(self.settings['LOG_QUEUE_SIZE'])
+        self.listener = QueueListener(self.handler.queue, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+
+    def restart_after_fork(self):
+        # Nothing of the parent's queue and listener is used, see the top of the module
+        if not self.stopped:
+            self.handler.dropped = 0
+            self.start_listener()
+
+    def stop(self):
+        # Writes what is still in the queue
+        self.stopped = True
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+        self.logger.removeHandler(self.handler)
+        self.file_handler.close()
+
+    @property
+    def dropped(self):
+        return getattr(self.handler, 'dropped', 0)
+
+
+def init_request_logging(app_to_setup, settings):
+    request_logger = logging.getLogger('devmate.request')
+    sample_rate = settings['LOG_SAMPLE_RATE']
+    log_body = settings['LOG_REQUEST_BODY']
+
+    @app_to_setup.before_request
+    def start_request():
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app_to_setup.after_request
+    def log_request(response):
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        # Only the successful requests are sampled
+        if response.status_code < 400 and sample_rate < 1 and random.random() >= sample_rate:
+            return response
+        if not request_logger.isEnabledFor(logging.INFO):
+            return response
+
+        fields = {'method': request.method,
+                  'path': request.path,
+                  'query': request.query_string.decode(errors='replace'),
+                  'status': response.status_code,
+                  # Until the handler returns, the streamed responses are sent after that
+                  'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 3),
+                  'remote_addr': request.remote_addr}
+        if log_body:
+            fields['body'] = request.get_json(silent=True)
+        request_logger.info(f'{request.method} {request.path} {response.status_code}', extra=fields)
+        return response
@@ -0,0 +1,275 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from devmateback import operations, slowlog, state
+from devmateback.models import Device
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Prometheus metrics of the requests, the database queries and the fleet, served in the text format by /metrics.
+#
+# Recording a request is a few dict lookups and a bisect under one lock, the exposition happens only on a scrape.
+# The histograms keep the count of each bucket (not the cumulative one) and their sum, so the histograms of
+# several workers add up bucket by bucket into the histogram of all the requests, which isn't true for
+# percentiles. With several gunicorn workers, set METRICS_DIR to a directory shared by them: each worker writes
+# its counters there every METRICS_FLUSH_INTERVAL seconds, and the one serving the scrape adds them up. The files
+# are named by the gunicorn master as well, the files of the previous runs are ignored and removed. The files of
+# the exited workers of the current run are kept, so that the counters never go back.
+#
+# The durations are up to the end of the handler, the streamed responses are sent after that.
+
+EXTENSION = 'devmate_metrics'
+# Defaults, can be overridden with METRICS_DIR and METRICS_FLUSH_INTERVAL
+DEFAULT_FLUSH_INTERVAL = 5.0
+# Upper bounds of the buckets, in seconds for the durations
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+UNMATCHED_ROUTE = 'unmatched'
+
+# Name -> type, help and the bucket bounds of the histograms
+METRICS = {
+    'devmate_http_requests_total': ('counter', 'Requests served, by route, method and status.', None),
+    'devmate_http_request_duration_seconds': ('histogram', 'Time to handle a request, by route and method.',
+                                              DURATION_BUCKETS),
+    'devmate_db_queries_per_request': ('histogram', 'Database queries made by a request, by route and method.',
+                                       QUERY_COUNT_BUCKETS),
+    'devmate_db_query_duration_seconds_per_request': ('histogram',
+                                                      'Time spent in the database by a request, by route and '
+                                                      'method.', DURATION_BUCKETS),
+    'devmate_db_queries_total': ('counter', 'Database queries, including the ones made outside of the requests.',
+                                 None),
+    'devmate_db_query_duration_seconds_total': ('counter', 'Time spent in the database queries.', None),
+    'devmate_slow_queries_total': ('counter', 'Statements over the slow query threshold, by fingerprint.', None),
+    'devmate_slow_query_duration_seconds_total': ('counter', 'Time spent in the slow statements, by fingerprint.',
+                                                  None),
+}
+GAUGES = {
+    'devmate_devices': 'Devices by status.',
+    'devmate_reservations': 'Reserved devices by model.',
+}
+
+
+class Metrics(object):
+
+    def __init__(self, metrics_dir=None, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # (name, labels) -> value for the counters, and [bucket counts..., sum] for the histograms
+        self.values = {}
+        self.thread = None
+        self.pid = None
+
+    def add(self, name, labels, value=1):
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def observe_request(self, route, method, status, duration, queries, query_time):
+        labels = (('route', route), ('method', method))
+        with self.lock:
+            self.observe(('devmate_http_request_duration_seconds', labels), DURATION_BUCKETS, duration)
+            self.observe(('devmate_db_queries_per_request', labels), QUERY_COUNT_BUCKETS, queries)
+            self.observe(('devmate_db_query_duration_seconds_per_request', labels), DURATION_BUCKETS, query_time)
+            key = ('devmate_http_requests_total', labels + (('status', str(status)),))
+            self.values[key] = self.values.get(key, 0) + 1
+
+    def observe(self, key, buckets, value):
+        # Must be called with the lock
+        histogram = self.values.get(key)
+        if histogram is None:
+            histogram = self.values[key] = [0] * (len(buckets) + 2)
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, labels, value if isinstance(value, (int, float)) else list(value)]
+                    for (name, labels), value in self.values.items()]
+
+    # The files of the workers
+
+    def file_prefix(self):
+        # Under gunicorn, the parent is the master, so a restart starts with new files
+        return os.path.join(self.metrics_dir, f'worker-{os.getppid()}-')
+
+    def ensure_started(self):
+        # The thread is started in the worker itself, threads don't survive a fork
+        if self.metrics_dir is None or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        for path in glob.glob(os.path.join(self.metrics_dir, 'worker-*.json')):
+            if not os.path.basename(path).startswith(os.path.basename(self.file_prefix())):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.thread = threading.Thread(target=self.flush_loop, name='devmate-metrics', daemon=True)
+        self.thread.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Failed to write the metrics')
+
+    def flush(self):
+        path = f'{self.file_prefix()}{os.getpid()}.json'
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self):
+        # The values of all the workers, the files are read after writing the own one
+        if self.metrics_dir is None:
+            return merge([self.snapshot()])
+        self.flush()
+        snapshots = []
+        for path in glob.glob(f'{self.file_prefix()}*.json'):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or being replaced, it'll be there on the next scrape
+                logger.warning(f'Failed to read the metrics file {path}')
+        return merge(snapshots)
+
+
+def merge(snapshots):
+    values = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in values:
+                values[key] = value if isinstance(value, (int, float)) else list(value)
+            elif isinstance(value, (int, float)):
+                values[key] += value
+            else:
+                values[key] = [total + count for total, count in zip(values[key], value)]
+    return values
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def exposition(values, gauges):
+    lines = []
+    for name, (metric_type, description, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (value_name, labels), value in sorted(values.items()):
+            if value_name != name:
+                continue
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(value[-1])}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    for name, description in GAUGES.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in sorted(gauges.get(name, {}).items()):
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def fleet_gauges():
+    # Read when scraped, from the database or from the state engine
+    devices = {(('status', status),): 0 for status in Device.STATUS_CHOICES}
+    reservations = {}
+    for status, model, count in current_app.extensions.get(state.EXTENSION, operations).fleet_counts():
+        devices[(('status', status),)] = devices.get((('status', status),), 0) + count
+        if status == Device.RESERVED:
+            reservations[(('model', model),)] = count
+    return {'devmate_devices': devices, 'devmate_reservations': reservations}
+
+
+def register_query_events(engine, metrics):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_query_started'].pop()
+        metrics.add('devmate_db_queries_total', ())
+        metrics.add('devmate_db_query_duration_seconds_total', (), elapsed)
+        if has_request_context() and 'metrics_started' in g:
+            g.metrics_queries += 1
+            g.metrics_query_time += elapsed
+
+
+def init_metrics(app_to_setup, engine):
+    try:
+        flush_interval = float(os.environ.get('METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL))
+    except ValueError as error:
+        logger.error(f'Invalid metrics flush interval: {error}')
+        return None
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir is not None:
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+        except OSError as error:
+            logger.error(f'Failed to create the metrics directory: {error}')
+            return None
+
+    metrics = Metrics(metrics_dir, flush_interval)
+    app_to_setup.extensions[EXTENSION] = metrics
+    register_query_events(engine, metrics)
+    slow_log = app_to_setup.extensions.get(slowlog.EXTENSION)
+    if slow_log is not None:
+        slow_log.metrics = metrics
+
+    @app_to_setup.before_request
+    def start_request_metrics():
+        metrics.ensure_started()
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_time = 0.0
+
+    @app_to_setup.after_request
+    def record_request_metrics(response):
+        if 'metrics_started' in g:
+            route = request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+            metrics.observe_request(route, request.method, response.status_code,
+                                    time.perf_counter() - g.metrics_started, g.metrics_queries,
+                                    g.metrics_query_time)
+        return response
+
+    @app_to_setup.route('/metrics', methods=['GET'])
+    def get_metrics():
+        body = exposition(metrics.collect(), fleet_gauges())
+        return Response(body, mimetype='text/plain; version=0.0.4')
+
+    if metrics_dir is not None:
+        logger.debug(f'Metrics of the workers are shared in {metrics_dir}')
+    return True
@@ -15,10 +15,15 @@ class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     model = db.Column(db.String(50), nullable=False)
-    status = db.Column(db.Enum(*STATUS_CHOICES), nullable=False, default=FREE)
-    user = db.Column(db.String(50), nullable=True)
+    status = db.Column(db.Enum(*STATUS_CHOICES), nullable=False, default=FREE, index=True)
+    user = db.Column(db.String(50), nullable=True, index=True)
     reservation_time = db.Column(db.DateTime, nullable=True)
     info = db.Column(db.String(100), nullable=True)
+    # End of the reservation lease, if the reservation has one. The expiry scheduler releases the device then.
+    lease_expires = db.Column(db.DateTime, nullable=True, index=True)
+
+    # Serves both the model filter of the list and picking a free device of a model
+    __table_args__ = (db.Index('ix_device_model_status', 'model', 'status'),)
 
     def as_dict(self):
         result_dict = {}
@@ -38,3 +43,38 @@ class Device(db.Model):
                 result_dict[column_name] = column_value
 
         return result_dict
+
+
+class FleetRevision(db.Model):
+    # Single-row table with the revision of the whole fleet.
+    # It is bumped in the same transaction as every change of the devices, so it can be used as a cheap version tag.
+    ROW_ID = 1
+
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+    # Random tag of the row, see devmateback/revision.py
+    epoch = db.Column(db.String(32), nullable=True)
+
+
+class DeviceEvent(db.Model):
+    # Log of the device changes, one row per fleet revision.
+    # It's what the clients are fed from, so they don't have to re-read the whole fleet.
+    revision = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    action = db.Column(db.String(20), nullable=False)
+    device = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+
+
+class ReservationWaiter(db.Model):
+    # FIFO queue of the reservations waiting for a busy device, or for any device of a model.
+    # A device freed by any worker is handed to the oldest live waiter in the same transaction.
+    id = db.Column(db.Integer, primary_key=True)
+    device = db.Column(db.String(50), nullable=True, index=True)
+    model = db.Column(db.String(50), nullable=True, index=True)
+    username = db.Column(db.String(50), nullable=False)
+    # Lease in seconds of the reservation, counted from the handoff
+    lease = db.Column(db.Float, nullable=True)
+    # The waiter is skipped after this, its request has given up
+    expires = db.Column(db.DateTime, nullable=False)
+    granted_device = db.Column(db.String(50), nullable=True)
@@ -0,0 +1,354 @@
+import logging
+import time
+
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from http import HTTPStatus
+from sqlalchemy import and_, delete as delete_statement, func, or_, select, update
+
+from devmateback.models import db, Device, ReservationWaiter
+from devmateback import cache, events, listing
+from devmateback.revision import get_version
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# The device operations, shared by the single device routes and /devices/batch.
+# Each of them changes the device in the session without committing, and returns the response body
+# (None for an empty one) and the HTTP status. The in-memory state engine (devmateback/state.py) provides the
+# same functions, so the routes work with either of them.
+#
+# The state changes are single conditional UPDATE statements: the status check is a part of the WHERE clause,
+# so two workers can never both win the same device, and the affected row count is the result. The device is
+# read only when the change didn't happen, to tell why.
+
+
+def change_state(name, condition, values):
+    result = db.session.execute(
+        update(Device).where(Device.name == name, condition).values(**values)
+        .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+def get_state(name):
+    return db.session.execute(select(Device.status, Device.user).where(Device.name == name)).first()
+
+
+def state_event(name, values):
+    # The changed columns of the device, as Device.as_dict gives them
+    data = {'name': name}
+    for key, value in values.items():
+        data[key] = value.isoformat() if isinstance(value, datetime) else value
+    return data
+
+
+def not_found(name):
+    logger.error(f'Device {name} not found')
+    return {'message': 'Device not found'}, HTTPStatus.NOT_FOUND
+
+
+def already_exists(name):
+    logger.debug(f'Device {name} already exists')
+    return {'message': 'Device with this name already exists'}, HTTPStatus.CONFLICT
+
+
+def reserve(name, username, lease_expires=None):
+    values = {'status': Device.RESERVED, 'user': username,
+              'reservation_time': datetime.now(timezone.utc).replace(tzinfo=None), 'lease_expires': lease_expires}
+    if not change_state(name, Device.status == Device.FREE, values):
+        state = get_state(name)
+        if not state:
+            return not_found(name)
+        logger.debug(f'Device {name} not available for reservation')
+        return {'message': 'Device not available for reservation', 'reserved_by': state.user}, HTTPStatus.CONFLICT
+
+    events.record_event(events.RESERVE, name, state_event(name, values))
+    logger.info(f'Device {name} reserved by {username}')
+    return reserved_body(lease_expires), HTTPStatus.OK
+
+
+def reserved_body(lease_expires, names=None):
+    body = {'message': 'Device reserved'}
+    if names is not None:
+        body['devices'] = names
+    if lease_expires is not None:
+        body['lease_expires'] = lease_expires.isoformat()
+    return body
+
+
+def reserve_any(model, username, count=1, info=None, lease_expires=None):
+    # Picks and reserves the free devices of the model with one statement, served by the (model, status) index.
+    # Either all the requested devices are reserved, or the caller must roll back.
+    reservation_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    candidates = select(Device.id).where(Device.model == model, Device.status == Device.FREE)
+    if info:
+        candidates = candidates.where(Device.info.contains(info, autoescape=True))
+    candidates = candidates.order_by(Device.id).limit(count)
+    values = {'status': Device.RESERVED, 'user': username, 'reservation_time': reservation_time,
+              'lease_expires': lease_expires}
+    result = db.session.execute(
+        update(Device).where(Device.id.in_(candidates), Device.status == Device.FREE).values(**values)
+        .execution_options(synchronize_session=False))
+    if result.rowcount < count:
+        logger.debug(f'Only {result.rowcount} of {count} devices of model {model} are available')
+        return {'message': 'Not enough devices available for reservation', 'available': result.rowcount}, \
+            HTTPStatus.CONFLICT
+
+    # The write lock is held since the update, so these are exactly the devices it has reserved
+    names = db.session.execute(
+        select(Device.name).where(Device.model == model, Device.user == username,
+                                  Device.reservation_time == reservation_time).order_by(Device.id)).scalars().all()
+    for name in names:
+        events.record_event(events.RESERVE, name, state_event(name, values))
+    logger.info(f"Devices {', '.join(names)} of model {model} reserved by {username}")
+    return reserved_body(lease_expires, names), HTTPStatus.OK
+
+
+def renew(name, username, lease_expires):
+    # Extends the lease of a reservation which hasn't ended yet
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    values = {'lease_expires': lease_expires}
+    condition = and_(Device.status == Device.RESERVED, Device.user == username,
+                     or_(Device.lease_expires.is_(None), Device.lease_expires > now))
+    if not change_state(name, condition, values):
+        state = get_state(name)
+        if not state:
+            return not_found(name)
+        if state.status == Device.RESERVED and state.user == username:
+            logger.debug(f'Lease of device {name} has already expired')
+            return {'message': 'Lease has expired'}, HTTPStatus.CONFLICT
+        logger.debug(f'Device {name} not reserved by {username}')
+        return {'message': 'Device is not reserved by this user', 'reserved_by': state.user}, HTTPStatus.CONFLICT
+
+    events.record_event(events.RENEW, name, state_event(name, values))
+    logger.info(f'Lease of device {name} renewed until {lease_expires}')
+    return {'message': 'Lease renewed', 'lease_expires': lease_expires.isoformat()}, HTTPStatus.OK
+
+
+def expire_leases(names, now):
+    # Releases the devices among the names whose lease has ended, all in the current transaction.
+    # Returns the released names and the new deadlines of the leases which have been renewed meanwhile.
+    leases = db.session.execute(
+        select(Device.name, Device.lease_expires)
+        .where(Device.name.in_(names), Device.status == Device.RESERVED, Device.lease_expires.is_not(None))).all()
+    values = {'status': Device.FREE, 'user': None, 'reservation_time': None, 'lease_expires': None}
+    expired = []
+    renewed = {}
+    for name, lease_expires in leases:
+        if lease_expires > now:
+            renewed[name] = lease_expires
+        elif change_state(name, and_(Device.status == Device.RESERVED, Device.lease_expires <= now), values):
+            events.record_event(events.EXPIRE, name, state_event(name, values))
+            expired.append(name)
+            hand_off(name)
+    if expired:
+        logger.info(f"Leases of devices {', '.join(expired)} expired")
+    return expired, renewed
+
+
+def get_leases():
+    # Served by the lease index, only the leased devices are read
+    return db.session.execute(
+        select(Device.name, Device.lease_expires)
+        .where(Device.lease_expires.is_not(None), Device.status == Device.RESERVED)).all()
+
+
+def release(name):
+    values = {'status': Device.FREE, 'user': None, 'reservation_time': None, 'lease_expires': None}
+    if not change_state(name, Device.status == Device.RESERVED, values):
+        if not get_state(name):
+            return not_found(name)
+        logger.debug(f'Device {name} not reserved')
+        return {'message': 'Device is not reserved'}, HTTPStatus.NOT_MODIFIED
+
+    events.record_event(events.RELEASE, name, state_event(name, values))
+    logger.info(f'Device {name} released')
+    hand_off(name)
+    return {'message': 'Device released'}, HTTPStatus.OK
+
+
+def add(name, model, info=None, check_existing=True):
+    if check_existing and get_state(name):
+        return already_exists(name)
+
+    new_device = Device(name=name, model=model, status=Device.FREE, info=info)
+    db.session.add(new_device)
+    events.record_event(events.ADD, new_device.name, new_device.as_dict())
+    logger.info(f'Device {name} added')
+    hand_off(name)
+    return {'message': 'Device added'}, HTTPStatus.CREATED
+
+
+def set_offline(name):
+    values = {'status': Device.OFFLINE, 'user': None, 'reservation_time': None, 'lease_expires': None}
+    if not change_state(name, Device.status != Device.OFFLINE, values):
+        if not get_state(name):
+            return not_found(name)
+        logger.debug(f'Device {name} already offline')
+        return None, HTTPStatus.NOT_MODIFIED
+
+    events.record_event(events.OFFLINE, name, state_event(name, values))
+    logger.info(f'Device {name} set to offline')
+    return {'message': 'Device set to offline'}, HTTPStatus.OK
+
+
+def set_online(name):
+    # Offline devices have neither user nor reservation time, so only the status changes
+    values = {'status': Device.FREE}
+    if not change_state(name, Device.status == Device.OFFLINE, values):
+        if not get_state(name):
+            return not_found(name)
+        logger.debug(f'Device {name} already available')
+        return None, HTTPStatus.NOT_MODIFIED
+
+    events.record_event(events.ONLINE, name, state_event(name, values))
+    logger.info(f'Device {name} set to available')
+    hand_off(name)
+    return {'message': 'Device set to available'}, HTTPStatus.OK
+
+
+def delete(name):
+    result = db.session.execute(delete_statement(Device).where(Device.name == name)
+                                .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        return not_found(name)
+
+    events.record_event(events.DELETE, name, {'name': name})
+    logger.info(f'Device {name} deleted')
+    return None, HTTPStatus.NO_CONTENT
+
+
+# The wait queues of the reservations. The queue is a table, so a device freed by any worker is handed to a
+# waiter of any worker, in the transaction which has freed it. The waiting request only polls its own row.
+
+# Waiters whose request is gone for longer than this are dropped from the table
+WAITER_GRACE = timedelta(minutes=1)
+
+
+def enqueue(username, lease, timeout, device=None, model=None):
+    # Puts a reservation in the queue of the device, or of the model, and returns the id of the waiter.
+    # The device may have been freed since the reservation failed, so a free one is handed off right away,
+    # to the oldest waiter.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    db.session.execute(delete_statement(ReservationWaiter).where(ReservationWaiter.expires < now - WAITER_GRACE)
+                       .execution_options(synchronize_session=False))
+    waiter = ReservationWaiter(device=device, model=model, username=username, lease=lease,
+                               expires=now + timedelta(seconds=timeout))
+    db.session.add(waiter)
+    db.session.flush()
+    logger.debug(f'{username} waits for {device or "a device of model " + model}')
+
+    if device is None:
+        device = db.session.execute(select(Device.name).where(Device.model == model, Device.status == Device.FREE)
+                                    .order_by(Device.id).limit(1)).scalar()
+    if device is not None:
+        hand_off(device)
+    return waiter.id
+
+
+def hand_off(name):
+    # Reserves the device, if it's free, for the oldest live waiter of the device or of its model.
+    # Must be called in the transaction which has freed the device. Returns the user it's handed to.
+    device = db.session.execute(select(Device.model, Device.status).where(Device.name == name)).first()
+    if device is None or device.status != Device.FREE:
+        return None
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    waiters = select(ReservationWaiter.id, ReservationWaiter.username, ReservationWaiter.lease).where(
+        ReservationWaiter.granted_device.is_(None), ReservationWaiter.expires > now,
+        or_(ReservationWaiter.device == name,
+            and_(ReservationWaiter.device.is_(None), ReservationWaiter.model == device.model))
+    ).order_by(ReservationWaiter.id)
+    for waiter in db.session.execute(waiters).all():
+        # The waiter may have given up meanwhile
+        result = db.session.execute(
+            update(ReservationWaiter).where(ReservationWaiter.id == waiter.id,
+                                            ReservationWaiter.granted_device.is_(None))
+            .values(granted_device=name).execution_options(synchronize_session=False))
+        if result.rowcount == 1:
+            lease_expires = now + timedelta(seconds=waiter.lease) if waiter.lease else None
+            reserve(name, waiter.username, lease_expires)
+            logger.info(f'Device {name} handed off to {waiter.username}')
+            return waiter.username
+    return None
+
+
+def wait_for_grant(waiter_id, timeout, poll_interval):
+    # Blocks until a device is handed to the waiter or the timeout passes, then leaves the queue.
+    # Returns the name of the device and the end of its lease, or None.
+    deadline = time.monotonic() + timeout
+    granted = None
+    while True:
+        granted = db.session.execute(
+            select(ReservationWaiter.granted_device).where(ReservationWaiter.id == waiter_id)).scalar()
+        if granted is not None or time.monotonic() >= deadline:
+            break
+        # Don't keep the connection and the read transaction while sleeping
+        db.session.remove()
+        time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+    if granted is None:
+        # The device may be handed off right now, only an ungranted waiter can leave with nothing
+        result = db.session.execute(
+            delete_statement(ReservationWaiter).where(ReservationWaiter.id == waiter_id,
+                                                      ReservationWaiter.granted_device.is_(None))
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            granted = db.session.execute(
+                select(ReservationWaiter.granted_device).where(ReservationWaiter.id == waiter_id)).scalar()
+    if granted is not None:
+        db.session.execute(delete_statement(ReservationWaiter).where(ReservationWaiter.id == waiter_id)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    if granted is None:
+        return None
+    return granted, db.session.execute(select(Device.lease_expires).where(Device.name == granted)).scalar()
+
+
+def existing_names(names):
+    read_cache = current_app.extensions.get(cache.EXTENSION)
+    if read_cache is not None:
+        return {name for name, row in cache.lookup_devices(read_cache, names).items() if row is not None}
+    return set(db.session.execute(select(Device.name).where(Device.name.in_(names))).scalars())
+
+
+def commit():
+    db.session.commit()
+
+
+def rollback():
+    db.session.rollback()
+
+
+def fleet_counts():
+    # The number of devices by status and model
+    return db.session.execute(
+        select(Device.status, Device.model, func.count()).group_by(Device.status, Device.model)).all()
+
+
+def get_list_version():
+    return get_version()
+
+
+def list_rows(params):
+    return db.session.execute(listing.apply_list_params(listing.LIST_SELECT, params)).all()
+
+
+def stream_list(params, chunk_size):
+    return listing.stream_rows(listing.apply_list_params(listing.LIST_SELECT, params), chunk_size)
+
+
+# Operations available in /devices/batch: the name of the operation and the fields it takes besides the device
+# name. The first fields are required, the rest are optional.
+BATCH_OPERATIONS = {
+    events.RESERVE: ('reserve', ['username'], []),
+    events.RELEASE: ('release', [], []),
+    events.ADD: ('add', ['model'], ['info']),
+    events.OFFLINE: ('set_offline', [], []),
+    events.ONLINE: ('set_online', [], []),
+    events.DELETE: ('delete', [], []),
+}
+
+
+def is_failure(status):
+    # Not modified is fine: the device is already in the requested state
+    return status >= HTTPStatus.BAD_REQUEST
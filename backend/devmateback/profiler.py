@@ -0,0 +1,206 @@
+import collections
+import cProfile
+import hmac
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Profiling of single requests, to see why some call is slow in production.
+#
+# Enabled with PROFILER_TOKEN: a request with the token in the X-Devmate-Profile header runs under the profiler.
+# Only the header is accepted, a query argument would leave the token in the request log and the proxy logs.
+# PROFILER_EVERY_N profiles every Nth request as well, without the token.
+# When neither is set, no hooks are registered and the requests don't pay anything.
+#
+# Two profilers:
+#   sample - a thread samples the stack of the request thread every PROFILER_INTERVAL seconds, the profile is
+#            the collapsed stacks ("frame;frame;frame count" lines), which flamegraph.pl and speedscope read
+#   cprofile - the deterministic profiler, more exact but slower, and only one request at a time can use it,
+#              the profile is the pstats file
+# The profiles are written to PROFILER_DIR, the file name is returned in the X-Devmate-Profile-File header.
+# With profile_output=inline (query) or X-Devmate-Profile-Output: inline, the profile is returned as text instead
+# of the response. Only the handler is profiled, the streamed responses are sent after it.
+
+PROFILE_HEADER = 'X-Devmate-Profile'
+OUTPUT_HEADER = 'X-Devmate-Profile-Output'
+FILE_HEADER = 'X-Devmate-Profile-File'
+MODES = ['sample', 'cprofile']
+# Defaults, can be overridden with PROFILER_MODE, PROFILER_INTERVAL and PROFILER_DIR
+DEFAULT_MODE = 'sample'
+DEFAULT_INTERVAL = 0.001
+PROFILES_DIR = 'profiles'
+# Lines of the inline cprofile output
+INLINE_STATS_LINES = 40
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler(object):
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='devmate-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def output(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class DeterministicProfiler(object):
+    # Only one cProfile can run in the process
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.profile.enable()
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        self.lock.release()
+
+    def output(self):
+        stream = io.StringIO()
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(INLINE_STATS_LINES)
+        return stream.getvalue()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+def load_settings():
+    # Returns the settings, or None if some of them are invalid
+    try:
+        settings = {'token': os.environ.get('PROFILER_TOKEN'),
+                    'every_n': int(os.environ.get('PROFILER_EVERY_N', 0)),
+                    'mode': os.environ.get('PROFILER_MODE', DEFAULT_MODE),
+                    'interval': float(os.environ.get('PROFILER_INTERVAL', DEFAULT_INTERVAL)),
+                    'dir': os.environ.get('PROFILER_DIR')}
+    except ValueError as error:
+        logger.error(f'Invalid profiler setting: {error}')
+        return None
+    if settings['mode'] not in MODES:
+        logger.error(f"Invalid profiler mode {settings['mode']}, expected one of {', '.join(MODES)}")
+        return None
+    return settings
+
+
+def is_requested(token):
+    value = request.headers.get(PROFILE_HEADER)
+    return value is not None and hmac.compare_digest(value.encode(), token.encode())
+
+
+def init_profiler(app_to_setup, db_dir):
+    settings = load_settings()
+    if settings is None:
+        return None
+    token = settings['token']
+    every_n = settings['every_n']
+    if not token and every_n <= 0:
+        return True
+
+    profiles_dir = settings['dir'] or os.path.join(db_dir, PROFILES_DIR)
+    try:
+        os.makedirs(profiles_dir, exist_ok=True)
+    except OSError as error:
+        logger.error(f'Failed to create the profiles directory: {error}')
+        return None
+    request_numbers = itertools.count(1)
+
+    @app_to_setup.before_request
+    def start_profiler():
+        requested = bool(token) and is_requested(token)
+        if not requested and not (every_n > 0 and next(request_numbers) % every_n == 0):
+            return
+        if settings['mode'] == 'sample':
+            profiler = StackSampler(threading.get_ident(), settings['interval'])
+            profiler.start()
+        else:
+            profiler = DeterministicProfiler()
+            if not profiler.start():
+                logger.warning(f'Another request is being profiled, {request.path} is not')
+                return
+        g.profiler = profiler
+        g.profile_inline = requested and (request.args.get('profile_output') == 'inline'
+                                          or request.headers.get(OUTPUT_HEADER) == 'inline')
+        g.profile_started = time.perf_counter()
+
+    def save_profile(profiler):
+        # Returns the name of the file, or None if it couldn't be written
+        elapsed_ms = (time.perf_counter() - g.profile_started) * 1000
+        route = request.path.strip('/').replace('/', '_') or 'root'
+        extension = 'collapsed' if isinstance(profiler, StackSampler) else 'prof'
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{route}-{uuid.uuid4().hex[:8]}.{extension}"
+        try:
+            if isinstance(profiler, StackSampler):
+                with open(os.path.join(profiles_dir, name), 'w') as f:
+                    f.write(profiler.output())
+            else:
+                profiler.dump(os.path.join(profiles_dir, name))
+        except OSError as error:
+            logger.error(f'Failed to write the profile {name}: {error}')
+            return None
+        logger.info(f'Profiled {request.method} {request.path} in {elapsed_ms:.1f} ms: {name}')
+        return name
+
+    @app_to_setup.after_request
+    def stop_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.stop()
+        if g.profile_inline:
+            return Response(profiler.output(), mimetype='text/plain',
+                            headers={'X-Devmate-Profiled-Status': str(response.status_code)})
+        name = save_profile(profiler)
+        if name is not None:
+            response.headers[FILE_HEADER] = name
+        return response
+
+    @app_to_setup.teardown_request
+    def stop_failed_profiler(error):
+        # The after_request functions are skipped when the view raises, the sampler thread and the cProfile lock
+        # must not be left behind. The profile of the failed request goes to a file.
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            save_profile(profiler)
+
+    logger.info(f"Request profiler enabled, {settings['mode']} mode, profiles in {profiles_dir}")
+    return True
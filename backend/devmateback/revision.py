@@ -0,0 +1,63 @@
+import logging
+import secrets
+
+from sqlalchemy import select, update
+
+from devmateback.models import db, FleetRevision
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# The epoch is a random tag of the revision row, set when the row is created. A database which is recreated or
+# restored from a backup starts counting the revisions again, with another epoch, so the ETags and the cached
+# lists of the old one never match it.
+EPOCH_BYTES = 8
+
+
+def new_epoch():
+    return secrets.token_hex(EPOCH_BYTES)
+
+
+def ensure_revision_row():
+    # Create the revision row if the database doesn't have it yet, and give it an epoch if it's older than them
+    row = db.session.get(FleetRevision, FleetRevision.ROW_ID)
+    if row is None:
+        db.session.add(FleetRevision(id=FleetRevision.ROW_ID, revision=0, epoch=new_epoch()))
+        db.session.commit()
+        logger.debug('Fleet revision row created')
+    elif not row.epoch:
+        row.epoch = new_epoch()
+        db.session.commit()
+        logger.debug(f'Fleet revision epoch set to {row.epoch}')
+
+
+def get_revision():
+    revision = db.session.execute(
+        select(FleetRevision.revision).where(FleetRevision.id == FleetRevision.ROW_ID)).scalar()
+    return revision or 0
+
+
+def get_version():
+    # The epoch and the revision, with one primary key read
+    row = db.session.execute(
+        select(FleetRevision.epoch, FleetRevision.revision).where(FleetRevision.id == FleetRevision.ROW_ID)).first()
+    if row is None:
+        return '', 0
+    return row.epoch or '', row.revision or 0
+
+
+def bump_revision():
+    # Must be called in the same transaction as the change of the devices, before the commit.
+    # The increment is done in SQL, so concurrent workers never get the same revision.
+    result = db.session.execute(
+        update(FleetRevision).where(FleetRevision.id == FleetRevision.ROW_ID)
+        .values(revision=FleetRevision.revision + 1))
+    if result.rowcount == 0:
+        db.session.add(FleetRevision(id=FleetRevision.ROW_ID, revision=1, epoch=new_epoch()))
+        db.session.flush()
+    revision = get_revision()
+    logger.debug(f'Fleet revision bumped to {revision}')
+    return revision
+
+
+def revision_etag(epoch, revision):
+    return f"fleet-{epoch}-{revision}"
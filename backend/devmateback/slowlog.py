@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from devmateback import logs
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Log of the slow database statements, to see which lookups and list scans need indexes as the fleet grows.
+#
+# The statements slower than SLOW_QUERY_MS are written to their own log (SLOW_QUERY_LOG, JSON lines) with the
+# types of their parameters (never the values), the route or the background thread which ran them, and the
+# EXPLAIN QUERY PLAN output of SQLite. The statements are grouped by fingerprint, the statement with its literals
+# and IN lists collapsed, so the same lookup for different devices is one entry: the plan is read once per
+# fingerprint, and every record carries the count, total and max time of its fingerprint in the worker so far.
+# The totals by fingerprint are in /metrics as well, added up across the workers.
+#
+# The records are written like the app log, by the writer thread of a queue with LOG_ASYNC (see
+# devmateback/logs.py), to SLOW_QUERY_LOG, next to LOG_FILE by default.
+#
+# SLOW_QUERY_MS=-1 disables the log, SLOW_QUERY_EXPLAIN=0 skips the plans.
+
+EXTENSION = 'devmate_slow_queries'
+# Defaults, can be overridden with SLOW_QUERY_MS, SLOW_QUERY_LOG, SLOW_QUERY_MAX_BYTES and SLOW_QUERY_EXPLAIN,
+# the file is in the directory of LOG_FILE
+DEFAULT_THRESHOLD_MS = 100
+DEFAULT_LOG_FILE = 'devmate-slow-queries.log'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+# The statements which can be explained
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(statement):
+    # The statement without its literals, and with the IN lists of any length as one
+    statement = STRING_LITERAL.sub('?', statement)
+    statement = NUMBER_LITERAL.sub('?', statement)
+    statement = IN_LIST.sub('IN (...)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def parameter_shape(parameters, executemany):
+    if executemany:
+        return {'rows': len(parameters), 'row': parameter_shape(parameters[0], False) if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+def statement_source():
+    if has_request_context():
+        return f'{request.method} {request.url_rule.rule if request.url_rule is not None else request.path}'
+    return f'thread {threading.current_thread().name}'
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, threshold_ms, log_file, max_bytes=DEFAULT_MAX_BYTES, explain=True, log_settings=None):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.lock = threading.Lock()
+        # Fingerprint -> {'statement', 'count', 'total_ms', 'max_ms', 'plan'}
+        self.statements = {}
+        # Set by the metrics, to add up the totals of the workers
+        self.metrics = None
+
+        # Not in the app log
+        self.log = logging.getLogger('devmate.slow_query')
+        self.log.propagate = False
+        settings = dict(log_settings or logs.DEFAULT_SETTINGS, LOG_FILE=log_file, LOG_MAX_BYTES=max_bytes,
+                        LOG_BACKUP_COUNT=2, LOG_LEVEL='INFO', LOG_FORMAT='json')
+        self.pipeline = logs.LogPipeline(settings, self.log.name)
+
+    def close(self):
+        # Writes what is still in the queue
+        self.pipeline.stop()
+
+    def register(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.start_statement)
+        event.listen(engine, 'after_cursor_execute', self.end_statement)
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_started', []).append(time.perf_counter())
+
+    def end_statement(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['slow_query_started'].pop()
+        if elapsed >= self.threshold:
+            self.record(cursor, statement, parameters, executemany, elapsed)
+
+    def record(self, cursor, statement, parameters, executemany, elapsed):
+        normalized = normalize(statement)
+        key = fingerprint(normalized)
+        elapsed_ms = elapsed * 1000
+        with self.lock:
+            entry = self.statements.get(key)
+            is_new = entry is None
+            if is_new:
+                entry = self.statements[key] = {'statement': normalized, 'count': 0, 'total_ms': 0.0,
+                                                'max_ms': 0.0, 'plan': None}
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            totals = {'count': entry['count'], 'total_ms': round(entry['total_ms'], 3),
+                      'max_ms': round(entry['max_ms'], 3)}
+
+        fields = {'fingerprint': key,
+                  'duration_ms': round(elapsed_ms, 3),
+                  'statement': normalized,
+                  'parameters': parameter_shape(parameters, executemany),
+                  'source': statement_source(),
+                  'totals': totals}
+        # The plan is read once per statement, it doesn't change between the calls
+        if is_new and self.explain and not executemany and normalized.upper().startswith(EXPLAINABLE):
+            entry['plan'] = fields['plan'] = explain(cursor, statement, parameters)
+        self.log.info(f'Slow statement {key}: {elapsed_ms:.1f} ms', extra=fields)
+        if self.metrics is not None:
+            labels = (('fingerprint', key),)
+            self.metrics.add('devmate_slow_queries_total', labels)
+            self.metrics.add('devmate_slow_query_duration_seconds_total', labels, elapsed)
+
+    def summary(self):
+        # The statements by total time, the slowest first
+        with self.lock:
+            entries = [dict(entry, fingerprint=key) for key, entry in self.statements.items()]
+        return sorted(entries, key=lambda entry: entry['total_ms'], reverse=True)
+
+
+def explain(cursor, statement, parameters):
+    # Runs on the connection of the statement, so it sees the same transaction
+    try:
+        rows = cursor.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters or ()).fetchall()
+    except Exception as error:
+        return f'Failed to explain: {error}'
+    # The rows are (id, parent, unused, detail), the children are indented under their parents
+    depths = {0: -1}
+    lines = []
+    for row_id, parent, _, detail in rows:
+        depths[row_id] = depths.get(parent, -1) + 1
+        lines.append('  ' * depths[row_id] + detail)
+    return lines
+
+
+def init_slow_query_log(app_to_setup, engine):
+    try:
+        threshold_ms = float(os.environ.get('SLOW_QUERY_MS', DEFAULT_THRESHOLD_MS))
+        max_bytes = int(os.environ.get('SLOW_QUERY_MAX_BYTES', DEFAULT_MAX_BYTES))
+    except ValueError as error:
+        logger.error(f'Invalid slow query log setting: {error}')
+        return None
+    if threshold_ms < 0:
+        return True
+    log_settings = logs.load_settings()
+    if log_settings is None:
+        return None
+    explain_plans = os.environ.get('SLOW_QUERY_EXPLAIN', '1').lower() in ['1', 'true', 'yes']
+    log_file = os.environ.get('SLOW_QUERY_LOG', os.path.join(os.path.dirname(log_settings['LOG_FILE']),
+                                                             DEFAULT_LOG_FILE))
+    slow_log = SlowQueryLog(threshold_ms, log_file, max_bytes, explain_plans, log_settings)
+    slow_log.register(engine)
+    app_to_setup.extensions[EXTENSION] = slow_log
+    logger.debug(f'Statements slower than {threshold_ms} ms are logged')
+    return True
@@ -0,0 +1,130 @@
+import fcntl
+import logging
+import os
+import time
+
+from flask import current_app, jsonify
+from http import HTTPStatus
+from sqlalchemy import inspect
+
+from devmateback import leases, metrics
+from devmateback.models import db
+from devmateback.revision import ensure_revision_row, get_revision
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# Startup of the app and of its workers.
+#
+# DB_SCHEMA selects how the schema is set up when the app is created:
+#   create - db.create_all(), as in development and in the tests (the default)
+#   migrate - Alembic: a new database gets the current schema and is stamped, an existing one is upgraded
+# Either runs under a file lock in DB_DIR, so the workers of a server which doesn't preload the app can't race on
+# the schema.
+# In production (gunicorn.conf.py) the app is preloaded into the gunicorn master, so the schema is set up and the
+# modules are imported once, before the workers fork. Each worker then drops the connections inherited from the
+# master and warms up: opens its own connection, reads the revision and starts its background threads, before
+# it accepts requests. /ready answers 200 from a warm worker, and warms up the worker first where no server hook
+# did it (the development server).
+
+SCHEMA_MODES = ['create', 'migrate']
+SCHEMA_LOCK_FILE = 'devices.db.schema-lock'
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+# The revision of the first migration, the databases created before the migrations were used have its changes
+FIRST_REVISION = '2700b4ffbe41'
+EXTENSION = 'devmate_startup'
+
+
+def init_migrations(app_to_setup):
+    # Alembic is imported only when the migrations are needed, it's the largest import of the app
+    from flask_migrate import Migrate
+    return Migrate(app_to_setup, db)
+
+
+def prepare_schema(app_to_setup, db_dir, mode):
+    # Must be called in the app context. The workers starting at once take turns, the first one sets the schema up.
+    started = time.perf_counter()
+    with open(os.path.join(db_dir, SCHEMA_LOCK_FILE), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if mode == 'create':
+            db.create_all()
+        else:
+            migrate_schema(app_to_setup)
+        ensure_revision_row()
+        db.session.remove()
+    logger.info(f'Database schema ready in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+
+def migrate_schema(app_to_setup):
+    from flask_migrate import stamp, upgrade
+    if 'migrate' not in app_to_setup.extensions:
+        init_migrations(app_to_setup)
+    # migrations/env.py sets up the logging of alembic.ini, it's kept only while the migrations run
+    root_handlers, root_level = logging.root.handlers[:], logging.root.level
+    inspector = inspect(db.engine)
+    try:
+        if not inspector.has_table('device'):
+            # A new database gets the current schema at once
+            db.create_all()
+            stamp(directory=MIGRATIONS_DIR)
+        elif not inspector.has_table('alembic_version') and schema_is_current():
+            # Created by create_all of this version
+            stamp(directory=MIGRATIONS_DIR)
+        else:
+            if not inspector.has_table('alembic_version'):
+                # Created by create_all before the migrations were used
+                stamp(directory=MIGRATIONS_DIR, revision=FIRST_REVISION)
+            upgrade(directory=MIGRATIONS_DIR)
+    finally:
+        logging.root.handlers = root_handlers
+        logging.root.setLevel(root_level)
+
+
+def schema_is_current():
+    from alembic.autogenerate import compare_metadata
+    from alembic.migration import MigrationContext
+    with db.engine.connect() as connection:
+        return not compare_metadata(MigrationContext.configure(connection), db.metadata)
+
+
+def reset_after_fork(app_to_setup):
+    # The pooled connections of the master must not be used by the worker
+    with app_to_setup.app_context():
+        db.engine.dispose(close=False)
+
+
+def warm_up(app_to_setup, started=None):
+    # Returns the time the worker took to start since started (the fork), in milliseconds
+    started = started or time.monotonic()
+    with app_to_setup.app_context():
+        get_revision()
+        db.session.remove()
+    for extension in [leases.EXTENSION, metrics.EXTENSION]:
+        if extension in app_to_setup.extensions:
+            app_to_setup.extensions[extension].ensure_started()
+
+    boot_ms = (time.monotonic() - started) * 1000
+    app_to_setup.extensions[EXTENSION] = {'pid': os.getpid(), 'boot_ms': boot_ms}
+    logger.info(f'Worker {os.getpid()} ready in {boot_ms:.0f} ms')
+    return boot_ms
+
+
+def is_warm(app_to_setup):
+    return (app_to_setup.extensions.get(EXTENSION) or {}).get('pid') == os.getpid()
+
+
+def init_readiness(app_to_setup):
+
+    @app_to_setup.route('/ready', methods=['GET'])
+    def ready():
+        app = current_app._get_current_object()
+        try:
+            get_revision()
+        except Exception as error:
+            logger.error(f'Not ready, the database is not available: {error}')
+            return jsonify({'message': 'Database not available'}), HTTPStatus.SERVICE_UNAVAILABLE
+        if not is_warm(app):
+            warm_up(app)
+        return jsonify({'pid': os.getpid(), 'boot_ms': round(app.extensions[EXTENSION]['boot_ms'], 1)}), \
+            HTTPStatus.OK
+
+    return True
@@ -0,0 +1,713 @@
+import collections
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from sqlalchemy import delete, insert, select, update
+
+from devmateback.models import db, Device, DeviceEvent, FleetRevision
+from devmateback import events, listing, operations
+from devmateback.revision import new_epoch
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# In-memory authoritative device state, enabled with STATE_ENGINE=memory.
+#
+# The devices live in a slot array with indexes by name, status and model, and every operation is a few dict and
+# set updates under one lock instead of a SQLite write transaction. A commit appends the events of the
+# transaction to a journal file, so an acknowledged change survives a crash, and a flusher thread writes them to
+# the database in batches: the device rows, the device_event rows and the fleet revision, in one transaction per
+# batch. On startup the engine loads the database and replays the journal entries it doesn't have yet.
+#
+# The journal is fsynced on every commit by default, so a change survives a power loss too. With
+# STATE_JOURNAL_FSYNC=0 the commits only reach the page cache: they survive a crash of the process, but the last
+# ones may be lost with the machine, in exchange for the commits not waiting for the disk.
+# The journal keeps the entries after the last flush only: it's emptied when everything is flushed, and rewritten
+# with the pending entries when it grows over STATE_JOURNAL_MAX_BYTES under a steady load.
+#
+# The state is owned by one process, so it can only run with a single worker (with threads). The journal is
+# locked, and a second process refuses to start. /devices/changes and /devices/events keep reading the
+# database, so they lag behind the memory by one flush interval at most. The lists report the flushed revision in
+# their ETag and X-Fleet-Revision, the data may be newer but never older, the same as without the engine, so the
+# changes since the revision are always in the database.
+
+EXTENSION = 'devmate_state'
+JOURNAL_FILE = 'devices.journal'
+# Defaults, can be overridden with STATE_FLUSH_INTERVAL, STATE_MAX_PENDING, STATE_JOURNAL_FSYNC and
+# STATE_JOURNAL_MAX_BYTES
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_PENDING = 10000
+DEFAULT_JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+
+DeviceRow = collections.namedtuple('DeviceRow', ('id',) + listing.LIST_COLUMN_NAMES)
+DATETIME_COLUMN_NAMES = tuple(listing.LIST_COLUMN_NAMES[index] for index in listing.LIST_DATETIME_INDEXES)
+
+
+class StateEngineError(Exception):
+    pass
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def entry_values(data):
+    # The column values in the data of a journal entry
+    values = {key: data[key] for key in listing.LIST_COLUMN_NAMES if key in data}
+    for key in DATETIME_COLUMN_NAMES:
+        if key in values:
+            values[key] = parse_time(values[key])
+    return values
+
+
+class Journal(object):
+    # Append-only file of the committed events which may not be in the database yet, one JSON object per line.
+    # The lock is taken on a file next to it, the journal itself is replaced when it's rewritten.
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.lock_file = open(f'{path}.lock', 'a')
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise StateEngineError(f'Journal {path} is locked by another process')
+        self.file = open(path, 'a+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self):
+        self.file.seek(0)
+        entries = []
+        for line in self.file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # A torn write of a crash, the request wasn't acknowledged
+                logger.error(f'Journal {self.path} has a broken entry, ignoring the rest of it')
+                break
+        return entries
+
+    def append(self, entries):
+        data = b''.join(listing.dumps(entry) + b'\n' for entry in entries)
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.size += len(data)
+
+    def truncate(self):
+        self.file.truncate(0)
+        self.file.flush()
+        self.size = 0
+
+    def rewrite(self, entries):
+        # Replaces the journal with the entries, a crash leaves either the old or the new one
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.journal-', delete=False) as f:
+            try:
+                f.write(b''.join(listing.dumps(entry) + b'\n' for entry in entries))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, self.path)
+        self.file.close()
+        self.file = open(self.path, 'a+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.file.close()
+        self.lock_file.close()
+
+
+class Transaction(object):
+    def __init__(self):
+        # The replaced rows of the slots, to roll them back in reverse order
+        self.undo = []
+        self.entries = []
+        self.start_revision = None
+        self.start_next_id = None
+        # The waiters queued and granted by the transaction
+        self.waiters = []
+        self.grants = []
+
+
+class Waiter(object):
+    def __init__(self, waiter_id, username, lease, expires, device=None, model=None):
+        self.id = waiter_id
+        self.username = username
+        self.lease = lease
+        self.expires = expires
+        self.device = device
+        self.model = model
+        self.granted = None
+        self.lease_expires = None
+
+
+class StateEngine(object):
+
+    def __init__(self, app, journal_path, flush_interval=DEFAULT_FLUSH_INTERVAL, max_pending=DEFAULT_MAX_PENDING,
+                 fsync=True, journal_max_bytes=DEFAULT_JOURNAL_MAX_BYTES):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_max_bytes = journal_max_bytes
+        # Held by a request from its first operation until the commit or rollback
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.rows = []
+        self.free_slots = []
+        self.by_name = {}
+        self.by_status = {status: set() for status in Device.STATUS_CHOICES}
+        self.by_model = collections.defaultdict(set)
+        self.next_id = 1
+        self.revision = 0
+        # The revision of the database
+        self.flushed_revision = 0
+        self.epoch = None
+        # Entries which are in the journal but not in the database yet
+        self.pending = []
+        self.pending_condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        # The wait queues of the reservations, in FIFO order. The waiting requests are woken up by the commits
+        # which grant a device.
+        self.waiters = collections.OrderedDict()
+        self.next_waiter_id = 1
+        self.grant_condition = threading.Condition(self.lock)
+        self.stopped = False
+
+        self.journal = Journal(journal_path, fsync)
+        try:
+            with app.app_context():
+                self.load()
+                self.replay()
+        except Exception:
+            self.journal.close()
+            raise
+
+        self.flusher = threading.Thread(target=self.flush_loop, name='devmate-state-flusher', daemon=True)
+        self.flusher.start()
+
+    # Slots and indexes
+
+    def put(self, slot, row):
+        old_row = self.rows[slot]
+        if old_row is not None:
+            self.by_status[old_row.status].discard(slot)
+            self.by_model[old_row.model].discard(slot)
+            if not self.by_model[old_row.model]:
+                del self.by_model[old_row.model]
+            del self.by_name[old_row.name]
+        self.rows[slot] = row
+        if row is None:
+            self.free_slots.append(slot)
+        else:
+            self.by_status[row.status].add(slot)
+            self.by_model[row.model].add(slot)
+            self.by_name[row.name] = slot
+        return old_row
+
+    def new_slot(self):
+        # A rolled back delete leaves its slot in the list, so the taken ones are skipped
+        while self.free_slots:
+            slot = self.free_slots.pop()
+            if self.rows[slot] is None:
+                return slot
+        self.rows.append(None)
+        return len(self.rows) - 1
+
+    def insert_row(self, row):
+        slot = self.new_slot()
+        self.put(slot, row)
+        self.next_id = max(self.next_id, row.id + 1)
+        return slot
+
+    def load(self):
+        with db.engine.connect() as connection:
+            for row in connection.execute(listing.LIST_SELECT.order_by(Device.id)):
+                self.insert_row(DeviceRow(*row))
+            row = connection.execute(select(FleetRevision.epoch, FleetRevision.revision)
+                                     .where(FleetRevision.id == FleetRevision.ROW_ID)).first()
+        # The database gets the epoch with the revision row, if it has none yet
+        self.epoch = row.epoch if row is not None and row.epoch else new_epoch()
+        self.revision = row.revision if row is not None else 0
+        self.flushed_revision = self.revision
+        logger.info(f'Loaded {len(self.by_name)} devices at revision {self.revision}')
+
+    def replay(self):
+        # Applies the journal entries the database doesn't have yet, to both the memory and the database
+        entries = [entry for entry in self.journal.read() if entry['revision'] > self.revision]
+        if entries:
+            for entry in entries:
+                self.apply_entry(entry)
+            with db.engine.begin() as connection:
+                write_entries(connection, entries, self.epoch)
+            self.revision = entries[-1]['revision']
+            self.flushed_revision = self.revision
+            logger.info(f'Replayed {len(entries)} journal entries up to revision {self.revision}')
+        self.journal.truncate()
+
+    def apply_entry(self, entry):
+        data = entry['data']
+        slot = self.by_name.get(entry['device'])
+        if entry['action'] == events.ADD:
+            self.insert_row(DeviceRow(id=entry['id'], **entry_values(data)))
+        elif entry['action'] == events.DELETE:
+            self.put(slot, None)
+        else:
+            self.put(slot, self.rows[slot]._replace(**entry_values(data)))
+
+    # Transactions
+
+    def begin(self):
+        transaction = getattr(self.local, 'transaction', None)
+        if transaction is not None:
+            return transaction
+        # Backpressure: don't take more writes while the database is too far behind
+        with self.pending_condition:
+            while len(self.pending) >= self.max_pending and not self.stopped:
+                self.pending_condition.wait(self.flush_interval)
+        self.lock.acquire()
+        transaction = Transaction()
+        transaction.start_revision = self.revision
+        transaction.start_next_id = self.next_id
+        self.local.transaction = transaction
+        return transaction
+
+    def record(self, transaction, action, name, data, device_id=None):
+        self.revision += 1
+        entry = {'revision': self.revision, 'action': action, 'device': name, 'data': data,
+                 'time': utc_now().isoformat()}
+        if device_id is not None:
+            entry['id'] = device_id
+        transaction.entries.append(entry)
+
+    def change(self, transaction, slot, values, action):
+        row = self.rows[slot]
+        transaction.undo.append((slot, self.put(slot, row._replace(**values))))
+        self.record(transaction, action, row.name, operations.state_event(row.name, values))
+
+    def commit(self):
+        transaction = getattr(self.local, 'transaction', None)
+        if transaction is None:
+            return
+        try:
+            if transaction.entries:
+                try:
+                    self.journal.append(transaction.entries)
+                except OSError:
+                    logger.exception('Failed to write the journal, rolling back')
+                    self.undo(transaction)
+                    raise
+                with self.pending_condition:
+                    self.pending.extend(transaction.entries)
+            if transaction.grants:
+                self.grant_condition.notify_all()
+        finally:
+            self.local.transaction = None
+            self.lock.release()
+
+    def rollback(self):
+        transaction = getattr(self.local, 'transaction', None)
+        if transaction is None:
+            return
+        try:
+            self.undo(transaction)
+        finally:
+            self.local.transaction = None
+            self.lock.release()
+
+    def undo(self, transaction):
+        for slot, old_row in reversed(transaction.undo):
+            self.put(slot, old_row)
+        self.revision = transaction.start_revision
+        self.next_id = transaction.start_next_id
+        for waiter in transaction.grants:
+            waiter.granted = None
+            waiter.lease_expires = None
+        for waiter in transaction.waiters:
+            self.waiters.pop(waiter.id, None)
+
+    # Operations, the same as in devmateback/operations.py
+
+    def not_found(self, name):
+        return operations.not_found(name)
+
+    def already_exists(self, name):
+        return operations.already_exists(name)
+
+    def is_failure(self, status):
+        return operations.is_failure(status)
+
+    def existing_names(self, names):
+        with self.lock:
+            return {name for name in names if name in self.by_name}
+
+    def reserve(self, name, username, lease_expires=None):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+        row = self.rows[slot]
+        if row.status != Device.FREE:
+            logger.debug(f'Device {name} not available for reservation')
+            return {'message': 'Device not available for reservation', 'reserved_by': row.user}, \
+                HTTPStatus.CONFLICT
+
+        self.change(transaction, slot, {'status': Device.RESERVED, 'user': username, 'reservation_time': utc_now(),
+                                        'lease_expires': lease_expires}, events.RESERVE)
+        logger.info(f'Device {name} reserved by {username}')
+        return operations.reserved_body(lease_expires), HTTPStatus.OK
+
+    def reserve_any(self, model, username, count=1, info=None, lease_expires=None):
+        transaction = self.begin()
+        slots = self.by_model.get(model, set()) & self.by_status[Device.FREE]
+        if info:
+            slots = [slot for slot in slots if self.rows[slot].info and info in self.rows[slot].info]
+        slots = sorted(slots, key=lambda slot: self.rows[slot].id)[:count]
+        if len(slots) < count:
+            logger.debug(f'Only {len(slots)} of {count} devices of model {model} are available')
+            return {'message': 'Not enough devices available for reservation', 'available': len(slots)}, \
+                HTTPStatus.CONFLICT
+
+        values = {'status': Device.RESERVED, 'user': username, 'reservation_time': utc_now(),
+                  'lease_expires': lease_expires}
+        names = []
+        for slot in slots:
+            names.append(self.rows[slot].name)
+            self.change(transaction, slot, values, events.RESERVE)
+        logger.info(f"Devices {', '.join(names)} of model {model} reserved by {username}")
+        return operations.reserved_body(lease_expires, names), HTTPStatus.OK
+
+    def renew(self, name, username, lease_expires):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+        row = self.rows[slot]
+        if row.status != Device.RESERVED or row.user != username:
+            logger.debug(f'Device {name} not reserved by {username}')
+            return {'message': 'Device is not reserved by this user', 'reserved_by': row.user}, HTTPStatus.CONFLICT
+        if row.lease_expires is not None and row.lease_expires <= utc_now():
+            logger.debug(f'Lease of device {name} has already expired')
+            return {'message': 'Lease has expired'}, HTTPStatus.CONFLICT
+
+        self.change(transaction, slot, {'lease_expires': lease_expires}, events.RENEW)
+        logger.info(f'Lease of device {name} renewed until {lease_expires}')
+        return {'message': 'Lease renewed', 'lease_expires': lease_expires.isoformat()}, HTTPStatus.OK
+
+    def expire_leases(self, names, now):
+        transaction = self.begin()
+        values = {'status': Device.FREE, 'user': None, 'reservation_time': None, 'lease_expires': None}
+        expired = []
+        renewed = {}
+        for name in names:
+            slot = self.by_name.get(name)
+            row = self.rows[slot] if slot is not None else None
+            if row is None or row.status != Device.RESERVED or row.lease_expires is None:
+                continue
+            if row.lease_expires > now:
+                renewed[name] = row.lease_expires
+            else:
+                self.change(transaction, slot, values, events.EXPIRE)
+                expired.append(name)
+                self.hand_off(name)
+        if expired:
+            logger.info(f"Leases of devices {', '.join(expired)} expired")
+        return expired, renewed
+
+    def get_leases(self):
+        with self.lock:
+            return [(row.name, row.lease_expires) for row in self.rows
+                    if row is not None and row.status == Device.RESERVED and row.lease_expires is not None]
+
+    def release(self, name):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+        if self.rows[slot].status != Device.RESERVED:
+            logger.debug(f'Device {name} not reserved')
+            return {'message': 'Device is not reserved'}, HTTPStatus.NOT_MODIFIED
+
+        self.change(transaction, slot, {'status': Device.FREE, 'user': None, 'reservation_time': None,
+                                        'lease_expires': None}, events.RELEASE)
+        logger.info(f'Device {name} released')
+        self.hand_off(name)
+        return {'message': 'Device released'}, HTTPStatus.OK
+
+    def add(self, name, model, info=None, check_existing=True):
+        transaction = self.begin()
+        if name in self.by_name:
+            return operations.already_exists(name)
+
+        row = DeviceRow(id=self.next_id, name=name, model=model, status=Device.FREE, user=None,
+                        reservation_time=None, info=info, lease_expires=None)
+        slot = self.insert_row(row)
+        transaction.undo.append((slot, None))
+        self.record(transaction, events.ADD, name, listing.serialize_rows([row])[0], device_id=row.id)
+        logger.info(f'Device {name} added')
+        self.hand_off(name)
+        return {'message': 'Device added'}, HTTPStatus.CREATED
+
+    def set_offline(self, name):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+        if self.rows[slot].status == Device.OFFLINE:
+            logger.debug(f'Device {name} already offline')
+            return None, HTTPStatus.NOT_MODIFIED
+
+        self.change(transaction, slot, {'status': Device.OFFLINE, 'user': None, 'reservation_time': None,
+                                        'lease_expires': None}, events.OFFLINE)
+        logger.info(f'Device {name} set to offline')
+        return {'message': 'Device set to offline'}, HTTPStatus.OK
+
+    def set_online(self, name):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+        if self.rows[slot].status != Device.OFFLINE:
+            logger.debug(f'Device {name} already available')
+            return None, HTTPStatus.NOT_MODIFIED
+
+        self.change(transaction, slot, {'status': Device.FREE}, events.ONLINE)
+        logger.info(f'Device {name} set to available')
+        self.hand_off(name)
+        return {'message': 'Device set to available'}, HTTPStatus.OK
+
+    def delete(self, name):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None:
+            return operations.not_found(name)
+
+        transaction.undo.append((slot, self.put(slot, None)))
+        self.record(transaction, events.DELETE, name, {'name': name})
+        logger.info(f'Device {name} deleted')
+        return None, HTTPStatus.NO_CONTENT
+
+    # Wait queues
+
+    def enqueue(self, username, lease, timeout, device=None, model=None):
+        transaction = self.begin()
+        waiter = Waiter(self.next_waiter_id, username, lease, utc_now() + timedelta(seconds=timeout), device, model)
+        self.next_waiter_id += 1
+        self.waiters[waiter.id] = waiter
+        transaction.waiters.append(waiter)
+        logger.debug(f'{username} waits for {device or "a device of model " + model}')
+
+        if device is None:
+            free_slots = self.by_model.get(model, set()) & self.by_status[Device.FREE]
+            if free_slots:
+                device = self.rows[min(free_slots, key=lambda slot: self.rows[slot].id)].name
+        if device is not None:
+            self.hand_off(device)
+        return waiter.id
+
+    def hand_off(self, name):
+        transaction = self.begin()
+        slot = self.by_name.get(name)
+        if slot is None or self.rows[slot].status != Device.FREE:
+            return None
+
+        model = self.rows[slot].model
+        now = utc_now()
+        for waiter in self.waiters.values():
+            if waiter.granted is not None or waiter.expires <= now:
+                continue
+            if waiter.device == name or (waiter.device is None and waiter.model == model):
+                lease_expires = now + timedelta(seconds=waiter.lease) if waiter.lease else None
+                self.reserve(name, waiter.username, lease_expires)
+                waiter.granted = name
+                waiter.lease_expires = lease_expires
+                transaction.grants.append(waiter)
+                logger.info(f'Device {name} handed off to {waiter.username}')
+                return waiter.username
+        return None
+
+    def wait_for_grant(self, waiter_id, timeout, poll_interval):
+        # The grants are notified, there is nothing to poll
+        with self.grant_condition:
+            waiter = self.waiters.get(waiter_id)
+            if waiter is None:
+                return None
+            self.grant_condition.wait_for(lambda: waiter.granted is not None, timeout)
+            del self.waiters[waiter_id]
+            if waiter.granted is None:
+                return None
+            return waiter.granted, waiter.lease_expires
+
+    # The list
+
+    def fleet_counts(self):
+        with self.lock:
+            counts = collections.Counter((row.status, row.model) for row in self.rows if row is not None)
+        return [(status, model, count) for (status, model), count in counts.items()]
+
+    def get_list_version(self):
+        # The database may be behind the memory, see the top of the module
+        with self.lock:
+            return self.epoch, self.flushed_revision
+
+    def list_rows(self, params):
+        # The same rows, order and page size as listing.apply_list_params gives from the database
+        with self.lock:
+            slots = None
+            if params.statuses:
+                slots = set().union(*[self.by_status[status] for status in params.statuses])
+            if params.model:
+                model_slots = self.by_model.get(params.model, set())
+                slots = model_slots if slots is None else slots & model_slots
+            if slots is None:
+                rows = [row for row in self.rows if row is not None]
+            else:
+                rows = [self.rows[slot] for slot in slots]
+
+        if params.user:
+            rows = [row for row in rows if row.user == params.user]
+        if params.prefix:
+            rows = [row for row in rows if row.name.startswith(params.prefix)]
+
+        if params.sort_column is not None:
+            def key(row):
+                return getattr(row, params.sort), row.id
+            after = tuple(params.after) if params.after else None
+        else:
+            def key(row):
+                return row.id,
+            after = tuple(params.after[1:]) if params.after else None
+        if after:
+            if params.descending:
+                rows = [row for row in rows if key(row) < after]
+            else:
+                rows = [row for row in rows if key(row) > after]
+        rows.sort(key=key, reverse=params.descending)
+
+        if params.limit:
+            rows = rows[:params.limit + 1]
+        return rows
+
+    def stream_list(self, params, chunk_size):
+        # The rows are already in memory, only the serialization is done in chunks
+        rows = self.list_rows(params)
+        if not rows:
+            return None
+
+        def generate():
+            for start in range(0, len(rows), chunk_size):
+                yield listing.serialize_rows(rows[start:start + chunk_size])
+        return generate()
+
+    # Write-behind
+
+    def flush_loop(self):
+        while True:
+            # The condition is notified by the flushes as well, they must not start the next one early
+            deadline = time.monotonic() + self.flush_interval
+            with self.pending_condition:
+                while not self.stopped and time.monotonic() < deadline:
+                    self.pending_condition.wait(deadline - time.monotonic())
+                if self.stopped:
+                    # The last flush is done by stop
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # The entries stay pending and in the journal, the next round retries them
+                logger.exception('Failed to flush the device state to the database')
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_condition:
+                entries = list(self.pending)
+            if not entries:
+                return
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    write_entries(connection, entries, self.epoch)
+            logger.debug(f'Flushed {len(entries)} entries up to revision {entries[-1]["revision"]}')
+
+            # No commit can append to the journal while the lock is held
+            with self.lock:
+                self.flushed_revision = entries[-1]['revision']
+                with self.pending_condition:
+                    del self.pending[:len(entries)]
+                    if not self.pending:
+                        self.journal.truncate()
+                    elif self.journal.size > self.journal_max_bytes:
+                        # Under a steady load the journal is never empty after a flush
+                        self.journal.rewrite(self.pending)
+                        logger.debug(f'Journal rewritten with {len(self.pending)} pending entries')
+                    self.pending_condition.notify_all()
+
+    def stop(self):
+        with self.pending_condition:
+            self.stopped = True
+            self.pending_condition.notify_all()
+        self.flusher.join()
+        self.flush()
+        self.journal.close()
+
+
+def write_entries(connection, entries, epoch):
+    # Applies the journal entries to the database, in the order they were committed
+    devices = Device.__table__
+    for entry in entries:
+        data = entry['data']
+        if entry['action'] == events.ADD:
+            connection.execute(insert(devices).values(id=entry['id'], **entry_values(data)))
+        elif entry['action'] == events.DELETE:
+            connection.execute(delete(devices).where(devices.c.name == entry['device']))
+        else:
+            connection.execute(update(devices).where(devices.c.name == entry['device']).values(**entry_values(data)))
+
+    connection.execute(insert(DeviceEvent.__table__), [
+        {'revision': entry['revision'], 'action': entry['action'], 'device': entry['device'],
+         'data': json.dumps(entry['data']), 'time': parse_time(entry['time'])} for entry in entries])
+
+    revision = entries[-1]['revision']
+    result = connection.execute(update(FleetRevision.__table__).where(FleetRevision.id == FleetRevision.ROW_ID)
+                                .values(revision=revision))
+    if result.rowcount == 0:
+        connection.execute(insert(FleetRevision.__table__).values(id=FleetRevision.ROW_ID, revision=revision,
+                                                                  epoch=epoch))
+    connection.execute(delete(DeviceEvent.__table__)
+                       .where(DeviceEvent.revision <= revision - events.EVENT_RETENTION))
+
+
+def init_state_engine(app_to_setup, db_dir):
+    # Returns True if the engine is disabled or started, None if it can't be started
+    if os.environ.get('STATE_ENGINE', 'database') != 'memory':
+        return True
+
+    journal_path = os.environ.get('STATE_JOURNAL', os.path.join(db_dir, JOURNAL_FILE))
+    try:
+        engine = StateEngine(
+            app_to_setup, journal_path,
+            flush_interval=float(os.environ.get('STATE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)),
+            max_pending=int(os.environ.get('STATE_MAX_PENDING', DEFAULT_MAX_PENDING)),
+            fsync=os.environ.get('STATE_JOURNAL_FSYNC', '1').lower() not in ['0', 'false', 'no'],
+            journal_max_bytes=int(os.environ.get('STATE_JOURNAL_MAX_BYTES', DEFAULT_JOURNAL_MAX_BYTES)))
+    except (StateEngineError, ValueError) as error:
+        logger.error(f'Failed to start the in-memory state engine: {error}')
+        return None
+    app_to_setup.extensions[EXTENSION] = engine
+    logger.info(f'In-memory state engine started with journal {journal_path}')
+    return True
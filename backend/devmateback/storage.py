@@ -0,0 +1,74 @@
+import logging
+import os
+
+from sqlalchemy import event
+
+logger = logging.getLogger(f"devmate.{__name__}")
+
+# SQLite storage profiles, selected with the DB_PROFILE environment variable.
+# 'default' keeps the SQLite and SQLAlchemy defaults. 'production' is for several gunicorn workers sharing the
+# database: with WAL the readers don't block the writer, NORMAL synchronous is still safe with WAL, and the
+# busy timeout makes a worker wait for the write lock instead of failing with "database is locked".
+# Any setting of the profile can be overridden with its own environment variable, e.g. DB_BUSY_TIMEOUT=10000.
+PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        # Negative means KiB instead of pages
+        'cache_size': -64 * 1024,
+        'pool_size': 10,
+        'max_overflow': 30,
+        'pool_timeout': 10,
+    },
+}
+DEFAULT_PROFILE = 'default'
+
+# Settings applied as PRAGMAs on every new connection, and the engine pool options
+PRAGMA_SETTINGS = ['journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size']
+POOL_SETTINGS = ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']
+INTEGER_SETTINGS = ['busy_timeout', 'mmap_size', 'cache_size'] + POOL_SETTINGS
+
+
+def load_profile():
+    # Returns the settings of the profile from the environment, or None if the profile is unknown
+    profile_name = os.environ.get('DB_PROFILE', DEFAULT_PROFILE)
+    if profile_name not in PROFILES:
+        logger.error(f"Unknown database profile {profile_name}, expected one of: {', '.join(PROFILES)}")
+        return None
+
+    settings = dict(PROFILES[profile_name])
+    for setting in PRAGMA_SETTINGS + POOL_SETTINGS:
+        value = os.environ.get(f'DB_{setting.upper()}')
+        if value is None:
+            continue
+        if setting in INTEGER_SETTINGS:
+            try:
+                value = int(value)
+            except ValueError:
+                logger.error(f"Invalid value of DB_{setting.upper()}: {value}")
+                return None
+        settings[setting] = value
+    logger.debug(f"Using database profile {profile_name}: {settings}")
+    return settings
+
+
+def engine_options(settings):
+    return {setting: settings[setting] for setting in POOL_SETTINGS if setting in settings}
+
+
+def register_pragmas(engine, settings):
+    pragmas = [(setting, settings[setting]) for setting in PRAGMA_SETTINGS if setting in settings]
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for setting, value in pragmas:
+                cursor.execute(f'PRAGMA {setting}={value}')
+        finally:
+            cursor.close()
@@ -0,0 +1,26 @@
+import os
+import time
+
+# gunicorn settings of the container: gunicorn -c gunicorn.conf.py devmateback.app:app
+#
+# The app is preloaded into the master: the modules are imported and the schema is set up (DB_SCHEMA=migrate)
+# once, and the workers are forked from it. A worker drops the database connections of the master, then warms
+# up before it accepts requests, see devmateback/startup.py.
+
+bind = '0.0.0.0:8000'
+threads = 32
+# The in-memory state engine owns its threads and journal, it's started in the worker (a single one)
+preload_app = os.environ.get('STATE_ENGINE', 'database') != 'memory'
+
+
+def post_fork(server, worker):
+    worker.devmate_forked = time.monotonic()
+    if preload_app:
+        from devmateback import startup
+        from devmateback.app import app
+        startup.reset_after_fork(app)
+
+
+def post_worker_init(worker):
+    from devmateback import startup
+    startup.warm_up(worker.wsgi, worker.devmate_forked)
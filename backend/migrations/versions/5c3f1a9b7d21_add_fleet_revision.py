@@ -0,0 +1,32 @@
+"""Add fleet revision
+
+Revision ID: 5c3f1a9b7d21
+Revises: 1e0ad968300e
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3f1a9b7d21'
+down_revision = '1e0ad968300e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The app creates the missing tables on start, so the table may already be there
+    if sa.inspect(op.get_bind()).has_table('fleet_revision'):
+        return
+    fleet_revision = op.create_table('fleet_revision',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('revision', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(fleet_revision, [{'id': 1, 'revision': 0}])
+
+
+def downgrade():
+    op.drop_table('fleet_revision')
@@ -0,0 +1,34 @@
+"""Add device events
+
+Revision ID: 8a41d2e6c0f3
+Revises: 5c3f1a9b7d21
+Create Date: 2026-10-18 11:03:17.542816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a41d2e6c0f3'
+down_revision = '5c3f1a9b7d21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The app creates the missing tables on start, so the table may already be there
+    if sa.inspect(op.get_bind()).has_table('device_event'):
+        return
+    op.create_table('device_event',
+    sa.Column('revision', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('action', sa.String(length=20), nullable=False),
+    sa.Column('device', sa.String(length=50), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('revision')
+    )
+
+
+def downgrade():
+    op.drop_table('device_event')
@@ -0,0 +1,33 @@
+"""Add fleet revision epoch
+
+Revision ID: a7c3e9f15d62
+Revises: f2b8e0c6d4a1
+Create Date: 2026-10-18 19:03:12.540176
+
+"""
+import secrets
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f15d62'
+down_revision = 'f2b8e0c6d4a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The column is there already if the app has created the table on start
+    existing_columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('fleet_revision')}
+    if 'epoch' not in existing_columns:
+        with op.batch_alter_table('fleet_revision', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('epoch', sa.String(length=32), nullable=True))
+    op.execute(sa.text('UPDATE fleet_revision SET epoch = :epoch WHERE epoch IS NULL')
+               .bindparams(epoch=secrets.token_hex(8)))
+
+
+def downgrade():
+    with op.batch_alter_table('fleet_revision', schema=None) as batch_op:
+        batch_op.drop_column('epoch')
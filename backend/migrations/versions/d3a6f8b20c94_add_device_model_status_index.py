@@ -0,0 +1,33 @@
+"""Add device model and status index
+
+Revision ID: d3a6f8b20c94
+Revises: b7e92c4d1f05
+Create Date: 2026-10-18 13:41:08.624573
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a6f8b20c94'
+down_revision = 'b7e92c4d1f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The index is there already if the app has created the table on start
+    existing_indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('device')}
+    with op.batch_alter_table('device', schema=None) as batch_op:
+        if 'ix_device_model_status' not in existing_indexes:
+            batch_op.create_index('ix_device_model_status', ['model', 'status'], unique=False)
+        # The model index is a prefix of the new one
+        if 'ix_device_model' in existing_indexes:
+            batch_op.drop_index('ix_device_model')
+
+
+def downgrade():
+    with op.batch_alter_table('device', schema=None) as batch_op:
+        batch_op.create_index('ix_device_model', ['model'], unique=False)
+        batch_op.drop_index('ix_device_model_status')
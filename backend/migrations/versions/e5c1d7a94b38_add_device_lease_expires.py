@@ -0,0 +1,34 @@
+"""Add device lease expiry
+
+Revision ID: e5c1d7a94b38
+Revises: d3a6f8b20c94
+Create Date: 2026-10-18 16:02:47.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c1d7a94b38'
+down_revision = 'd3a6f8b20c94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The column is there already if the app has created the table on start
+    inspector = sa.inspect(op.get_bind())
+    existing_columns = {column['name'] for column in inspector.get_columns('device')}
+    existing_indexes = {index['name'] for index in inspector.get_indexes('device')}
+    with op.batch_alter_table('device', schema=None) as batch_op:
+        if 'lease_expires' not in existing_columns:
+            batch_op.add_column(sa.Column('lease_expires', sa.DateTime(), nullable=True))
+        if 'ix_device_lease_expires' not in existing_indexes:
+            batch_op.create_index('ix_device_lease_expires', ['lease_expires'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('device', schema=None) as batch_op:
+        batch_op.drop_index('ix_device_lease_expires')
+        batch_op.drop_column('lease_expires')
@@ -0,0 +1,43 @@
+"""Add reservation waiters
+
+Revision ID: f2b8e0c6d4a1
+Revises: e5c1d7a94b38
+Create Date: 2026-10-18 17:21:36.904512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8e0c6d4a1'
+down_revision = 'e5c1d7a94b38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The app creates the missing tables on start, so the table may already be there
+    if sa.inspect(op.get_bind()).has_table('reservation_waiter'):
+        return
+    op.create_table('reservation_waiter',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device', sa.String(length=50), nullable=True),
+    sa.Column('model', sa.String(length=50), nullable=True),
+    sa.Column('username', sa.String(length=50), nullable=False),
+    sa.Column('lease', sa.Float(), nullable=True),
+    sa.Column('expires', sa.DateTime(), nullable=False),
+    sa.Column('granted_device', sa.String(length=50), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('reservation_waiter', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_reservation_waiter_device'), ['device'], unique=False)
+        batch_op.create_index(batch_op.f('ix_reservation_waiter_model'), ['model'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('reservation_waiter', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_reservation_waiter_model'))
+        batch_op.drop_index(batch_op.f('ix_reservation_waiter_device'))
+
+    op.drop_table('reservation_waiter')
@@ -0,0 +1,111 @@
+import asyncio
+import atexit
+import json as json_module
+import queue
+import threading
+
+from urllib.parse import urlencode, urlsplit
+
+from werkzeug.wrappers import Response
+
+from devmateback.asgi import AsgiApp
+
+# Test client running the requests through the ASGI app, with the calls of the Flask test client the tests use.
+# It can be set as the test client class of the Flask app, then app.test_client() returns it:
+# DEVMATE_TEST_ASGI=1 python -m pytest tests runs the whole suite against devmateback/asgi.py.
+
+# One ASGI app and event loop per Flask app, shared by its clients
+ASGI_APPS = {}
+ASGI_APPS_LOCK = threading.Lock()
+RESPONSE_TIMEOUT = 30
+
+
+def get_asgi_app(flask_app):
+    with ASGI_APPS_LOCK:
+        if flask_app not in ASGI_APPS:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='devmate-asgi-test', daemon=True).start()
+            asgi_app = AsgiApp(flask_app)
+            ASGI_APPS[flask_app] = (asgi_app, loop)
+            # Don't leave the watcher running when the tests are done
+            atexit.register(lambda: asyncio.run_coroutine_threadsafe(asgi_app.watcher.stop(), loop).result())
+        return ASGI_APPS[flask_app]
+
+
+class AsgiTestClient(object):
+
+    def __init__(self, flask_app, response_wrapper=None, use_cookies=True, **kwargs):
+        self.asgi_app, self.loop = get_asgi_app(flask_app)
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+    def open(self, method, path, json=None, headers=None, query_string=None, buffered=False):
+        url = urlsplit(path)
+        query = url.query
+        if query_string:
+            query = '&'.join(filter(None, [query, urlencode(query_string)]))
+        body = b''
+        request_headers = [(key.lower().encode('latin-1'), str(value).encode('latin-1'))
+                           for key, value in (headers or {}).items()]
+        if json is not None:
+            body = json_module.dumps(json).encode()
+            request_headers += [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode())]
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                 'scheme': 'http', 'path': url.path, 'raw_path': url.path.encode(), 'root_path': '',
+                 'query_string': query.encode('latin-1'), 'headers': request_headers,
+                 'client': ('127.0.0.1', 12345), 'server': ('localhost', 80)}
+
+        messages = queue.Queue()
+        disconnected = asyncio.Event()
+        request_messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+        async def receive():
+            if request_messages:
+                return request_messages.pop()
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.put(message)
+
+        async def run():
+            try:
+                await self.asgi_app(scope, receive, send)
+            finally:
+                messages.put(None)
+
+        task = asyncio.run_coroutine_threadsafe(run(), self.loop)
+        start = messages.get(timeout=RESPONSE_TIMEOUT)
+        if start is None:
+            task.result()
+            raise RuntimeError('The app sent no response')
+
+        def body_chunks():
+            while True:
+                message = messages.get(timeout=RESPONSE_TIMEOUT)
+                if message is None:
+                    return
+                if message.get('body'):
+                    yield message['body']
+                if not message.get('more_body'):
+                    return
+
+        def close():
+            self.loop.call_soon_threadsafe(disconnected.set)
+            task.result(timeout=RESPONSE_TIMEOUT)
+
+        response = Response(body_chunks(), status=start['status'],
+                            headers=[(key.decode('latin-1'), value.decode('latin-1'))
+                                     for key, value in start['headers']])
+        response.call_on_close(close)
+        if buffered:
+            response.get_data()
+        return response
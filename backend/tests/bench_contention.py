@@ -0,0 +1,128 @@
+import argparse
+import threading
+import time
+
+from http import HTTPStatus
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# Hammers one device with reserve/release from many threads and checks that it's never held twice.
+# Run from the backend directory: python -m tests.bench_contention --threads 16 --duration 5
+
+DEVICE = 'ContendedDevice'
+
+
+class Holder(object):
+    # What the clients believe about the device: nobody may win it while somebody else holds it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holder = None
+        self.violations = 0
+
+    def acquire(self, worker):
+        with self.lock:
+            if self.holder is not None:
+                self.violations += 1
+            self.holder = worker
+
+    def release(self, worker):
+        with self.lock:
+            if self.holder != worker:
+                self.violations += 1
+            self.holder = None
+
+
+def worker(app, worker_id, deadline, holder, stats, hold_time):
+    client = app.test_client()
+    username = f'worker-{worker_id}'
+    reserve_latencies = []
+    counts = {'reserved': 0, 'conflicts': 0, 'released': 0, 'errors': 0}
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            response = client.post('/devices/reserve', json={'device': DEVICE, 'username': username})
+        except Exception:
+            counts['errors'] += 1
+            continue
+        reserve_latencies.append(time.perf_counter() - started)
+
+        if response.status_code == HTTPStatus.CONFLICT:
+            counts['conflicts'] += 1
+            continue
+        if response.status_code != HTTPStatus.OK:
+            counts['errors'] += 1
+            continue
+
+        counts['reserved'] += 1
+        holder.acquire(username)
+        if hold_time:
+            time.sleep(hold_time)
+        holder.release(username)
+        try:
+            response = client.post('/devices/release', json={'device': DEVICE})
+        except Exception:
+            response = None
+        if response is not None and response.status_code == HTTPStatus.OK:
+            counts['released'] += 1
+        else:
+            # The device stays reserved, the run is broken from here on
+            counts['errors'] += 1
+            holder.violations += 1
+    stats.append((counts, reserve_latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reserve/release contention on a single device.')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run')
+    parser.add_argument('--hold-time', type=float, default=0.0, help='Seconds to hold each reservation')
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    setup_app_environment()
+    from devmateback.app import app, db
+    from devmateback.models import Device
+
+    with app.app_context():
+        db.session.add(Device(name=DEVICE, model='BenchModel', status=Device.FREE))
+        db.session.commit()
+
+    holder = Holder()
+    stats = []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=worker, args=(app, i, deadline, holder, stats, args.hold_time))
+               for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    totals = {'reserved': 0, 'conflicts': 0, 'released': 0, 'errors': 0}
+    latencies = []
+    for counts, reserve_latencies in stats:
+        for key, value in counts.items():
+            totals[key] += value
+        latencies.extend(reserve_latencies)
+
+    with app.app_context():
+        device = Device.query.filter_by(name=DEVICE).first()
+        final_status = device.status
+
+    requests_done = totals['reserved'] + totals['conflicts'] + totals['released'] + totals['errors']
+    results = dict(totals)
+    results.update({
+        'violations': holder.violations,
+        'final_status': final_status,
+        'correct': holder.violations == 0 and totals['reserved'] == totals['released']
+                   and final_status == Device.FREE,
+        'requests_per_second': requests_done / elapsed,
+        'reservations_per_second': totals['reserved'] / elapsed,
+        'reserve_latency': latency_summary(latencies),
+    })
+    report('contention', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
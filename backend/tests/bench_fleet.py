@@ -0,0 +1,142 @@
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import time
+import tracemalloc
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# How the backend scales with the fleet size: seeds a synthetic inventory (tests/inventory.py) of each size and
+# measures the device list (whole, one page, streamed), the ORM as_dict serialization, the name lookups and the
+# migrations which rewrite the device table, with their latency and memory. This is the baseline to measure the
+# other performance changes against.
+# Each size runs in its own process on a new database, so the memory of one doesn't count in the next one.
+# Run from the backend directory: python -m tests.bench_fleet --sizes 10 1000 100000 1000000
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+# The migrations from this one to the head are timed, the lease column rewrites the device table
+MIGRATION_BASE = 'd3a6f8b20c94'
+
+
+def timed(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return latency_summary(latencies)
+
+
+def peak_memory_mb(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run_size(work_dir, cli_dir, size, args, results):
+    os.environ['DB_DIR'] = work_dir
+    os.environ['CLI_DIR'] = cli_dir
+    os.environ['LOG_LEVEL'] = 'INFO'
+    os.environ['LOG_FILE'] = os.path.join(work_dir, 'devmate.log')
+    os.environ['SLOW_QUERY_LOG'] = os.path.join(work_dir, 'slow-queries.log')
+    # Every list is read from the database, not from the cache
+    os.environ['READ_CACHE_MAX_LISTS'] = '0'
+    from flask_migrate import downgrade, stamp, upgrade
+    from devmateback import startup
+    from devmateback.app import app, db
+    from devmateback.models import Device
+    from tests.inventory import seed_devices
+
+    result = {}
+    client = app.test_client()
+    with app.app_context():
+        started = time.perf_counter()
+        seed_devices(db, size, args.seed)
+        result['seed_s'] = time.perf_counter() - started
+        names = [name for name, in db.session.query(Device.name)]
+        sample = random.Random(args.seed).choices(names, k=args.lookups)
+        del names
+
+    def whole_list():
+        response = client.get('/devices/list')
+        assert response.status_code in [200, 204], response.status_code
+        return response
+
+    result['list_bytes'] = len(whole_list().get_data())
+    result['list'] = timed(whole_list, args.repeat)
+    result['list_peak_mb'] = peak_memory_mb(whole_list)
+    result['list_page'] = timed(lambda: client.get('/devices/list?status=free&limit=100'), args.repeat)
+
+    def streamed_list():
+        for _ in client.get('/devices/list?format=ndjson', buffered=False).response:
+            pass
+
+    result['list_streamed'] = timed(streamed_list, args.repeat)
+    result['list_streamed_peak_mb'] = peak_memory_mb(streamed_list)
+
+    with app.app_context():
+        def serialize():
+            devices = [device.as_dict() for device in Device.query.all()]
+            db.session.remove()
+            return devices
+
+        result['as_dict'] = timed(serialize, args.repeat)
+        result['as_dict_peak_mb'] = peak_memory_mb(serialize)
+
+        latencies = []
+        for name in sample:
+            started = time.perf_counter()
+            Device.query.filter_by(name=name).first()
+            latencies.append(time.perf_counter() - started)
+        result['lookup'] = latency_summary(latencies)
+        db.session.remove()
+
+        if args.migrations:
+            startup.init_migrations(app)
+            stamp(directory=MIGRATIONS_DIR)
+            started = time.perf_counter()
+            downgrade(directory=MIGRATIONS_DIR, revision=MIGRATION_BASE)
+            result['migration_downgrade_s'] = time.perf_counter() - started
+            started = time.perf_counter()
+            upgrade(directory=MIGRATIONS_DIR)
+            result['migration_upgrade_s'] = time.perf_counter() - started
+
+    result['db_mb'] = os.path.getsize(os.path.join(work_dir, 'devices.db')) / 1024 / 1024
+    # Kilobytes on Linux
+    result['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fleet size scaling benchmark.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each list and serialization measurement')
+    parser.add_argument('--lookups', type=int, default=1000, help='Name lookups of each size')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the inventory')
+    parser.add_argument('--no-migrations', dest='migrations', action='store_false',
+                        help="Don't time the migrations, they rewrite the device table")
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for size in args.sizes:
+        work_dir = setup_app_environment()
+        queue = context.Queue()
+        process = context.Process(target=run_size, args=(work_dir, os.environ['CLI_DIR'], size, args, queue))
+        process.start()
+        results[size] = queue.get()
+        process.join()
+        print(f"{size} devices: list p50 {results[size]['list']['p50_ms']:.1f} ms "
+              f"({results[size]['list_peak_mb']:.1f} MB), as_dict p50 {results[size]['as_dict']['p50_ms']:.1f} ms, "
+              f"lookup p50 {results[size]['lookup']['p50_ms']:.3f} ms, max RSS {results[size]['max_rss_mb']:.0f} MB")
+    report('fleet', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# Load test of the API over HTTP: starts the real server on a temporary database, seeds it, and runs a mix of
+# list, reserve, release and add requests from client threads (in several processes with --processes, so the
+# clients don't share a GIL). Reports the throughput, the latency percentiles and the conflict and error rates of
+# each operation.
+# Run from the backend directory:
+#   python -m tests.bench_load --server gunicorn --workers 4 --clients 32 --mix list=70 reserve=15 release=10 add=5
+# --server werkzeug runs the development server instead, for machines without gunicorn.
+
+OPERATIONS = ['list', 'reserve', 'release', 'add']
+DEFAULT_MIX = ['list=70', 'reserve=15', 'release=10', 'add=5']
+SEED_BATCH_SIZE = 500
+READY_TIMEOUT = 30
+
+
+def parse_mix(values):
+    mix = {}
+    for value in values:
+        operation, _, weight = value.partition('=')
+        if operation not in OPERATIONS or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f'Invalid mix {value}, expected <{"|".join(OPERATIONS)}>=<weight>')
+        mix[operation] = int(weight)
+    return mix
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, port):
+    # Everything the server writes stays in the temporary directory
+    work_dir = os.environ['DB_DIR']
+    environment = dict(os.environ, LOG_LEVEL=args.log_level, LOG_FILE=os.path.join(work_dir, 'devmate.log'),
+                       SLOW_QUERY_LOG=os.path.join(work_dir, 'slow-queries.log'),
+                       METRICS_DIR=os.path.join(work_dir, 'metrics'))
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}', '--workers', str(args.workers),
+                   '--threads', str(args.threads), 'devmateback.app:app']
+    else:
+        command = [sys.executable, '-c',
+                   f'from devmateback.app import app; app.run(host="127.0.0.1", port={port}, threaded=True)']
+    server = subprocess.Popen(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'The server exited with {server.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def seed(base_url, args):
+    session = requests.Session()
+    for start in range(0, args.devices, SEED_BATCH_SIZE):
+        batch = [{'action': 'add', 'device': f'device-{i}', 'model': f'model-{i % args.models}', 'info': f'Rack {i}'}
+                 for i in range(start, min(start + SEED_BATCH_SIZE, args.devices))]
+        response = session.post(f'{base_url}/devices/batch', json={'operations': batch})
+        response.raise_for_status()
+
+
+class Client(object):
+
+    def __init__(self, base_url, client_id, args):
+        self.base_url = base_url
+        self.client_id = client_id
+        self.args = args
+        self.session = requests.Session()
+        self.reserved = []
+        self.added = 0
+
+    def request(self, operation):
+        # Returns the response of a random request of the operation
+        if operation == 'list':
+            return self.session.get(f'{self.base_url}/devices/list')
+        if operation == 'reserve':
+            device = f'device-{random.randrange(self.args.devices)}'
+            response = self.session.post(f'{self.base_url}/devices/reserve',
+                                         json={'device': device, 'username': f'client-{self.client_id}'})
+            if response.status_code == 200:
+                self.reserved.append(device)
+            return response
+        if operation == 'release':
+            # Own devices first, a random one (probably free, so 304) otherwise
+            if self.reserved:
+                device = self.reserved.pop(random.randrange(len(self.reserved)))
+            else:
+                device = f'device-{random.randrange(self.args.devices)}'
+            return self.session.post(f'{self.base_url}/devices/release', json={'device': device})
+        self.added += 1
+        return self.session.post(f'{self.base_url}/devices/add',
+                                 json={'device': f'added-{self.client_id}-{self.added}',
+                                       'model': f'model-{random.randrange(self.args.models)}'})
+
+
+def run_clients(base_url, first_client, clients, args, results):
+    # Runs the client threads of one process, puts the latencies and counts by operation to the results
+    operations = list(args.mix)
+    weights = [args.mix[operation] for operation in operations]
+    latencies = {operation: [] for operation in operations}
+    counts = {operation: {'ok': 0, 'conflicts': 0, 'errors': 0} for operation in operations}
+    lock = threading.Lock()
+    start = threading.Barrier(clients)
+
+    def client_thread(client_id):
+        client = Client(base_url, client_id, args)
+        local_latencies = {operation: [] for operation in operations}
+        local_counts = {operation: {'ok': 0, 'conflicts': 0, 'errors': 0} for operation in operations}
+        start.wait()
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = client.request(operation).status_code
+            except requests.RequestException:
+                local_counts[operation]['errors'] += 1
+                continue
+            local_latencies[operation].append(time.perf_counter() - started)
+            if status == 409:
+                local_counts[operation]['conflicts'] += 1
+            elif status < 400:
+                local_counts[operation]['ok'] += 1
+            else:
+                local_counts[operation]['errors'] += 1
+        with lock:
+            for operation in operations:
+                latencies[operation].extend(local_latencies[operation])
+                for key, value in local_counts[operation].items():
+                    counts[operation][key] += value
+
+    threads = [threading.Thread(target=client_thread, args=(first_client + i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, counts))
+
+
+def summarize(collected, duration):
+    latencies = {}
+    counts = {}
+    for process_latencies, process_counts in collected:
+        for operation, values in process_latencies.items():
+            latencies.setdefault(operation, []).extend(values)
+        for operation, operation_counts in process_counts.items():
+            totals = counts.setdefault(operation, {'ok': 0, 'conflicts': 0, 'errors': 0})
+            for key, value in operation_counts.items():
+                totals[key] += value
+
+    results = {}
+    for operation, operation_counts in counts.items():
+        total = sum(operation_counts.values())
+        results[operation] = dict(operation_counts,
+                                  requests_per_second=total / duration,
+                                  conflict_rate=operation_counts['conflicts'] / total if total else 0,
+                                  error_rate=operation_counts['errors'] / total if total else 0,
+                                  latency=latency_summary(latencies[operation]))
+    all_latencies = [value for values in latencies.values() for value in values]
+    total = sum(sum(operation_counts.values()) for operation_counts in counts.values())
+    errors = sum(operation_counts['errors'] for operation_counts in counts.values())
+    results['total'] = {'requests': total,
+                        'requests_per_second': total / duration,
+                        'error_rate': errors / total if total else 0,
+                        'latency': latency_summary(all_latencies)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test of the backend.')
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='Gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=32, help='Threads of each gunicorn worker')
+    parser.add_argument('--clients', type=int, default=32, help='Client threads in total')
+    parser.add_argument('--processes', type=int, default=1, help='Client processes, the threads are split among them')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run')
+    parser.add_argument('--devices', type=int, default=1000, help='Devices seeded')
+    parser.add_argument('--models', type=int, default=20, help='Models of the seeded devices')
+    parser.add_argument('--mix', nargs='+', default=DEFAULT_MIX, help='Weights of the operations, operation=weight')
+    parser.add_argument('--log-level', default='INFO', help='LOG_LEVEL of the server')
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+    try:
+        args.mix = parse_mix(args.mix)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+    setup_app_environment()
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = start_server(args, port)
+    try:
+        seed(base_url, args)
+        context = multiprocessing.get_context('spawn')
+        results_queue = context.Queue()
+        per_process = [args.clients // args.processes + (1 if i < args.clients % args.processes else 0)
+                       for i in range(args.processes)]
+        processes = []
+        first_client = 0
+        for clients in per_process:
+            if clients:
+                processes.append(context.Process(target=run_clients,
+                                                 args=(base_url, first_client, clients, args, results_queue)))
+            first_client += clients
+        for process in processes:
+            process.start()
+        collected = [results_queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = summarize(collected, args.duration)
+    for operation, operation_results in results.items():
+        print(f"{operation}: {operation_results['requests_per_second']:.0f} requests/s, "
+              f"p99 {operation_results['latency'].get('p99_ms', 0):.2f} ms, "
+              f"{operation_results['error_rate']:.1%} errors")
+    report('load', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
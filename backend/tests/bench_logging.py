@@ -0,0 +1,105 @@
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+from http import HTTPStatus
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# Request latency and throughput with the logging setups: the legacy one (text records of every request and its
+# body, written and rotated by the request threads) and the queue-based JSON one.
+# Each mode runs in its own process, as the logging is set up when the app is imported.
+# Run from the backend directory: python -m tests.bench_logging --threads 8 --duration 5
+
+MODES = {
+    'sync-text': {'LOG_ASYNC': '0', 'LOG_FORMAT': 'text', 'LOG_LEVEL': 'DEBUG', 'LOG_MAX_BYTES': str(1024 * 1024),
+                  'LOG_REQUEST_BODY': '1'},
+    'async-json': {'LOG_ASYNC': '1', 'LOG_FORMAT': 'json', 'LOG_LEVEL': 'DEBUG'},
+    'async-json-info': {'LOG_ASYNC': '1', 'LOG_FORMAT': 'json', 'LOG_LEVEL': 'INFO'},
+}
+
+
+def run_mode(work_dir, cli_dir, mode, args, results):
+    os.environ['DB_DIR'] = work_dir
+    os.environ['CLI_DIR'] = cli_dir
+    os.environ['LOG_FILE'] = os.path.join(work_dir, f'{mode}.log')
+    os.environ.update(MODES[mode])
+    from devmateback.app import app, db, log_pipeline
+    from devmateback.models import Device
+
+    with app.app_context():
+        db.session.execute(Device.__table__.insert(), [
+            {'name': f'device-{i}', 'model': f'model-{i % 10}', 'status': Device.FREE} for i in range(args.devices)])
+        db.session.commit()
+
+    start = threading.Barrier(args.threads)
+    latencies = [[] for _ in range(args.threads)]
+    errors = [0] * args.threads
+
+    def client_thread(index):
+        client = app.test_client()
+        device = f'device-{index % args.devices}'
+        reserved = False
+        start.wait()
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            is_write = reserved or random.random() < 0.5
+            started = time.perf_counter()
+            if reserved:
+                response = client.post('/devices/release', json={'device': device})
+            elif is_write:
+                response = client.post('/devices/reserve', json={'device': device, 'username': f'user-{index}'})
+            else:
+                response = client.get('/devices/list')
+            latencies[index].append(time.perf_counter() - started)
+            if response.status_code != HTTPStatus.OK:
+                errors[index] += 1
+            elif is_write:
+                reserved = not reserved
+
+    threads = [threading.Thread(target=client_thread, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    dropped = log_pipeline.dropped
+    stop_started = time.perf_counter()
+    log_pipeline.stop()
+    all_latencies = [value for values in latencies for value in values]
+    results.put({'requests_per_second': len(all_latencies) / args.duration,
+                 'errors': sum(errors),
+                 'dropped_records': dropped,
+                 # Time to write what was left in the queue
+                 'drain_ms': (time.perf_counter() - stop_started) * 1000,
+                 'latency': latency_summary(all_latencies)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Request logging overhead.')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--threads', type=int, default=8, help='Client threads')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each mode')
+    parser.add_argument('--devices', type=int, default=100, help='Devices in the database')
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode in args.modes:
+        work_dir = setup_app_environment()
+        queue = context.Queue()
+        process = context.Process(target=run_mode, args=(work_dir, os.environ['CLI_DIR'], mode, args, queue))
+        process.start()
+        results[mode] = queue.get()
+        process.join()
+        print(f"{mode}: {results[mode]['requests_per_second']:.0f} requests/s, "
+              f"p99 {results[mode]['latency']['p99_ms']:.2f} ms, {results[mode]['dropped_records']} dropped")
+    report('logging', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
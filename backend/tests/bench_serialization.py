@@ -0,0 +1,97 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+from tests.benchutils import setup_app_environment, report
+
+# Compares the ORM listing (Device.query.all(), as_dict, jsonify) with the row listing used by /devices/list,
+# and the row listing with the streamed one: time to the first chunk and peak memory.
+# Run from the backend directory: python -m tests.bench_serialization --sizes 1000 10000 100000
+
+
+def seed(db, device_table, size):
+    db.session.execute(device_table.delete())
+    db.session.execute(device_table.insert(), [
+        {'name': f'device-{i}', 'model': f'model-{i % 20}', 'status': 'free', 'info': f'Rack {i % 40}'}
+        for i in range(size)])
+    db.session.commit()
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def measure_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Device list serialization micro-benchmark.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the best one is reported')
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    setup_app_environment()
+    from flask import jsonify
+    from devmateback import listing
+    from devmateback.app import app, db
+    from devmateback.models import Device
+
+    def orm_path():
+        return jsonify({'devices': [device.as_dict() for device in Device.query.all()]}).get_data()
+
+    def row_path():
+        rows = db.session.execute(listing.LIST_SELECT).all()
+        return listing.json_response({'devices': listing.serialize_rows(rows)}).get_data()
+
+    def stream_chunks():
+        chunks = listing.stream_rows(listing.LIST_SELECT, listing.DEFAULT_STREAM_CHUNK_SIZE)
+        return listing.generate_json(chunks)
+
+    def stream_path():
+        # Consumes the chunks the way the server sends them, without keeping the whole document
+        for _ in stream_chunks():
+            pass
+
+    def stream_first_chunk():
+        chunks = stream_chunks()
+        next(chunks)
+        next(chunks)
+        chunks.close()
+
+    results = {'json_encoder': 'orjson' if listing.orjson is not None else 'json'}
+    with app.test_request_context():
+        for size in args.sizes:
+            seed(db, Device.__table__, size)
+            # Both paths must give the same devices
+            assert json.loads(orm_path())['devices'] == json.loads(row_path())['devices']
+            assert json.loads(b''.join(stream_chunks())) == json.loads(row_path())
+            # Keep the identity map from skewing the ORM numbers
+            db.session.expunge_all()
+            orm_ms = measure(lambda: (orm_path(), db.session.expunge_all()), args.repeat)
+            row_ms = measure(row_path, args.repeat)
+            stream_ms = measure(stream_path, args.repeat)
+            first_chunk_ms = measure(stream_first_chunk, args.repeat)
+            results[str(size)] = {'orm_ms': orm_ms, 'rows_ms': row_ms, 'speedup': orm_ms / row_ms,
+                                  'stream_ms': stream_ms, 'stream_first_chunk_ms': first_chunk_ms,
+                                  'rows_peak_mb': measure_memory(row_path),
+                                  'stream_peak_mb': measure_memory(stream_path)}
+            print(f"{size}: orm {orm_ms:.1f} ms, rows {row_ms:.1f} ms, stream {stream_ms:.1f} ms")
+
+    report('serialization', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
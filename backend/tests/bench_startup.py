@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# Worker startup latency:
+#   cold - N processes start at once on the same database, each imports and creates the app and serves /ready,
+#          as the workers of a server which doesn't preload the app (with DB_SCHEMA=create and =migrate)
+#   fork - the app is created once and N workers are forked from it, each resets its connections, warms up and
+#          serves /ready, as the gunicorn workers of gunicorn.conf.py
+#   gunicorn - the time from starting gunicorn with gunicorn.conf.py until /ready answers, if gunicorn is installed
+# Run from the backend directory: python -m tests.bench_startup --workers 8 --rounds 5
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_TIMEOUT = 60
+
+# Run in each cold worker: the import, the app and the first request, in seconds
+COLD_WORKER = '''
+import json, time
+started = time.perf_counter()
+from devmateback.app import app
+created = time.perf_counter()
+assert app.test_client().get('/ready').status_code == 200
+print(json.dumps({'create_s': created - started, 'ready_s': time.perf_counter() - started}))
+'''
+
+
+def worker_environment(work_dir, **extra):
+    return dict(os.environ, DB_DIR=work_dir, LOG_LEVEL='INFO', LOG_FILE=os.path.join(work_dir, 'devmate.log'),
+                SLOW_QUERY_LOG=os.path.join(work_dir, 'slow-queries.log'), **extra)
+
+
+def run_cold(workers, schema_mode):
+    # A new database per round, the first start creates the schema while the other workers wait or race
+    work_dir = setup_app_environment()
+    environment = worker_environment(work_dir, DB_SCHEMA=schema_mode)
+    started = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, '-c', COLD_WORKER], env=environment, cwd=BACKEND_DIR,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                 for _ in range(workers)]
+    results = []
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f'A {schema_mode} worker exited with {process.returncode}')
+        results.append(json.loads(output))
+    return time.perf_counter() - started, results
+
+
+def run_fork(workers):
+    # The master preloads the app, the workers are forked from it
+    work_dir = setup_app_environment()
+    os.environ.update(worker_environment(work_dir, DB_SCHEMA='migrate'))
+    started = time.perf_counter()
+    from devmateback import startup
+    from devmateback.app import app
+    preload_s = time.perf_counter() - started
+
+    children = []
+    started = time.perf_counter()
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        forked = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            startup.reset_after_fork(app)
+            warm_ms = startup.warm_up(app, forked)
+            assert app.test_client().get('/ready').status_code == 200
+            result = {'warm_s': warm_ms / 1000, 'ready_s': time.monotonic() - forked}
+            os.write(write_fd, json.dumps(result).encode())
+            os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+
+    results = []
+    for pid, read_fd in children:
+        with os.fdopen(read_fd) as f:
+            output = f.read()
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise RuntimeError(f'A forked worker exited with {status}')
+        results.append(json.loads(output))
+    return preload_s, time.perf_counter() - started, results
+
+
+def run_gunicorn(workers):
+    import requests
+
+    work_dir = setup_app_environment()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = ['gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}', '--workers', str(workers),
+               'devmateback.app:app']
+    started = time.perf_counter()
+    server = subprocess.Popen(command, env=worker_environment(work_dir, DB_SCHEMA='migrate'), cwd=BACKEND_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < READY_TIMEOUT:
+            if server.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with {server.returncode}')
+            try:
+                if requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError('gunicorn did not start')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker startup benchmark.')
+    parser.add_argument('--workers', type=int, default=4, help='Workers started at once')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--no-gunicorn', dest='gunicorn', action='store_false', help="Don't start gunicorn")
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for schema_mode in ['create', 'migrate']:
+        create, ready, walls = [], [], []
+        for _ in range(args.rounds):
+            wall, workers = run_cold(args.workers, schema_mode)
+            walls.append(wall)
+            create += [worker['create_s'] for worker in workers]
+            ready += [worker['ready_s'] for worker in workers]
+        results[f'cold_{schema_mode}'] = {'create_app': latency_summary(create), 'ready': latency_summary(ready),
+                                          'all_ready': latency_summary(walls)}
+        print(f"cold {schema_mode}: ready p50 {results[f'cold_{schema_mode}']['ready']['p50_ms']:.0f} ms, "
+              f"all {args.workers} ready p50 {results[f'cold_{schema_mode}']['all_ready']['p50_ms']:.0f} ms")
+
+    # Forked in a child, so the app of one round isn't in the next one
+    preloads, warm, ready, walls = [], [], [], []
+    for _ in range(args.rounds):
+        output = subprocess.run([sys.executable, '-m', 'tests.bench_startup', '--fork-round', str(args.workers)],
+                                cwd=BACKEND_DIR, check=True, capture_output=True, text=True).stdout
+        round_result = json.loads(output.strip().splitlines()[-1])
+        preloads.append(round_result['preload_s'])
+        walls.append(round_result['wall_s'])
+        warm += [worker['warm_s'] for worker in round_result['workers']]
+        ready += [worker['ready_s'] for worker in round_result['workers']]
+    results['fork'] = {'preload': latency_summary(preloads), 'warm_up': latency_summary(warm),
+                       'ready': latency_summary(ready), 'all_ready': latency_summary(walls)}
+    print(f"fork: preload p50 {results['fork']['preload']['p50_ms']:.0f} ms, "
+          f"worker ready p50 {results['fork']['ready']['p50_ms']:.1f} ms")
+
+    if args.gunicorn and shutil.which('gunicorn'):
+        results['gunicorn'] = latency_summary([run_gunicorn(args.workers) for _ in range(args.rounds)])
+        print(f"gunicorn: ready p50 {results['gunicorn']['p50_ms']:.0f} ms")
+    elif args.gunicorn:
+        print('gunicorn is not installed, skipped')
+
+    report('startup', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--fork-round':
+        preload_s, wall_s, workers = run_fork(int(sys.argv[2]))
+        print(json.dumps({'preload_s': preload_s, 'wall_s': wall_s, 'workers': workers}))
+    else:
+        main()
@@ -0,0 +1,128 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from http import HTTPStatus
+
+from tests.benchutils import setup_app_environment, latency_summary, report
+
+# Reads and writes per second of concurrent worker processes sharing one database, for each storage profile.
+# Each process is a separate app, like a gunicorn worker.
+# Run from the backend directory: python -m tests.bench_storage --workers 4 --duration 5
+
+
+def worker(db_dir, cli_dir, profile, worker_id, duration, write_ratio, start, results):
+    os.environ['DB_DIR'] = db_dir
+    os.environ['CLI_DIR'] = cli_dir
+    os.environ['DB_PROFILE'] = profile
+    from devmateback.app import app
+
+    client = app.test_client()
+    device = f'device-{worker_id}'
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    read_latencies = []
+    write_latencies = []
+    reserved = False
+    start.wait()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        is_write = random.random() < write_ratio
+        started = time.perf_counter()
+        try:
+            if is_write:
+                if reserved:
+                    response = client.post('/devices/release', json={'device': device})
+                else:
+                    response = client.post('/devices/reserve', json={'device': device, 'username': device})
+            else:
+                response = client.get('/devices/list')
+        except Exception:
+            counts['errors'] += 1
+            continue
+        elapsed = time.perf_counter() - started
+        if response.status_code != HTTPStatus.OK:
+            counts['errors'] += 1
+        elif is_write:
+            reserved = not reserved
+            counts['writes'] += 1
+            write_latencies.append(elapsed)
+        else:
+            counts['reads'] += 1
+            read_latencies.append(elapsed)
+    results.put((counts, read_latencies, write_latencies))
+
+
+def run_profile(profile, args):
+    work_dir = setup_app_environment()
+    os.environ['DB_PROFILE'] = profile
+    context = multiprocessing.get_context('spawn')
+
+    # Create the database and the devices in the parent, the workers only use them
+    seed = context.Process(target=seed_database, args=(work_dir, os.environ['CLI_DIR'], profile, args))
+    seed.start()
+    seed.join()
+
+    start = context.Barrier(args.workers)
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(work_dir, os.environ['CLI_DIR'], profile, i, args.duration,
+                                                    args.write_ratio, start, results))
+               for i in range(args.workers)]
+    for process in workers:
+        process.start()
+    collected = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+
+    totals = {'reads': 0, 'writes': 0, 'errors': 0}
+    read_latencies = []
+    write_latencies = []
+    for counts, reads, writes in collected:
+        for key, value in counts.items():
+            totals[key] += value
+        read_latencies.extend(reads)
+        write_latencies.extend(writes)
+    return {'reads_per_second': totals['reads'] / args.duration,
+            'writes_per_second': totals['writes'] / args.duration,
+            'errors': totals['errors'],
+            'read_latency': latency_summary(read_latencies),
+            'write_latency': latency_summary(write_latencies)}
+
+
+def seed_database(db_dir, cli_dir, profile, args):
+    os.environ['DB_DIR'] = db_dir
+    os.environ['CLI_DIR'] = cli_dir
+    os.environ['DB_PROFILE'] = profile
+    from devmateback.app import app, db
+    from devmateback.models import Device
+
+    with app.app_context():
+        db.session.execute(Device.__table__.insert(), [
+            {'name': f'device-{i}', 'model': f'model-{i % 10}', 'status': Device.FREE}
+            for i in range(max(args.devices, args.workers))])
+        db.session.commit()
+
+
+def main():
+    from devmateback.storage import PROFILES
+
+    parser = argparse.ArgumentParser(description='Storage profile throughput under concurrent workers.')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES))
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each profile')
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of the requests that are writes')
+    parser.add_argument('--devices', type=int, default=200, help='Devices in the database')
+    parser.add_argument('--output', help='Save the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for profile in args.profiles:
+        results[profile] = run_profile(profile, args)
+        print(f"{profile}: {results[profile]['reads_per_second']:.0f} reads/s, "
+              f"{results[profile]['writes_per_second']:.0f} writes/s, {results[profile]['errors']} errors")
+    report('storage', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
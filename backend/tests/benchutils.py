@@ -0,0 +1,69 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Helpers shared by the benchmarks in this directory.
+# The benchmarks are standalone scripts, run them from the backend directory: python -m tests.bench_<name> --help
+
+
+def setup_app_environment():
+    # The app is created at import time, so the database and CLI directories must be set up before importing it
+    work_dir = tempfile.mkdtemp(prefix='devmate-bench-')
+    cli_dir = os.path.join(work_dir, 'cli-data')
+    for platform_name in ['linux', 'macos', 'windows']:
+        os.makedirs(os.path.join(cli_dir, f'devmatecli-{platform_name}-latest'))
+    os.environ['DB_DIR'] = work_dir
+    os.environ['CLI_DIR'] = cli_dir
+    return work_dir
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    # Latencies in seconds, summary in milliseconds
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'mean_ms': sum(values) / len(values) * 1000,
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(name, parameters, results, output=None):
+    # Prints the results and saves them as JSON, so the runs of different commits can be compared
+    print(f"== {name} ==")
+    for key, value in parameters.items():
+        print(f"{key}: {value}")
+    print(json.dumps(results, indent=2, default=str))
+
+    if output:
+        document = {'benchmark': name,
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'commit': git_commit(),
+                    'python': sys.version.split()[0],
+                    'platform': platform.platform(),
+                    'parameters': parameters,
+                    'results': results}
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2, default=str)
+        print(f"Results saved to {output}")
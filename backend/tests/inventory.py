@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from tests.benchutils import setup_app_environment
+
+# Synthetic device inventory for the benchmarks: N devices with the model, status and info distributions of a
+# real lab. A few models make up most of the fleet, most devices are free, and the reserved ones have a user, a
+# reservation time and sometimes a lease. The same seed gives the same inventory.
+# Seed a database from the backend directory: python -m tests.inventory --devices 1000000 --db-dir /tmp/fleet
+
+# Model families and their weights, the devices of a family are spread over its generations
+MODEL_FAMILIES = [
+    ('Pixel', 30, 6), ('Galaxy S', 25, 8), ('iPhone', 20, 6), ('Galaxy A', 10, 10), ('Xperia', 4, 5),
+    ('Moto G', 4, 8), ('OnePlus', 3, 6), ('RaspberryPi', 2, 3), ('Jetson', 1, 3), ('iPad', 1, 4),
+]
+STATUS_WEIGHTS = [('free', 70), ('reserved', 25), ('offline', 5)]
+# Share of the reserved devices with a lease
+LEASED_SHARE = 0.3
+OS_VERSIONS = ['Android 12', 'Android 13', 'Android 14', 'Android 15', 'iOS 16', 'iOS 17', 'iOS 18', 'Linux']
+USERS = 500
+INSERT_CHUNK_SIZE = 10000
+
+
+def model_names():
+    names = []
+    weights = []
+    for family, weight, generations in MODEL_FAMILIES:
+        for generation in range(1, generations + 1):
+            names.append(f'{family} {generation}')
+            # The newer generations are the more common ones
+            weights.append(weight * generation)
+    return names, weights
+
+
+def generate_devices(count, seed=0, now=None):
+    # Yields the rows of the Device table, without the ids
+    rng = random.Random(seed)
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    models, model_weights = model_names()
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    status_weights = [weight for _, weight in STATUS_WEIGHTS]
+    for i in range(count):
+        model = rng.choices(models, model_weights)[0]
+        status = rng.choices(statuses, status_weights)[0]
+        row = {'name': f"{model.replace(' ', '-').lower()}-{i:07d}", 'model': model, 'status': status,
+               'user': None, 'reservation_time': None, 'lease_expires': None,
+               'info': f'Rack {rng.randrange(1, 200)}, shelf {rng.randrange(1, 10)}, {rng.choice(OS_VERSIONS)}'}
+        if status == 'reserved':
+            row['user'] = f'user{rng.randrange(USERS)}'
+            row['reservation_time'] = now - timedelta(minutes=rng.randrange(1, 7 * 24 * 60))
+            if rng.random() < LEASED_SHARE:
+                row['lease_expires'] = now + timedelta(minutes=rng.randrange(1, 24 * 60))
+        yield row
+
+
+def seed_devices(db, count, seed=0):
+    # Inserts the devices in chunks and bumps the fleet revision once. The events before it are dropped, so the
+    # clients re-read the whole list instead of missing the new devices.
+    from devmateback.models import Device, DeviceEvent
+    from devmateback.revision import bump_revision
+
+    chunk = []
+    for row in generate_devices(count, seed):
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            db.session.execute(Device.__table__.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(Device.__table__.insert(), chunk)
+    db.session.execute(DeviceEvent.__table__.delete())
+    bump_revision()
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a database with a synthetic device inventory.')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--db-dir', required=True, help='Directory of devices.db, created with the schema if needed')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.db_dir, exist_ok=True)
+    # The app needs the CLI directories as well
+    setup_app_environment()
+    os.environ['DB_DIR'] = args.db_dir
+    from devmateback.app import app, db
+
+    started = time.perf_counter()
+    with app.app_context():
+        seed_devices(db, args.devices, args.seed)
+    print(f'{args.devices} devices added to {os.path.join(args.db_dir, "devices.db")} '
+          f'in {time.perf_counter() - started:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
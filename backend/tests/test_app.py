@@ -1,9 +1,38 @@
+import asyncio
+import base64
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pstats
+import queue
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import patch
 
+from flask import Flask, has_app_context
+from flask.testing import FlaskClient
+from sqlalchemy import create_engine, delete
+
+from devmateback import (artifacts, asgi, asyncdb, cache, deltas, events, leases, logs, metrics, operations, profiler,
+                         slowlog, startup, state, storage)
 from devmateback.app import app, db
-from devmateback.models import Device
+from devmateback.devices import WAITERS_EXTENSION
+from devmateback.models import Device, DeviceEvent, ReservationWaiter
 from http import HTTPStatus
-from datetime import datetime
+from datetime import datetime, timedelta
+from tests import asgiclient
+
+# DEVMATE_TEST_ASGI=1 runs the tests through the ASGI app, see devmateback/asgi.py
+if os.environ.get('DEVMATE_TEST_ASGI'):
+    app.test_client_class = asgiclient.AsgiTestClient
 
 
 class BaseTestCase(unittest.TestCase):
@@ -19,6 +48,8 @@ class BaseTestCase(unittest.TestCase):
         pass
 
     def setUp(self):
+        # The tests change the devices behind the back of the revision row
+        app.extensions[cache.EXTENSION].clear()
         with app.app_context():
             db.create_all()
 
@@ -63,6 +94,341 @@ class TestListDevices(BaseTestCase):
         self.assertEqual(current_time, returned_time1)
         self.assertEqual(current_time, returned_time2)
 
+    def test_list_devices_same_as_model(self):
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='free', info='Info1'))
+            db.session.add(Device(name='Device2', model='Model2', status='reserved', user='Nikolay',
+                                  reservation_time=datetime(2021, 1, 1, 0, 0, 0, 123456)))
+            db.session.commit()
+            expected = [device.as_dict() for device in Device.query.order_by(Device.id).all()]
+
+        response = self.client.get('/devices/list')
+        self.assertEqual('application/json', response.mimetype)
+        self.assertEqual(expected, response.get_json()['devices'])
+
+    def test_list_devices_etag(self):
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='free'))
+            db.session.commit()
+
+        response = self.client.get('/devices/list')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        etag = response.headers.get('ETag')
+        self.assertIsNotNone(etag)
+        self.assertFalse(etag.startswith('W/'))
+
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response.headers.get('ETag'))
+
+    def test_list_devices_etag_changes_on_mutation(self):
+        response = self.client.get('/devices/list')
+        etag = response.headers.get('ETag')
+
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+        etag = response.headers.get('ETag')
+
+        for endpoint, payload in [('/devices/reserve', {'device': 'Device1', 'username': 'Nikolay'}),
+                                  ('/devices/release', {'device': 'Device1'}),
+                                  ('/devices/offline', {'device': 'Device1'}),
+                                  ('/devices/online', {'device': 'Device1'})]:
+            self.client.post(endpoint, json=payload)
+            response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+            self.assertEqual(HTTPStatus.OK, response.status_code, endpoint)
+            etag = response.headers.get('ETag')
+
+        self.client.delete('/devices/delete/Device1')
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NO_CONTENT, response.status_code)
+
+    def test_list_devices_etag_unchanged_on_failed_mutation(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        etag = self.client.get('/devices/list').headers.get('ETag')
+
+        self.client.post('/devices/release', json={'device': 'Device1'})
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+
+    def test_list_devices_etag_changes_with_recreated_database(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        response = self.client.get('/devices/list')
+        etag = response.headers.get('ETag')
+
+        # The same revision of another database, the cached list must not be served either
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model2'})
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual('1', response.headers.get('X-Fleet-Revision'))
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+        self.assertEqual(['Device2'], [device['name'] for device in response.get_json()['devices']])
+
+
+class TestListDevicesQuery(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            db.session.add(Device(name='board-c', model='ModelX', status='free'))
+            db.session.add(Device(name='board-a', model='ModelY', status='reserved', user='Nikolay'))
+            db.session.add(Device(name='board-b', model='ModelX', status='free'))
+            db.session.add(Device(name='phone-a', model='ModelX', status='offline'))
+            db.session.add(Device(name='board-d', model='ModelX', status='reserved', user='Nikolay'))
+            db.session.commit()
+
+    def list_names(self, query):
+        response = self.client.get(f'/devices/list?{query}')
+        if response.status_code == HTTPStatus.NO_CONTENT:
+            return []
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        return [device['name'] for device in response.get_json()['devices']]
+
+    def test_list_filters(self):
+        self.assertEqual(['board-c', 'board-b'], self.list_names('status=free&model=ModelX'))
+        self.assertEqual(['board-c', 'board-b', 'phone-a'], self.list_names('status=free,offline'))
+        self.assertEqual(['board-a', 'board-d'], self.list_names('user=Nikolay'))
+        self.assertEqual(['board-c', 'board-a', 'board-b', 'board-d'], self.list_names('prefix=board-'))
+        self.assertEqual([], self.list_names('model=ModelZ'))
+
+    def test_list_sort(self):
+        self.assertEqual(['board-a', 'board-b', 'board-c', 'board-d', 'phone-a'], self.list_names('sort=name'))
+        self.assertEqual(['phone-a', 'board-d', 'board-c', 'board-b', 'board-a'], self.list_names('sort=-name'))
+        self.assertEqual(['board-c', 'board-b', 'phone-a', 'board-a', 'board-d'], self.list_names('sort=status'))
+
+    def test_list_pagination(self):
+        for sort in ['name', '-name', 'status', '-model', '']:
+            expected = self.list_names(f'sort={sort}')
+            names = []
+            query = f'sort={sort}&limit=2'
+            while True:
+                response = self.client.get(f'/devices/list?{query}')
+                self.assertEqual(HTTPStatus.OK, response.status_code)
+                names.extend(device['name'] for device in response.get_json()['devices'])
+                cursor = response.get_json().get('next_cursor')
+                if not cursor:
+                    break
+                query = f'sort={sort}&limit=2&cursor={cursor}'
+            self.assertEqual(expected, names, sort)
+
+    def test_list_stream(self):
+        app.config['LIST_STREAM_CHUNK_SIZE'] = 2
+        try:
+            expected = self.client.get('/devices/list?sort=name').get_json()
+
+            response = self.client.get('/devices/list?sort=name&stream=true')
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(expected, response.get_json())
+
+            response = self.client.get('/devices/list?sort=name&format=ndjson')
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            self.assertEqual('application/x-ndjson', response.mimetype)
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertEqual(expected['devices'], [json.loads(line) for line in lines])
+
+            response = self.client.get('/devices/list?model=ModelZ&stream=true')
+            self.assertEqual(HTTPStatus.NO_CONTENT, response.status_code)
+        finally:
+            app.config.pop('LIST_STREAM_CHUNK_SIZE')
+
+    def test_list_invalid_query(self):
+        for query, message in [('status=broken', 'Invalid status: broken'),
+                               ('sort=user', 'Invalid sort, expected one of: id, name, model, status'),
+                               ('limit=0', 'Invalid limit, expected 1 to 1000'),
+                               ('limit=abc', 'Invalid limit, expected 1 to 1000'),
+                               ('cursor=abc', 'Invalid cursor'),
+                               ('format=xml', 'Invalid format, expected json or ndjson'),
+                               ('stream=true&limit=2', "The streamed list can't be paginated")]:
+            response = self.client.get(f'/devices/list?{query}')
+            self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code, query)
+            self.assertEqual({'message': message}, response.get_json())
+
+        cursor = self.client.get('/devices/list?sort=name&limit=1').get_json()['next_cursor']
+        response = self.client.get(f'/devices/list?sort=model&limit=1&cursor={cursor}')
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+
+    def test_list_tampered_cursor(self):
+        for sort, cursor in [('name', ['name', 0, 'Device1', 1]),
+                             ('name', ['name', False, ['Device1'], 1]),
+                             ('name', ['name', False, None, 1]),
+                             ('name', ['name', False, 'Device1', '1']),
+                             ('name', ['name', False, 'Device1', True]),
+                             ('id', ['id', False, 'Device1', 1]),
+                             ('id', ['id', False, None, 1.5]),
+                             ('id', {'sort': 'id', 'descending': False, 'value': None, 'id': 1})]:
+            encoded = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+            response = self.client.get(f'/devices/list?sort={sort}&limit=1&cursor={encoded}')
+            self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code, cursor)
+            self.assertEqual({'message': 'Invalid cursor'}, response.get_json())
+
+
+class TestDeviceEvents(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['EVENTS_POLL_INTERVAL'] = 0.01
+
+    def tearDown(self):
+        app.config.pop('EVENTS_POLL_INTERVAL', None)
+        app.config.pop('EVENTS_HEARTBEAT_INTERVAL', None)
+        super().tearDown()
+
+    def read_stream(self, count, headers=None):
+        response = self.client.get('/devices/events', headers=headers, buffered=False)
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual('text/event-stream', response.mimetype)
+        chunks = response.iter_encoded()
+        try:
+            return [next(chunks).decode() for _ in range(count)]
+        finally:
+            response.close()
+
+    def test_events_new_client_gets_reset(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+
+        chunks = self.read_stream(2)
+        self.assertTrue(chunks[0].startswith('retry: '))
+        self.assertEqual('id: 1\nevent: reset\ndata: {"revision": 1}\n\n', chunks[1])
+
+    def test_events_resume(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.delete('/devices/delete/Device1')
+
+        chunks = self.read_stream(3, headers={'Last-Event-ID': '1'})
+        self.assertTrue(chunks[1].startswith('id: 2\nevent: reserve\ndata: '))
+        reserve_data = json.loads(chunks[1].split('data: ')[1])
+        self.assertEqual('Device1', reserve_data['name'])
+        self.assertEqual('reserved', reserve_data['status'])
+        self.assertEqual('Nikolay', reserve_data['user'])
+        self.assertEqual('id: 3\nevent: delete\ndata: {"name": "Device1"}\n\n', chunks[2])
+
+    def test_events_resume_from_pruned_revision(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        with app.app_context():
+            db.session.execute(delete(DeviceEvent).where(DeviceEvent.revision == 1))
+            db.session.commit()
+
+        chunks = self.read_stream(2, headers={'Last-Event-ID': '0'})
+        self.assertEqual('id: 2\nevent: reset\ndata: {"revision": 2}\n\n', chunks[1])
+
+    def test_events_heartbeat(self):
+        app.config['EVENTS_HEARTBEAT_INTERVAL'] = 0
+
+        chunks = self.read_stream(3)
+        self.assertEqual(': heartbeat\n\n', chunks[2])
+
+    def test_events_invalid_last_event_id(self):
+        response = self.client.get('/devices/events', headers={'Last-Event-ID': 'abc'})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Invalid Last-Event-ID'})
+
+    def test_events_stream_limit(self):
+        # The limit of the WSGI workers, the ASGI app serves the streams itself
+        client = FlaskClient(app)
+        slots = app.extensions[events.STREAMS_EXTENSION]
+        app.extensions[events.STREAMS_EXTENSION] = events.RequestSlots(1)
+        try:
+            first = client.get('/devices/events', buffered=False)
+            self.assertEqual(HTTPStatus.OK, first.status_code)
+            response = client.get('/devices/events', buffered=False)
+            self.assertEqual(HTTPStatus.SERVICE_UNAVAILABLE, response.status_code)
+            self.assertEqual(str(events.STREAM_RETRY_AFTER), response.headers['Retry-After'])
+
+            first.close()
+            response = client.get('/devices/events', buffered=False)
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            response.close()
+        finally:
+            app.extensions[events.STREAMS_EXTENSION] = slots
+
+
+class TestDeviceChanges(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['EVENTS_POLL_INTERVAL'] = 0.01
+
+    def tearDown(self):
+        app.config.pop('EVENTS_POLL_INTERVAL', None)
+        super().tearDown()
+
+    def test_changes_upserts_and_tombstones(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model2'})
+        revision = int(self.client.get('/devices/list').headers['X-Fleet-Revision'])
+
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3'})
+        self.client.delete('/devices/delete/Device2')
+
+        response = self.client.get(f'/devices/changes?since={revision}')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        changes = response.get_json()
+        self.assertEqual(revision + 3, changes['revision'])
+        self.assertEqual(['Device1', 'Device3'], [device['name'] for device in changes['devices']])
+        self.assertEqual('reserved', changes['devices'][0]['status'])
+        self.assertEqual(['Device2'], changes['deleted'])
+
+    def test_changes_nothing_changed(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+
+        response = self.client.get('/devices/changes?since=1')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual({'revision': 1, 'devices': [], 'deleted': []}, response.get_json())
+
+    def test_changes_long_poll_timeout(self):
+        response = self.client.get('/devices/changes?since=0&wait=0.05')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual({'revision': 0, 'devices': [], 'deleted': []}, response.get_json())
+
+    def test_changes_long_poll_wakes_up(self):
+        add = threading.Timer(0.1, lambda: app.test_client().post('/devices/add',
+                                                                   json={'device': 'Device1', 'model': 'Model1'}))
+        add.start()
+        response = self.client.get('/devices/changes?since=0&wait=10')
+        add.join()
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(1, response.get_json()['revision'])
+        self.assertEqual(['Device1'], [device['name'] for device in response.get_json()['devices']])
+
+    def test_changes_pruned_revision(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model2'})
+        with app.app_context():
+            db.session.execute(delete(DeviceEvent).where(DeviceEvent.revision == 1))
+            db.session.commit()
+
+        response = self.client.get('/devices/changes?since=0')
+        self.assertEqual(HTTPStatus.GONE, response.status_code)
+        self.assertEqual(2, response.get_json()['revision'])
+
+    def test_changes_future_revision(self):
+        # E.g. a client of the database before it was restored
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+
+        response = self.client.get('/devices/changes?since=5&wait=10')
+        self.assertEqual(HTTPStatus.GONE, response.status_code)
+        self.assertEqual({'message': 'Revision is newer than the current one, the whole list must be re-read',
+                          'revision': 1}, response.get_json())
+
+    def test_changes_invalid_parameters(self):
+        response = self.client.get('/devices/changes')
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Missing parameters: since'})
+
+        response = self.client.get('/devices/changes?since=abc')
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Invalid since or wait value'})
+
+
 class TestAddDevice(BaseTestCase):
     
     def setUp(self):
@@ -103,6 +469,61 @@ class TestAddDevice(BaseTestCase):
                                                     'device, model'})
 
 
+class TestReserveAnyDevice(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='reserved', user='SomeoneElse'))
+            db.session.add(Device(name='Device2', model='Model1', status='free', info='rev A'))
+            db.session.add(Device(name='Device3', model='Model1', status='free', info='rev B'))
+            db.session.add(Device(name='Device4', model='Model2', status='free'))
+            db.session.commit()
+
+    def get_users(self):
+        with app.app_context():
+            return {device.name: device.user for device in Device.query.all()}
+
+    def test_reserve_any_success(self):
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1', 'username': 'Nikolay'})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual({'message': 'Device reserved', 'devices': ['Device2']}, response.get_json())
+        self.assertEqual('Nikolay', self.get_users()['Device2'])
+
+    def test_reserve_any_info_match(self):
+        response = self.client.post('/devices/reserve_any',
+                                    json={'model': 'Model1', 'username': 'Nikolay', 'info': 'rev B'})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(['Device3'], response.get_json()['devices'])
+
+    def test_reserve_any_gang(self):
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1', 'username': 'Nikolay', 'count': 2})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(['Device2', 'Device3'], response.get_json()['devices'])
+
+        events_response = self.client.get('/devices/changes?since=0')
+        self.assertEqual(['Device2', 'Device3'], [device['name'] for device in events_response.get_json()['devices']])
+
+    def test_reserve_any_not_enough(self):
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1', 'username': 'Nikolay', 'count': 3})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertEqual({'message': 'Not enough devices available for reservation', 'available': 2},
+                         response.get_json())
+        self.assertEqual({'Device1': 'SomeoneElse', 'Device2': None, 'Device3': None, 'Device4': None},
+                         self.get_users())
+
+    def test_reserve_any_invalid(self):
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1'})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Missing parameters: username'})
+
+        for count in [0, True]:
+            response = self.client.post('/devices/reserve_any',
+                                        json={'model': 'Model1', 'username': 'Nikolay', 'count': count})
+            self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+            self.assertEqual(response.get_json(), {'message': 'Invalid count, expected 1 to 100'})
+
+
 class TestReleaseDevice(BaseTestCase):
 
     def test_release_device_success(self):
@@ -169,6 +590,30 @@ class TestReserveDevice(BaseTestCase):
         self.assertEqual(HTTPStatus.NOT_FOUND, response.status_code)
         self.assertEqual(response.get_json(), {'message': 'Device not found'})
 
+    def test_reserve_device_concurrently(self):
+        with app.app_context():
+            device = Device(name='Device1', model='Model1', status='free')
+            db.session.add(device)
+            db.session.commit()
+
+        start = threading.Barrier(8)
+        statuses = []
+
+        def reserve(username):
+            client = app.test_client()
+            start.wait()
+            statuses.append(client.post('/devices/reserve',
+                                        json={'device': 'Device1', 'username': username}).status_code)
+
+        threads = [threading.Thread(target=reserve, args=(f'User{i}',)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, statuses.count(HTTPStatus.OK))
+        self.assertEqual(7, statuses.count(HTTPStatus.CONFLICT))
+
     def test_reserve_device_missing_parameters(self):
         response = self.client.post('/devices/reserve', json={})
         self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
@@ -253,6 +698,1362 @@ class TestDeleteDevice(BaseTestCase):
         self.assertEqual(response.get_json(), {'message': 'Device not found'})
 
 
+class TestBatch(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='free'))
+            db.session.add(Device(name='Device2', model='Model1', status='reserved', user='SomeoneElse'))
+            db.session.commit()
+
+    def get_device(self, name):
+        with app.app_context():
+            return Device.query.filter_by(name=name).first()
+
+    def test_batch_atomic_success(self):
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'reserve', 'device': 'Device1', 'username': 'Nikolay'},
+            {'action': 'release', 'device': 'Device2'},
+            {'action': 'add', 'device': 'Device3', 'model': 'Model3', 'info': 'Info3'},
+            {'action': 'offline', 'device': 'Device3'},
+        ]})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertTrue(response.get_json()['committed'])
+        self.assertEqual([200, 200, 201, 200], [result['status'] for result in response.get_json()['results']])
+        self.assertEqual('Nikolay', self.get_device('Device1').user)
+        self.assertEqual('free', self.get_device('Device2').status)
+        self.assertEqual('offline', self.get_device('Device3').status)
+        self.assertEqual('Info3', self.get_device('Device3').info)
+
+    def test_batch_atomic_rollback(self):
+        etag = self.client.get('/devices/list').headers.get('ETag')
+
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'reserve', 'device': 'Device1', 'username': 'Nikolay'},
+            {'action': 'reserve', 'device': 'Device2', 'username': 'Nikolay'},
+            {'action': 'delete', 'device': 'Device1'},
+        ]})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertFalse(response.get_json()['committed'])
+        results = response.get_json()['results']
+        self.assertEqual([200, 409], [result['status'] for result in results])
+        self.assertEqual('SomeoneElse', results[1]['reserved_by'])
+        self.assertEqual('free', self.get_device('Device1').status)
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+
+    def test_batch_best_effort(self):
+        response = self.client.post('/devices/batch', json={'mode': 'best_effort', 'operations': [
+            {'action': 'reserve', 'device': 'Device2', 'username': 'Nikolay'},
+            {'action': 'online', 'device': 'Device1'},
+            {'action': 'delete', 'device': 'NonExistentDevice'},
+            {'action': 'delete', 'device': 'Device1'},
+        ]})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertTrue(response.get_json()['committed'])
+        self.assertEqual([409, 304, 404, 204], [result['status'] for result in response.get_json()['results']])
+        self.assertIsNone(self.get_device('Device1'))
+        self.assertEqual('SomeoneElse', self.get_device('Device2').user)
+
+    def test_batch_invalid(self):
+        response = self.client.post('/devices/batch', json={'operations': 'reserve'})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Operations must be a list'})
+
+        response = self.client.post('/devices/batch', json={'operations': [{'action': 'explode', 'device': 'D'}]})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Operation 0: invalid action'})
+
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'release', 'device': 'Device2'},
+            {'action': 'reserve', 'device': 'Device1'},
+        ]})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual(response.get_json(), {'message': 'Operation 1: missing or empty parameters: username'})
+        self.assertEqual('reserved', self.get_device('Device2').status)
+
+        response = self.client.post('/devices/batch', json={'mode': 'sometimes', 'operations': []})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+
+    def test_batch_non_string_parameters(self):
+        for operation, field in [({'action': 'add', 'device': ['x'], 'model': 'Model3'}, 'device'),
+                                 ({'action': 'reserve', 'device': 'Device1', 'username': {'name': 'x'}}, 'username'),
+                                 ({'action': 'add', 'device': 'Device3', 'model': 'Model3', 'info': 1}, 'info')]:
+            response = self.client.post('/devices/batch', json={'operations': [operation]})
+            self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+            self.assertEqual({'message': f'Operation 0: parameters must be strings: {field}'}, response.get_json())
+        self.assertEqual('free', self.get_device('Device1').status)
+
+
+class TestStateEngine(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='free'))
+            db.session.add(Device(name='Device2', model='Model1', status='reserved', user='SomeoneElse'))
+            db.session.commit()
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.work_dir.name, state.JOURNAL_FILE)
+        self.engine = self.start_engine()
+
+    def tearDown(self):
+        if self.engine is not None:
+            self.engine.stop()
+        app.extensions.pop(state.EXTENSION, None)
+        self.work_dir.cleanup()
+        super().tearDown()
+
+    def start_engine(self, flush_interval=60):
+        # Flushes only when asked to, unless the interval is short
+        engine = state.StateEngine(app, self.journal_path, flush_interval=flush_interval)
+        app.extensions[state.EXTENSION] = engine
+        return engine
+
+    def get_device(self, name):
+        with app.app_context():
+            return Device.query.filter_by(name=name).first()
+
+    def test_operations(self):
+        response = self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        response = self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Other'})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertEqual('Nikolay', response.get_json()['reserved_by'])
+        response = self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model1'})
+        self.assertEqual(HTTPStatus.CREATED, response.status_code)
+        response = self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model1'})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1', 'username': 'Nikolay',
+                                                                  'count': 2})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertEqual(1, response.get_json()['available'])
+        response = self.client.post('/devices/release', json={'device': 'Device2'})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        response = self.client.delete('/devices/delete/Device3')
+        self.assertEqual(HTTPStatus.NO_CONTENT, response.status_code)
+
+        response = self.client.get('/devices/list', query_string={'status': 'reserved'})
+        self.assertEqual(['Device1'], [device['name'] for device in response.get_json()['devices']])
+        # The database is behind until the flush, and so is the revision of the list
+        self.assertEqual('0', response.headers.get('X-Fleet-Revision'))
+        self.assertEqual('reserved', self.get_device('Device2').status)
+        self.engine.flush()
+        self.assertEqual('4', self.client.get('/devices/list').headers.get('X-Fleet-Revision'))
+
+    def test_changes_after_list(self):
+        self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3'})
+        revision = self.client.get('/devices/list').headers.get('X-Fleet-Revision')
+
+        response = self.client.get('/devices/changes', query_string={'since': revision})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.engine.flush()
+        response = self.client.get('/devices/changes', query_string={'since': revision})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(['Device3'], [device['name'] for device in response.get_json()['devices']])
+
+    def test_list_pages(self):
+        for index in range(3, 8):
+            self.client.post('/devices/add', json={'device': f'Device{index}', 'model': f'Model{index % 2}'})
+
+        names = []
+        query = {'sort': '-name', 'limit': 2}
+        while True:
+            body = self.client.get('/devices/list', query_string=query).get_json()
+            names += [device['name'] for device in body['devices']]
+            if 'next_cursor' not in body:
+                break
+            query['cursor'] = body['next_cursor']
+        self.assertEqual([f'Device{index}' for index in range(7, 0, -1)], names)
+
+        response = self.client.get('/devices/list', query_string={'format': 'ndjson', 'model': 'Model1'})
+        self.assertEqual(['Device1', 'Device2', 'Device3', 'Device5', 'Device7'],
+                         [json.loads(line)['name'] for line in response.data.splitlines()])
+
+    def test_batch_rollback(self):
+        etag = self.client.get('/devices/list').headers.get('ETag')
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'delete', 'device': 'Device1'},
+            {'action': 'add', 'device': 'Device3', 'model': 'Model3'},
+            {'action': 'reserve', 'device': 'Device2', 'username': 'Nikolay'},
+        ]})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        response = self.client.get('/devices/list', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+        devices = self.client.get('/devices/list').get_json()['devices']
+        self.assertEqual(['Device1', 'Device2'], [device['name'] for device in devices])
+
+        response = self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3'})
+        self.assertEqual(HTTPStatus.CREATED, response.status_code)
+        self.assertEqual(['Device1', 'Device2', 'Device3'],
+                         [device['name'] for device in self.client.get('/devices/list').get_json()['devices']])
+
+    def test_flush(self):
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3', 'info': 'Info3'})
+        self.client.delete('/devices/delete/Device2')
+        memory_list = self.client.get('/devices/list').get_json()['devices']
+        self.engine.flush()
+
+        self.assertEqual(0, os.path.getsize(self.journal_path))
+        with app.app_context():
+            self.assertEqual(memory_list, [device.as_dict() for device in Device.query.order_by(Device.id).all()])
+            self.assertEqual(['reserve', 'add', 'delete'],
+                             [event.action for event in DeviceEvent.query.order_by(DeviceEvent.revision).all()])
+        response = self.client.get('/devices/changes', query_string={'since': 0})
+        self.assertEqual(3, response.get_json()['revision'])
+
+    def test_flusher_thread(self):
+        self.engine.stop()
+        self.engine = self.start_engine(flush_interval=0.01)
+        self.client.post('/devices/release', json={'device': 'Device2'})
+        for _ in range(100):
+            if self.get_device('Device2').status == 'free':
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual('free', self.get_device('Device2').status)
+
+    def test_replay_after_crash(self):
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3'})
+        # Crash: the journal is left as it is, nothing is flushed
+        with self.engine.pending_condition:
+            self.engine.stopped = True
+            self.engine.pending_condition.notify_all()
+        self.engine.flusher.join()
+        self.engine.journal.close()
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(b'{"revision": 3, "act')
+        self.assertEqual('free', self.get_device('Device1').status)
+
+        self.engine = self.start_engine()
+        self.assertEqual('Nikolay', self.get_device('Device1').user)
+        self.assertEqual('Model3', self.get_device('Device3').model)
+        self.assertEqual(0, os.path.getsize(self.journal_path))
+        response = self.client.get('/devices/list')
+        self.assertEqual('2', response.headers.get('X-Fleet-Revision'))
+        self.assertEqual(3, len(response.get_json()['devices']))
+
+    def test_lease_expiry(self):
+        response = self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay',
+                                                              'lease': 1})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        scheduler = app.extensions[leases.EXTENSION]
+        later = datetime.utcnow() + timedelta(seconds=2)
+        self.assertEqual(['Device1'], scheduler.expire_due(later))
+        devices = self.client.get('/devices/list', query_string={'status': 'free'}).get_json()['devices']
+        self.assertEqual(['Device1'], [device['name'] for device in devices])
+        self.engine.flush()
+        self.assertEqual('free', self.get_device('Device1').status)
+
+    def test_wait_queue(self):
+        result = {}
+
+        def wait():
+            response = app.test_client().post('/devices/reserve?wait=5',
+                                              json={'device': 'Device2', 'username': 'Nikolay'})
+            result['status'] = response.status_code
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        for _ in range(500):
+            if self.engine.waiters:
+                break
+            threading.Event().wait(0.01)
+        self.client.post('/devices/release', json={'device': 'Device2'})
+        waiter.join()
+        self.assertEqual(HTTPStatus.OK, result['status'])
+        devices = self.client.get('/devices/list', query_string={'user': 'Nikolay'}).get_json()['devices']
+        self.assertEqual(['Device2'], [device['name'] for device in devices])
+        self.assertEqual({}, dict(self.engine.waiters))
+
+    def test_single_process(self):
+        with self.assertRaises(state.StateEngineError):
+            state.Journal(self.journal_path)
+
+    def test_journal_rewritten_under_load(self):
+        self.engine.journal_max_bytes = 0
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        write_entries = state.write_entries
+
+        def write_and_commit(*args):
+            # Another change is committed while the first one is flushed, the journal is never empty
+            write_entries(*args)
+            self.client.post('/devices/release', json={'device': 'Device1'})
+        with patch.object(state, 'write_entries', write_and_commit):
+            self.engine.flush()
+
+        self.assertEqual([2], [entry['revision'] for entry in self.engine.journal.read()])
+        self.client.post('/devices/add', json={'device': 'Device3', 'model': 'Model3'})
+        self.assertEqual([2, 3], [entry['revision'] for entry in self.engine.journal.read()])
+        self.engine.flush()
+        self.assertEqual(0, os.path.getsize(self.journal_path))
+
+
+class TestReadCache(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model1'})
+        self.read_cache = app.extensions[cache.EXTENSION]
+
+    def change_in_other_worker(self, operation, *args):
+        # Another worker shares the database, but not the cache
+        with app.app_context():
+            operation(*args)
+            db.session.commit()
+
+    def test_list_cached(self):
+        first = self.client.get('/devices/list', query_string={'model': 'Model1', 'sort': 'name'})
+        hits = self.read_cache.get_stats().get('list_hits', 0)
+        second = self.client.get('/devices/list', query_string={'sort': 'name', 'model': 'Model1'})
+        self.assertEqual(hits + 1, self.read_cache.get_stats()['list_hits'])
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers.get('ETag'), second.headers.get('ETag'))
+        self.assertEqual('application/json', second.mimetype)
+
+    def test_list_invalidated_by_other_worker(self):
+        self.client.get('/devices/list')
+        self.change_in_other_worker(operations.reserve, 'Device1', 'Nikolay')
+        devices = self.client.get('/devices/list').get_json()['devices']
+        self.assertEqual('Nikolay', devices[0]['user'])
+
+        self.change_in_other_worker(operations.delete, 'Device1')
+        self.change_in_other_worker(operations.delete, 'Device2')
+        response = self.client.get('/devices/list')
+        self.assertEqual(HTTPStatus.NO_CONTENT, response.status_code)
+
+    def test_batch_lookups(self):
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'reserve', 'device': 'Device1', 'username': 'Nikolay'},
+            {'action': 'release', 'device': 'Device2'},
+            {'action': 'reserve', 'device': 'Device3', 'username': 'Nikolay'},
+        ], 'mode': 'best_effort'})
+        self.assertEqual([200, 304, 404], [result['status'] for result in response.get_json()['results']])
+
+        self.change_in_other_worker(operations.add, 'Device3', 'Model3')
+        self.change_in_other_worker(operations.delete, 'Device1')
+        hits = self.read_cache.get_stats()['device_hits']
+        response = self.client.post('/devices/batch', json={'operations': [
+            {'action': 'release', 'device': 'Device1'},
+            {'action': 'reserve', 'device': 'Device2', 'username': 'Nikolay'},
+            {'action': 'reserve', 'device': 'Device3', 'username': 'Nikolay'},
+        ], 'mode': 'best_effort'})
+        self.assertEqual([404, 200, 200], [result['status'] for result in response.get_json()['results']])
+        # Only the devices changed by the other worker were read again
+        self.assertEqual(hits + 1, self.read_cache.get_stats()['device_hits'])
+
+
+class TestLeases(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model1'})
+        self.scheduler = app.extensions[leases.EXTENSION]
+
+    def get_device(self, name):
+        with app.app_context():
+            return Device.query.filter_by(name=name).first()
+
+    def last_event(self):
+        with app.app_context():
+            return DeviceEvent.query.order_by(DeviceEvent.revision.desc()).first()
+
+    def later(self, seconds):
+        return datetime.utcnow() + timedelta(seconds=seconds)
+
+    def test_reserve_with_lease(self):
+        response = self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay',
+                                                              'lease': 60})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        lease_expires = datetime.fromisoformat(response.get_json()['lease_expires'])
+        self.assertEqual(lease_expires, self.get_device('Device1').lease_expires)
+        self.assertEqual(response.get_json()['lease_expires'],
+                         self.client.get('/devices/list').get_json()['devices'][0]['lease_expires'])
+
+        self.client.post('/devices/release', json={'device': 'Device1'})
+        self.assertIsNone(self.get_device('Device1').lease_expires)
+
+    def test_reserve_invalid_lease(self):
+        for lease in [-1, 'forever', leases.MAX_LEASE + 1]:
+            response = self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay',
+                                                                  'lease': lease})
+            self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        self.assertEqual('free', self.get_device('Device1').status)
+
+    def test_expire(self):
+        response = self.client.post('/devices/reserve_any', json={'model': 'Model1', 'username': 'Nikolay',
+                                                                  'count': 2, 'lease': 1})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertIn('lease_expires', response.get_json())
+
+        self.assertEqual(['Device1', 'Device2'], self.scheduler.expire_due(self.later(2)))
+        device = self.get_device('Device1')
+        self.assertEqual('free', device.status)
+        self.assertIsNone(device.user)
+        self.assertIsNone(device.lease_expires)
+        self.assertEqual('expire', self.last_event().action)
+        self.assertEqual([], self.scheduler.expire_due(self.later(2)))
+
+    def test_renew(self):
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay', 'lease': 1})
+        response = self.client.post('/devices/renew', json={'device': 'Device1', 'username': 'Other', 'lease': 60})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertEqual('Nikolay', response.get_json()['reserved_by'])
+        response = self.client.post('/devices/renew', json={'device': 'Device2', 'username': 'Nikolay',
+                                                            'lease': 60})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        response = self.client.post('/devices/renew', json={'device': 'Device1', 'username': 'Nikolay',
+                                                            'lease': 60})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual('renew', self.last_event().action)
+
+        # The old deadline is a stale entry of the heap, the device is scheduled again with the new one
+        self.assertEqual([], self.scheduler.expire_due(self.later(2)))
+        self.assertEqual('reserved', self.get_device('Device1').status)
+        self.assertEqual(['Device1'], self.scheduler.expire_due(self.later(61)))
+
+    def test_scheduler_thread(self):
+        self.scheduler.ensure_started()
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay', 'lease': 0.2})
+        for _ in range(100):
+            if self.get_device('Device1').status == 'free':
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual('free', self.get_device('Device1').status)
+
+
+class TestWaitQueue(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['RESERVE_POLL_INTERVAL'] = 0.01
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.client.post('/devices/add', json={'device': 'Device2', 'model': 'Model1'})
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Owner'})
+        self.client.post('/devices/offline', json={'device': 'Device2'})
+
+    def tearDown(self):
+        app.config.pop('RESERVE_POLL_INTERVAL')
+        super().tearDown()
+
+    def get_device(self, name):
+        with app.app_context():
+            return Device.query.filter_by(name=name).first()
+
+    def start_waiter(self, username, url='/devices/reserve?wait=5s', payload=None):
+        # Returns the thread and the dict it stores the response in, once the waiter is in the queue
+        result = {}
+        with app.app_context():
+            waiters = ReservationWaiter.query.count()
+
+        def wait():
+            response = app.test_client().post(url, json=payload or {'device': 'Device1', 'username': username})
+            result['status'] = response.status_code
+            result['body'] = response.get_json()
+        thread = threading.Thread(target=wait)
+        thread.start()
+        for _ in range(500):
+            with app.app_context():
+                if ReservationWaiter.query.count() > waiters:
+                    break
+            threading.Event().wait(0.01)
+        return thread, result
+
+    def test_handoff_on_release_in_order(self):
+        first, first_result = self.start_waiter('First')
+        second, second_result = self.start_waiter('Second')
+
+        self.client.post('/devices/release', json={'device': 'Device1'})
+        first.join()
+        self.assertEqual(HTTPStatus.OK, first_result['status'])
+        self.assertEqual('First', self.get_device('Device1').user)
+        self.assertNotIn('status', second_result)
+
+        self.client.post('/devices/release', json={'device': 'Device1'})
+        second.join()
+        self.assertEqual(HTTPStatus.OK, second_result['status'])
+        self.assertEqual('Second', self.get_device('Device1').user)
+        with app.app_context():
+            self.assertEqual(0, ReservationWaiter.query.count())
+            self.assertEqual(['release', 'reserve'], [event.action for event in DeviceEvent.query.order_by(
+                DeviceEvent.revision.desc()).limit(2).all()][::-1])
+
+    def test_handoff_with_lease(self):
+        waiter, result = self.start_waiter('Nikolay', payload={'device': 'Device1', 'username': 'Nikolay',
+                                                               'lease': 60})
+        self.client.post('/devices/release', json={'device': 'Device1'})
+        waiter.join()
+        self.assertEqual(HTTPStatus.OK, result['status'])
+        self.assertEqual(datetime.fromisoformat(result['body']['lease_expires']),
+                         self.get_device('Device1').lease_expires)
+
+    def test_wait_for_model(self):
+        waiter, result = self.start_waiter('Nikolay', url='/devices/reserve_any?wait=5',
+                                           payload={'model': 'Model1', 'username': 'Nikolay'})
+        self.client.post('/devices/online', json={'device': 'Device2'})
+        waiter.join()
+        self.assertEqual(HTTPStatus.OK, result['status'])
+        self.assertEqual(['Device2'], result['body']['devices'])
+        self.assertEqual('Nikolay', self.get_device('Device2').user)
+
+    def test_wait_timeout(self):
+        response = self.client.post('/devices/reserve?wait=0.1', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+        self.assertEqual('Owner', response.get_json()['reserved_by'])
+        with app.app_context():
+            self.assertEqual(0, ReservationWaiter.query.count())
+
+    def test_too_many_waiters(self):
+        slots = app.extensions[WAITERS_EXTENSION]
+        app.extensions[WAITERS_EXTENSION] = events.RequestSlots(1)
+        try:
+            waiter, result = self.start_waiter('First')
+            started = time.monotonic()
+            response = self.client.post('/devices/reserve?wait=5', json={'device': 'Device1', 'username': 'Second'})
+            self.assertEqual(HTTPStatus.CONFLICT, response.status_code)
+            self.assertLess(time.monotonic() - started, 1)
+
+            self.client.post('/devices/release', json={'device': 'Device1'})
+            waiter.join()
+            self.assertEqual(HTTPStatus.OK, result['status'])
+            self.assertEqual(0, app.extensions[WAITERS_EXTENSION].used)
+        finally:
+            app.extensions[WAITERS_EXTENSION] = slots
+
+    def test_invalid_wait(self):
+        response = self.client.post('/devices/reserve?wait=soon', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+        response = self.client.post('/devices/reserve_any?wait=5', json={'model': 'Model1', 'username': 'Nikolay',
+                                                                         'count': 2})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+
+
+class TestStorageProfile(unittest.TestCase):
+
+    def test_default_profile(self):
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertEqual({}, storage.load_profile())
+
+    def test_production_profile_with_overrides(self):
+        with patch.dict(os.environ, {'DB_PROFILE': 'production', 'DB_BUSY_TIMEOUT': '100', 'DB_POOL_SIZE': '3'}):
+            settings = storage.load_profile()
+        self.assertEqual('WAL', settings['journal_mode'])
+        self.assertEqual(100, settings['busy_timeout'])
+        self.assertEqual({'pool_size': 3, 'max_overflow': 30, 'pool_timeout': 10}, storage.engine_options(settings))
+
+    def test_invalid_profile(self):
+        with patch.dict(os.environ, {'DB_PROFILE': 'turbo'}):
+            self.assertIsNone(storage.load_profile())
+        with patch.dict(os.environ, {'DB_PROFILE': 'production', 'DB_MMAP_SIZE': 'big'}):
+            self.assertIsNone(storage.load_profile())
+
+    def test_pragmas_applied(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            engine = create_engine(f"sqlite:///{os.path.join(db_dir, 'test.db')}")
+            storage.register_pragmas(engine, {'journal_mode': 'WAL', 'busy_timeout': 1234, 'synchronous': 'NORMAL'})
+            with engine.connect() as connection:
+                self.assertEqual('wal', connection.exec_driver_sql('PRAGMA journal_mode').scalar())
+                self.assertEqual(1234, connection.exec_driver_sql('PRAGMA busy_timeout').scalar())
+                self.assertEqual(1, connection.exec_driver_sql('PRAGMA synchronous').scalar())
+            engine.dispose()
+
+
+class TestAsgi(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.config['EVENTS_POLL_INTERVAL'] = 0.01
+
+    def tearDown(self):
+        app.config.pop('EVENTS_POLL_INTERVAL', None)
+        super().tearDown()
+
+    async def call(self, asgi_app, path, query_string=b''):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': [],
+                 'root_path': ''}
+        request_messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        response = {'body': b''}
+
+        async def receive():
+            return request_messages.pop() if request_messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            else:
+                response['body'] += message.get('body', b'')
+
+        await asgi_app(scope, receive, send)
+        return response['status'], json.loads(response['body'])
+
+    def test_long_polls_wait_on_the_loop(self):
+        # Many more waiting requests than threads
+        asgi_app = asgi.AsgiApp(app, threads=2)
+
+        async def run():
+            add = asyncio.get_running_loop().run_in_executor(
+                None, lambda: time.sleep(0.2) or app.test_client().post('/devices/add', json={'device': 'Device1',
+                                                                                                 'model': 'Model1'}))
+            responses = await asyncio.gather(*[self.call(asgi_app, '/devices/changes', b'since=0&wait=10')
+                                               for _ in range(200)])
+            await add
+            return responses
+
+        started = time.monotonic()
+        try:
+            responses = asyncio.run(run())
+        finally:
+            asgi_app.executor.shutdown()
+        self.assertLess(time.monotonic() - started, 5)
+        for status, body in responses:
+            self.assertEqual(HTTPStatus.OK, status)
+            self.assertEqual(1, body['revision'])
+            self.assertEqual(['Device1'], [device['name'] for device in body['devices']])
+
+    def test_streamed_response_leaves_no_context(self):
+        # The chunks of a streamed response are generated by any thread of the pool
+        with app.app_context():
+            db.session.add_all([Device(name=f'Device{i}', model='Model1', status='free') for i in range(5)])
+            db.session.commit()
+        app.config['LIST_STREAM_CHUNK_SIZE'] = 1
+        asgi_app = asgi.AsgiApp(app, threads=2)
+        both_threads = threading.Barrier(2)
+
+        def flask_context_pushed():
+            both_threads.wait(5)
+            return has_app_context()
+
+        async def run():
+            for _ in range(5):
+                status, body = await self.call(asgi_app, '/devices/list', b'stream=true')
+                self.assertEqual(HTTPStatus.OK, status)
+                self.assertEqual(5, len(body['devices']))
+            return await asyncio.gather(asgi_app.run(flask_context_pushed), asgi_app.run(flask_context_pushed))
+
+        try:
+            self.assertEqual([False, False], asyncio.run(run()))
+        finally:
+            app.config.pop('LIST_STREAM_CHUNK_SIZE', None)
+            asgi_app.executor.shutdown()
+
+    def test_long_poll_timeout_and_errors(self):
+        asgi_app = asgi.AsgiApp(app, threads=2)
+        try:
+            self.assertEqual((HTTPStatus.OK, {'revision': 0, 'devices': [], 'deleted': []}),
+                             asyncio.run(self.call(asgi_app, '/devices/changes', b'since=0&wait=0.05')))
+            self.assertEqual((HTTPStatus.BAD_REQUEST, {'message': 'Invalid since or wait value'}),
+                             asyncio.run(self.call(asgi_app, '/devices/changes', b'since=0&wait=abc')))
+        finally:
+            asgi_app.executor.shutdown()
+
+    @unittest.skipIf(asyncdb.aiosqlite is None, 'aiosqlite is not installed')
+    def test_reads_without_threads(self):
+        asgi_app = asgi.AsgiApp(app, threads=1)
+        self.assertIsInstance(asgi_app.reader, asyncdb.AsyncReader)
+        busy = threading.Event()
+        # The only thread of the pool is taken
+        asgi_app.executor.submit(busy.wait, 10)
+        try:
+            self.assertEqual((HTTPStatus.OK, {'revision': 0, 'devices': [], 'deleted': []}),
+                             asyncio.run(self.call(asgi_app, '/devices/changes', b'since=0&wait=0.05')))
+        finally:
+            busy.set()
+            asgi_app.executor.shutdown()
+
+    def test_thread_reads_without_aiosqlite(self):
+        with patch.object(asyncdb, 'aiosqlite', None):
+            asgi_app = asgi.AsgiApp(app, threads=2)
+        self.assertIsInstance(asgi_app.reader, asyncdb.ThreadReader)
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        try:
+            status, body = asyncio.run(self.call(asgi_app, '/devices/changes', b'since=0'))
+        finally:
+            asgi_app.executor.shutdown()
+        self.assertEqual(HTTPStatus.OK, status)
+        self.assertEqual(['Device1'], [device['name'] for device in body['devices']])
+
+    def test_native_requests_through_flask_hooks(self):
+        app.extensions[metrics.EXTENSION].values.clear()
+        client = asgiclient.AsgiTestClient(app)
+        headers = {'X-Request-ID': 'abc123', 'Origin': 'http://dashboard.example'}
+        response = client.get('/devices/changes?since=0', headers=headers)
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual('abc123', response.headers['X-Request-ID'])
+        self.assertIn('X-Fleet-Revision', response.headers['Access-Control-Expose-Headers'])
+        response = client.get('/devices/events', headers=headers)
+        try:
+            self.assertEqual('abc123', response.headers['X-Request-ID'])
+            # The CORS settings of the app, not a wildcard of its own
+            self.assertEqual('http://dashboard.example', response.headers['Access-Control-Allow-Origin'])
+            self.assertTrue(next(response.iter_encoded()).decode().startswith('retry: '))
+        finally:
+            response.close()
+        lines = client.get('/metrics').get_data(as_text=True).splitlines()
+        for route in ['/devices/changes', '/devices/events']:
+            self.assertIn(f'devmate_http_requests_total{{route="{route}",method="GET",status="200"}} 1', lines)
+
+    def test_routes_through_flask(self):
+        client = asgiclient.AsgiTestClient(app)
+        response = client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'},
+                               headers={'X-Request-ID': 'abc123'})
+        self.assertEqual(HTTPStatus.CREATED, response.status_code)
+        self.assertEqual('abc123', response.headers['X-Request-ID'])
+        response = client.get('/devices/list')
+        self.assertEqual(['Device1'], [device['name'] for device in response.get_json()['devices']])
+
+    def test_events_stream(self):
+        client = asgiclient.AsgiTestClient(app)
+        response = client.get('/devices/events')
+        self.assertEqual('text/event-stream', response.mimetype)
+        chunks = response.iter_encoded()
+        try:
+            self.assertTrue(next(chunks).decode().startswith('retry: '))
+            self.assertEqual('id: 0\nevent: reset\ndata: {"revision": 0}\n\n', next(chunks).decode())
+            client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+            self.assertTrue(next(chunks).decode().startswith('id: 1\nevent: add\ndata: '))
+        finally:
+            response.close()
+
+
+class TestMetrics(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        app.extensions[metrics.EXTENSION].values.clear()
+
+    def test_request_metrics(self):
+        with app.app_context():
+            db.session.add(Device(name='Device1', model='Model1', status='free'))
+            db.session.add(Device(name='Device2', model='Model1', status='free'))
+            db.session.commit()
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.post('/devices/reserve', json={'device': 'Device1', 'username': 'Nikolay'})
+        self.client.get('/devices/no_such_route')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('devmate_http_requests_total{route="/devices/reserve",method="POST",status="200"} 1', lines)
+        self.assertIn('devmate_http_requests_total{route="/devices/reserve",method="POST",status="409"} 1', lines)
+        self.assertIn('devmate_http_requests_total{route="unmatched",method="GET",status="404"} 1', lines)
+        self.assertIn(
+            'devmate_http_request_duration_seconds_bucket{route="/devices/reserve",method="POST",le="+Inf"} 2', lines)
+        self.assertIn('devmate_devices{status="reserved"} 1', lines)
+        self.assertIn('devmate_devices{status="free"} 1', lines)
+        self.assertIn('devmate_devices{status="offline"} 0', lines)
+        self.assertIn('devmate_reservations{model="Model1"} 1', lines)
+        queries = [line for line in lines
+                   if line.startswith('devmate_db_queries_per_request_sum{route="/devices/reserve"')]
+        self.assertGreater(float(queries[0].split()[-1]), 0)
+
+    def test_workers_add_up(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            worker = metrics.Metrics(metrics_dir)
+            worker.observe_request('/devices/list', 'GET', 200, 0.002, 1, 0.001)
+            other_worker = metrics.Metrics(metrics_dir)
+            other_worker.observe_request('/devices/list', 'GET', 200, 0.3, 2, 0.1)
+            other_worker.observe_request('/devices/list', 'GET', 500, 0.004, 0, 0.0)
+            with patch('os.getpid', return_value=1):
+                other_worker.flush()
+            # A file of a previous run of the server
+            with open(os.path.join(metrics_dir, 'worker-0-1.json'), 'w') as f:
+                json.dump(worker.snapshot(), f)
+
+            values = worker.collect()
+        labels = (('route', '/devices/list'), ('method', 'GET'))
+        self.assertEqual(2, values[('devmate_http_requests_total', labels + (('status', '200'),))])
+        self.assertEqual(1, values[('devmate_http_requests_total', labels + (('status', '500'),))])
+        histogram = values[('devmate_http_request_duration_seconds', labels)]
+        self.assertEqual(3, sum(histogram[:-1]))
+        self.assertAlmostEqual(0.306, histogram[-1])
+        text = metrics.exposition(values, {})
+        self.assertIn('devmate_http_request_duration_seconds_bucket{route="/devices/list",method="GET",le="0.005"} 2',
+                      text)
+        self.assertIn('devmate_http_request_duration_seconds_count{route="/devices/list",method="GET"} 3', text)
+
+
+def busy_handler():
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    return 'done'
+
+
+class TestProfiler(unittest.TestCase):
+
+    def create_app(self, environment, profiles_dir):
+        test_app = type(app)('profiler-test')
+        test_app.add_url_rule('/busy', 'busy', busy_handler)
+        with patch.dict(os.environ, environment):
+            self.assertTrue(profiler.init_profiler(test_app, profiles_dir))
+        return test_app
+
+    def test_disabled_by_default(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            test_app = self.create_app({}, profiles_dir)
+            self.assertEqual({}, test_app.before_request_funcs)
+            self.assertEqual([], os.listdir(profiles_dir))
+
+    def test_inline_sample(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            client = self.create_app({'PROFILER_TOKEN': 'secret'}, profiles_dir).test_client()
+            response = client.get('/busy?profile_output=inline', headers={'X-Devmate-Profile': 'wrong'})
+            self.assertEqual('done', response.get_data(as_text=True))
+            # The token would be logged with the query
+            self.assertEqual('done', client.get('/busy?profile=secret&profile_output=inline').get_data(as_text=True))
+            response = client.get('/busy?profile_output=inline', headers={'X-Devmate-Profile': 'secret'})
+            self.assertEqual('200', response.headers['X-Devmate-Profiled-Status'])
+            stacks = response.get_data(as_text=True).splitlines()
+            self.assertTrue(any('busy_handler' in line for line in stacks))
+            self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+    def test_every_nth_request_to_file(self):
+        with tempfile.TemporaryDirectory() as profiles_dir:
+            client = self.create_app({'PROFILER_EVERY_N': '2', 'PROFILER_MODE': 'cprofile',
+                                      'PROFILER_DIR': profiles_dir}, profiles_dir).test_client()
+            self.assertNotIn('X-Devmate-Profile-File', client.get('/busy').headers)
+            name = client.get('/busy').headers['X-Devmate-Profile-File']
+            self.assertEqual([name], os.listdir(profiles_dir))
+            stats = pstats.Stats(os.path.join(profiles_dir, name))
+            self.assertTrue(any(function == 'busy_handler' for _, _, function in stats.stats))
+
+    def test_failed_request(self):
+        def failing_handler():
+            busy_handler()
+            raise RuntimeError('failed')
+
+        for mode in profiler.MODES:
+            with tempfile.TemporaryDirectory() as profiles_dir:
+                test_app = self.create_app({'PROFILER_TOKEN': 'secret', 'PROFILER_MODE': mode,
+                                            'PROFILER_DIR': profiles_dir}, profiles_dir)
+                test_app.add_url_rule('/fail', 'fail', failing_handler)
+                # The after_request functions are skipped
+                test_app.config['PROPAGATE_EXCEPTIONS'] = True
+                client = test_app.test_client()
+                threads = threading.active_count()
+                with self.assertRaises(RuntimeError):
+                    client.get('/fail', headers={'X-Devmate-Profile': 'secret'})
+                self.assertEqual(threads, threading.active_count())
+                self.assertEqual(1, len(os.listdir(profiles_dir)))
+                # The profiler is free for the next request
+                response = client.get('/busy', headers={'X-Devmate-Profile': 'secret'})
+                self.assertIn('X-Devmate-Profile-File', response.headers)
+
+    def test_invalid_mode(self):
+        with patch.dict(os.environ, {'PROFILER_MODE': 'magic'}):
+            self.assertIsNone(profiler.load_settings())
+
+
+class RecordCollector(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestRequestLogging(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.collector = RecordCollector()
+        self.collector.addFilter(logs.RequestIdFilter())
+        logging.getLogger('devmate').addHandler(self.collector)
+
+    def tearDown(self):
+        logging.getLogger('devmate').removeHandler(self.collector)
+        super().tearDown()
+
+    def request_records(self):
+        return [record for record in self.collector.records if record.name == 'devmate.request']
+
+    def test_request_id(self):
+        response = self.client.get('/devices/list', headers={'X-Request-ID': 'abc123'})
+        self.assertEqual('abc123', response.headers['X-Request-ID'])
+        record = self.request_records()[-1]
+        self.assertEqual('abc123', record.request_id)
+        self.assertEqual('/devices/list', record.path)
+        self.assertEqual(response.status_code, record.status)
+        self.assertGreaterEqual(record.duration_ms, 0)
+
+        # Generated when the client doesn't send one
+        response = self.client.get('/devices/list')
+        self.assertEqual(32, len(response.headers['X-Request-ID']))
+        self.assertEqual(response.headers['X-Request-ID'], self.request_records()[-1].request_id)
+
+    def test_application_records_have_request_id(self):
+        self.client.post('/devices/add', json={'device': '', 'model': 'Model1'}, headers={'X-Request-ID': 'bad1'})
+        records = [record for record in self.collector.records if record.levelno == logging.ERROR]
+        self.assertTrue(records)
+        self.assertTrue(all(record.request_id == 'bad1' for record in records))
+
+    def test_body_not_logged_by_default(self):
+        self.client.post('/devices/add', json={'device': 'Device1', 'model': 'Model1'})
+        self.assertFalse(hasattr(self.request_records()[-1], 'body'))
+
+    def test_body_logged_when_enabled(self):
+        settings = dict(logs.DEFAULT_SETTINGS, LOG_REQUEST_BODY=True)
+        test_app = type(app)('logging-test')
+        logs.init_request_logging(test_app, settings)
+        test_app.add_url_rule('/echo', 'echo', lambda: 'ok', methods=['POST'])
+        test_app.test_client().post('/echo', json={'device': 'Device1'})
+        self.assertEqual({'device': 'Device1'}, self.request_records()[-1].body)
+
+
+class TestLogPipeline(unittest.TestCase):
+
+    def test_load_settings(self):
+        with patch.dict(os.environ, {'LOG_LEVEL': 'info', 'LOG_ASYNC': '0', 'LOG_SAMPLE_RATE': '0.5'}):
+            settings = logs.load_settings()
+        self.assertEqual('INFO', settings['LOG_LEVEL'])
+        self.assertFalse(settings['LOG_ASYNC'])
+        self.assertEqual(0.5, settings['LOG_SAMPLE_RATE'])
+        for invalid in [{'LOG_LEVEL': 'LOUD'}, {'LOG_FORMAT': 'xml'}, {'LOG_QUEUE_SIZE': 'many'}]:
+            with patch.dict(os.environ, invalid):
+                self.assertIsNone(logs.load_settings())
+
+    def test_json_format(self):
+        record = logging.LogRecord('devmate.request', logging.INFO, __file__, 1, 'GET %s', ('/health',), None)
+        record.request_id = 'abc123'
+        record.duration_ms = 1.5
+        entry = json.loads(logs.JsonFormatter().format(record))
+        self.assertEqual('INFO', entry['level'])
+        self.assertEqual('GET /health', entry['message'])
+        self.assertEqual('abc123', entry['request_id'])
+        self.assertEqual(1.5, entry['duration_ms'])
+        self.assertNotIn('args', entry)
+
+    def test_full_queue_drops_records(self):
+        handler = logs.NonBlockingQueueHandler(queue.Queue(2))
+        test_logger = logging.getLogger('devmate.tests.queue')
+        test_logger.addHandler(handler)
+        test_logger.propagate = False
+        try:
+            for i in range(5):
+                test_logger.warning('record %d', i)
+        finally:
+            test_logger.removeHandler(handler)
+            test_logger.propagate = True
+        self.assertEqual(3, handler.dropped)
+        self.assertEqual('record 0', handler.queue.get_nowait().msg)
+
+    def test_listener_writes_file(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            settings = dict(logs.DEFAULT_SETTINGS, LOG_FILE=os.path.join(log_dir, 'test.log'))
+            pipeline = logs.LogPipeline(settings)
+            try:
+                logging.getLogger('devmate.tests.pipeline').info('written', extra={'status': 200})
+            finally:
+                pipeline.stop()
+            with open(settings['LOG_FILE']) as f:
+                entries = [json.loads(line) for line in f]
+        self.assertIn({'message': 'written', 'status': 200},
+                      [{'message': entry['message'], 'status': entry.get('status')} for entry in entries])
+
+    def test_forked_process_has_own_queue(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            settings = dict(logs.DEFAULT_SETTINGS, LOG_FILE=os.path.join(log_dir, 'test.log'))
+            pipeline = logs.LogPipeline(settings)
+            try:
+                parent_queue = pipeline.handler.queue
+                pid = os.fork()
+                if pid == 0:
+                    # The child must not touch the queue of the parent
+                    own_queue = pipeline.handler.queue is not parent_queue and pipeline.listener._thread is not None
+                    logging.getLogger('devmate.tests.pipeline').info('from the child')
+                    pipeline.stop()
+                    os._exit(0 if own_queue else 1)
+                _, status = os.waitpid(pid, 0)
+            finally:
+                pipeline.stop()
+            with open(settings['LOG_FILE']) as f:
+                messages = [json.loads(line)['message'] for line in f]
+        self.assertEqual(0, os.waitstatus_to_exitcode(status))
+        self.assertIn('from the child', messages)
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def test_fingerprint(self):
+        first = slowlog.normalize("SELECT * FROM device WHERE name IN (?, ?, ?) AND status = 'free' LIMIT 10")
+        second = slowlog.normalize("SELECT *  FROM device\nWHERE name IN (?) AND status = 'reserved' LIMIT 5")
+        self.assertEqual('SELECT * FROM device WHERE name IN (...) AND status = ? LIMIT ?', first)
+        self.assertEqual(slowlog.fingerprint(first), slowlog.fingerprint(second))
+
+    def test_slow_statements_logged(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            engine = create_engine(f"sqlite:///{os.path.join(work_dir, 'test.db')}")
+            log_file = os.path.join(work_dir, 'slow.log')
+            slow_log = slowlog.SlowQueryLog(0, log_file)
+            slow_log.register(engine)
+            try:
+                with engine.begin() as connection:
+                    connection.exec_driver_sql('CREATE TABLE device (name TEXT, status TEXT)')
+                    connection.exec_driver_sql('CREATE INDEX ix_status ON device (status)')
+                    connection.exec_driver_sql('INSERT INTO device VALUES (?, ?)', [('a', 'free'), ('b', 'free')])
+                    for name in ['a', 'b']:
+                        connection.exec_driver_sql('SELECT * FROM device WHERE name = ?', (name,)).all()
+                    connection.exec_driver_sql('SELECT * FROM device WHERE status = ?', ('free',)).all()
+            finally:
+                slow_log.close()
+                engine.dispose()
+            with open(log_file) as f:
+                records = [json.loads(line) for line in f]
+
+        lookups = [record for record in records if record['statement'] == 'SELECT * FROM device WHERE name = ?']
+        self.assertEqual(2, len(lookups))
+        self.assertEqual(['SCAN device'], lookups[0]['plan'])
+        # The plan is read once per fingerprint
+        self.assertNotIn('plan', lookups[1])
+        self.assertEqual(['str'], lookups[1]['parameters'])
+        self.assertEqual(2, lookups[1]['totals']['count'])
+        self.assertEqual('thread MainThread', lookups[1]['source'])
+        scan = [record for record in records if record['statement'] == 'SELECT * FROM device WHERE status = ?']
+        self.assertIn('USING INDEX ix_status', scan[0]['plan'][0])
+        insert = [record for record in records if record['statement'].startswith('INSERT')]
+        self.assertEqual({'rows': 2, 'row': ['str', 'str']}, insert[0]['parameters'])
+
+        summary = slow_log.summary()
+        entries = {entry['fingerprint']: entry for entry in summary}
+        self.assertEqual(2, entries[lookups[0]['fingerprint']]['count'])
+
+    def test_log_next_to_app_log(self):
+        with tempfile.TemporaryDirectory() as log_dir, patch.dict(os.environ, {'SLOW_QUERY_MS': '0'}):
+            os.environ.pop('SLOW_QUERY_LOG', None)
+            os.environ['LOG_FILE'] = os.path.join(log_dir, 'devmate.log')
+            test_app = Flask(__name__)
+            engine = create_engine('sqlite://')
+            self.assertTrue(slowlog.init_slow_query_log(test_app, engine))
+            slow_log = test_app.extensions[slowlog.EXTENSION]
+            try:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('SELECT 1').all()
+            finally:
+                slow_log.close()
+                engine.dispose()
+            with open(os.path.join(log_dir, slowlog.DEFAULT_LOG_FILE)) as f:
+                self.assertEqual('SELECT ?', json.loads(f.readline())['statement'])
+
+
+class TestReady(BaseTestCase):
+
+    def test_ready(self):
+        response = self.client.get('/ready')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(os.getpid(), response.get_json()['pid'])
+        self.assertTrue(startup.is_warm(app))
+
+    def test_not_ready_without_database(self):
+        with app.app_context():
+            db.drop_all()
+        response = self.client.get('/ready')
+        self.assertEqual(HTTPStatus.SERVICE_UNAVAILABLE, response.status_code)
+
+
+class TestStartup(unittest.TestCase):
+
+    def prepare(self, work_dir, setup_sql=None):
+        # A separate app on its own database, the schema is prepared as with DB_SCHEMA=migrate
+        db_path = os.path.join(work_dir, 'devices.db')
+        if setup_sql:
+            with sqlite3.connect(db_path) as connection:
+                connection.executescript(setup_sql)
+        schema_app = Flask(__name__)
+        schema_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+        db.init_app(schema_app)
+        with schema_app.app_context():
+            try:
+                startup.prepare_schema(schema_app, work_dir, 'migrate')
+                # A second start finds the schema up to date
+                startup.prepare_schema(schema_app, work_dir, 'migrate')
+            finally:
+                db.engine.dispose()
+        with sqlite3.connect(db_path) as connection:
+            version = connection.execute('SELECT version_num FROM alembic_version').fetchall()
+            revision = connection.execute('SELECT revision FROM fleet_revision').fetchall()
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(device)')]
+        return version, revision, columns
+
+    def test_new_database(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            version, revision, columns = self.prepare(work_dir)
+        self.assertEqual([('a7c3e9f15d62',)], version)
+        self.assertEqual([(0,)], revision)
+        self.assertIn('lease_expires', columns)
+
+    def test_database_before_migrations(self):
+        # The device table of the first version, created by create_all
+        with tempfile.TemporaryDirectory() as work_dir:
+            version, revision, columns = self.prepare(work_dir, '''
+                CREATE TABLE device (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(50) NOT NULL UNIQUE,
+                                     model VARCHAR(50) NOT NULL, status VARCHAR(8) NOT NULL, user VARCHAR(50),
+                                     reservation_time DATETIME, info VARCHAR(100));
+                INSERT INTO device (name, model, status) VALUES ('device1', 'model1', 'free');
+            ''')
+        self.assertEqual([('a7c3e9f15d62',)], version)
+        self.assertIn('lease_expires', columns)
+
+    def test_migrations_not_imported(self):
+        # The server doesn't import alembic unless it migrates the schema
+        code = "import sys; from devmateback.app import app; print('alembic' in sys.modules)"
+        with tempfile.TemporaryDirectory() as work_dir:
+            env = dict(os.environ, DB_DIR=work_dir, LOG_FILE=os.path.join(work_dir, 'devmate.log'),
+                       SLOW_QUERY_LOG=os.path.join(work_dir, 'slow.log'))
+            env.pop('DB_SCHEMA', None)
+            output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual('False', output.stdout.strip(), output.stderr)
+
+
+class TestCliDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.cli_dir = tempfile.TemporaryDirectory()
+        self.binaries = {}
+        for platform in artifacts.PLATFORMS:
+            os.makedirs(os.path.join(self.cli_dir.name, f'devmatecli-{platform}-latest'))
+            self.write_binary(platform, os.urandom(4096))
+        self.saved = app.config.get('CLI_BINARY_PATH'), app.extensions.get(artifacts.EXTENSION)
+        app.config['CLI_BINARY_PATH'] = self.cli_dir.name
+        artifacts.init_artifact_index(app, self.cli_dir.name)
+        for platform in artifacts.PLATFORMS:
+            self.prepared(platform)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        # Not while the files of the binaries are being written
+        for artifact in list(app.extensions[artifacts.EXTENSION].artifacts.values()):
+            artifact.ready.wait(10)
+        app.config['CLI_BINARY_PATH'], app.extensions[artifacts.EXTENSION] = self.saved
+        self.cli_dir.cleanup()
+
+    def write_binary(self, platform, content):
+        with open(artifacts.artifact_path(self.cli_dir.name, platform), 'wb') as f:
+            f.write(content)
+        self.binaries[platform] = content
+
+    def prepared(self, platform):
+        # Waits for the compressed variants and the deltas of the binary, made in the background
+        artifact = app.extensions[artifacts.EXTENSION].get(platform)
+        self.assertTrue(artifact.ready.wait(10))
+        return artifact
+
+    def test_download(self):
+        response = self.client.get('/cli/get?platform=windows')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(self.binaries['windows'], response.get_data())
+        self.assertEqual(f'"{hashlib.sha256(self.binaries["windows"]).hexdigest()}"', response.headers['ETag'])
+        self.assertIn('devmate.exe', response.headers['Content-Disposition'])
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+    def test_platform_from_user_agent(self):
+        response = self.client.get('/cli/get', headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)'})
+        self.assertEqual(self.binaries['linux'], response.get_data())
+        response = self.client.get('/cli/get', headers={'User-Agent': 'curl/8.0'})
+        self.assertEqual(HTTPStatus.BAD_REQUEST, response.status_code)
+
+    def test_not_modified(self):
+        etag = self.client.get('/cli/get?platform=linux').headers['ETag']
+        response = self.client.get('/cli/get?platform=linux', headers={'If-None-Match': etag})
+        self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+        self.assertEqual(b'', response.get_data())
+
+    def test_resumed_download(self):
+        etag = self.client.get('/cli/get?platform=macos').headers['ETag']
+        response = self.client.get('/cli/get?platform=macos', headers={'Range': 'bytes=1000-', 'If-Range': etag})
+        self.assertEqual(HTTPStatus.PARTIAL_CONTENT, response.status_code)
+        self.assertEqual(self.binaries['macos'][1000:], response.get_data())
+        self.assertEqual('bytes 1000-4095/4096', response.headers['Content-Range'])
+
+        # The binary has changed since, the whole new one is sent
+        self.write_binary('macos', os.urandom(5000))
+        response = self.client.get('/cli/get?platform=macos', headers={'Range': 'bytes=1000-', 'If-Range': etag})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(self.binaries['macos'], response.get_data())
+
+    def test_index_refreshed(self):
+        first = self.client.get('/cli/get?platform=linux').headers['ETag']
+        self.write_binary('linux', b'new version')
+        response = self.client.get('/cli/get?platform=linux', headers={'If-None-Match': first})
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        self.assertEqual(b'new version', response.get_data())
+
+        self.prepared('linux')
+        os.remove(artifacts.artifact_path(self.cli_dir.name, 'linux'))
+        self.assertEqual(HTTPStatus.NOT_FOUND, self.client.get('/cli/get?platform=linux').status_code)
+
+    def test_precompressed(self):
+        self.write_binary('linux', b'devmate binary ' * 1000)
+        sha256 = hashlib.sha256(self.binaries['linux']).hexdigest()
+        self.prepared('linux')
+        response = self.client.get('/cli/get?platform=linux', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(f'"{sha256}-gzip"', response.headers['ETag'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.get_data()), len(self.binaries['linux']))
+        self.assertEqual(self.binaries['linux'], gzip.decompress(response.get_data()))
+
+        # The client has the binary, whichever way it was downloaded
+        for etag in [f'"{sha256}"', response.headers['ETag']]:
+            response = self.client.get('/cli/get?platform=linux',
+                                       headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(HTTPStatus.NOT_MODIFIED, response.status_code)
+
+        # Not to a client which doesn't accept it, nor for a range
+        for headers in [{}, {'Accept-Encoding': 'gzip;q=0'}, {'Accept-Encoding': 'gzip', 'Range': 'bytes=10-'}]:
+            response = self.client.get('/cli/get?platform=linux', headers=headers)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(f'"{sha256}"', response.headers['ETag'])
+
+    def test_binary_served_until_compressed(self):
+        self.write_binary('linux', b'devmate binary ' * 1000)
+        compressing = threading.Event()
+        write_variant = artifacts.write_variant
+
+        def slow_write_variant(*args):
+            compressing.wait(10)
+            write_variant(*args)
+
+        with patch('devmateback.artifacts.write_variant', slow_write_variant):
+            response = self.client.get('/cli/get?platform=linux', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(self.binaries['linux'], response.get_data())
+            self.assertEqual({}, self.client.get('/cli/manifest').get_json()['linux']['encodings'])
+            compressing.set()
+            self.prepared('linux')
+        response = self.client.get('/cli/get?platform=linux', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+
+    def test_incompressible_not_precompressed(self):
+        response = self.client.get('/cli/get?platform=macos', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(self.binaries['macos'], response.get_data())
+
+    def test_old_variants_removed(self):
+        self.write_binary('linux', b'first version ' * 1000)
+        self.prepared('linux')
+        first = glob.glob(artifacts.artifact_path(self.cli_dir.name, 'linux') + '.*.gz')
+        self.assertEqual(1, len(first))
+        self.write_binary('linux', b'second version ' * 1000)
+        os.utime(first[0], (time.time() - 60, time.time() - 60))
+        self.prepared('linux')
+        second = glob.glob(artifacts.artifact_path(self.cli_dir.name, 'linux') + '.*.gz')
+        self.assertEqual(1, len(second))
+        self.assertNotEqual(first, second)
+
+    def test_accel_redirect(self):
+        self.write_binary('linux', b'devmate binary ' * 1000)
+        with patch.dict(os.environ, {'CLI_ACCEL_REDIRECT': '/cli-files'}):
+            artifacts.init_artifact_index(app, self.cli_dir.name)
+        try:
+            sha256 = hashlib.sha256(self.binaries['linux']).hexdigest()
+            self.prepared('linux')
+            response = self.client.get('/cli/get?platform=linux',
+                                       headers={'Accept-Encoding': 'gzip', 'X-Devmate-Accel': 'on'})
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            self.assertEqual(b'', response.get_data())
+            self.assertEqual(f'/cli-files/devmatecli-linux-latest/devmate.{sha256[:16]}.gz',
+                             response.headers['X-Accel-Redirect'])
+            self.assertEqual('gzip', response.headers['Content-Encoding'])
+            self.assertEqual(f'"{sha256}-gzip"', response.headers['ETag'])
+
+            # Not through nginx
+            response = self.client.get('/cli/get?platform=linux')
+            self.assertNotIn('X-Accel-Redirect', response.headers)
+            self.assertEqual(self.binaries['linux'], response.get_data())
+        finally:
+            app.config.pop('CLI_ACCEL_REDIRECT')
+
+    def test_invalid_encodings(self):
+        with patch.dict(os.environ, {'CLI_ENCODINGS': 'gzip,lzma'}):
+            self.assertIsNone(artifacts.init_artifact_index(app, self.cli_dir.name))
+
+    def test_delta_update(self):
+        self.write_binary('linux', os.urandom(200000))
+        first = self.binaries['linux']
+        first_sha256 = hashlib.sha256(first).hexdigest()
+        self.prepared('linux')
+        second = first[:1000] + b'new code' * 10 + first[1000:3000] + os.urandom(100) + first[3000:]
+        self.write_binary('linux', second)
+        self.prepared('linux')
+        headers = {'A-IM': 'devmate-delta', 'If-None-Match': f'"{first_sha256}"', 'Accept-Encoding': 'gzip'}
+        response = self.client.get('/cli/get?platform=linux', headers=headers)
+        self.assertEqual(HTTPStatus.IM_USED, response.status_code)
+        self.assertEqual('devmate-delta', response.headers['IM'])
+        self.assertEqual(f'"{first_sha256}"', response.headers['Delta-Base'])
+        self.assertEqual(f'"{hashlib.sha256(second).hexdigest()}"', response.headers['ETag'])
+        self.assertLess(len(response.get_data()), len(second) / 10)
+        self.assertEqual(second, deltas.apply(first, response.get_data()))
+
+        manifest = self.client.get('/cli/manifest').get_json()
+        self.assertEqual([first_sha256], list(manifest['linux']['deltas']))
+
+        # A client with an unknown version, or which doesn't ask for a delta, downloads the binary
+        for headers in [{'A-IM': 'devmate-delta', 'If-None-Match': '"unknown"'},
+                        {'If-None-Match': f'"{first_sha256}"'}]:
+            response = self.client.get('/cli/get?platform=linux', headers=headers)
+            self.assertEqual(HTTPStatus.OK, response.status_code)
+            self.assertEqual(second, response.get_data())
+
+    def test_history_limited(self):
+        with patch.dict(os.environ, {'CLI_DELTA_VERSIONS': '2'}):
+            artifacts.init_artifact_index(app, self.cli_dir.name)
+        history = deltas.history_dir(self.cli_dir.name, 'linux')
+        base = self.binaries['linux']
+        for version in range(3):
+            time.sleep(0.05)
+            self.write_binary('linux', base + b'version %d' % version)
+            self.prepared('linux')
+        kept = [name for name in os.listdir(history) if not name.endswith('.delta')]
+        self.assertEqual(sorted(hashlib.sha256(base + b'version %d' % version).hexdigest() for version in [1, 2]),
+                         sorted(kept))
+        self.assertEqual(1, len([name for name in os.listdir(history) if name.endswith('.delta')]))
+
+    def test_manifest(self):
+        response = self.client.get('/cli/manifest')
+        self.assertEqual(HTTPStatus.OK, response.status_code)
+        manifest = response.get_json()
+        self.assertEqual(artifacts.PLATFORMS, sorted(manifest))
+        self.assertEqual(hashlib.sha256(self.binaries['linux']).hexdigest(), manifest['linux']['sha256'])
+        self.assertEqual(4096, manifest['linux']['size'])
+        self.assertEqual('/cli/get?platform=linux', manifest['linux']['url'])
+
+        etag = response.headers['ETag']
+        self.assertEqual(HTTPStatus.NOT_MODIFIED,
+                         self.client.get('/cli/manifest', headers={'If-None-Match': etag}).status_code)
+        self.write_binary('linux', b'new version')
+        self.assertEqual(HTTPStatus.OK, self.client.get('/cli/manifest', headers={'If-None-Match': etag}).status_code)
+
+
+class TestDeltas(unittest.TestCase):
+
+    def test_round_trip(self):
+        base = os.urandom(200000) + bytes(50000) + os.urandom(100000)
+        target = base[:5000] + b'inserted' + base[5000:120000] + os.urandom(3000) + base[123000:]
+        delta = deltas.encode(base, target)
+        self.assertLess(len(delta), 10000)
+        self.assertEqual(target, deltas.apply(base, delta))
+
+    def test_unrelated_versions(self):
+        base, target = os.urandom(10000), os.urandom(20000)
+        self.assertEqual(target, deltas.apply(base, deltas.encode(base, target)))
+        self.assertEqual(b'', deltas.apply(base, deltas.encode(base, b'')))
+
+    def test_wrong_base(self):
+        delta = deltas.encode(b'first version' * 100, b'second version' * 100)
+        with self.assertRaises(deltas.DeltaError):
+            deltas.apply(b'other version' * 100, delta)
+        with self.assertRaises(deltas.DeltaError):
+            deltas.apply(b'first version' * 100, delta[:-10])
+
+
 class TestValidation(unittest.TestCase):
 
     def setUp(self):
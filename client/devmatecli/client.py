@@ -1,8 +1,12 @@
 import argparse
+import hashlib
 import json
+import lzma
 import os
 import requests
+import struct
 import sys
+import tempfile
 from datetime import datetime, timezone
 import humanize
 from prettytable import PrettyTable
@@ -24,6 +28,17 @@ class DevmateServer(object):
 
 devmate_server = DevmateServer(None, None)
 
+# The updates are downloaded as deltas from the current binary when the server has one, the format of
+# backend/devmateback/deltas.py: a header with the digests of both versions, then the lzma compressed operations,
+# which copy from the current binary or add new bytes.
+DELTA_ENCODING = 'devmate-delta'
+DELTA_MAGIC = b'DMDELTA1'
+DELTA_HEADER = struct.Struct('>8s32s32sQ')
+DELTA_COPY = b'C'
+DELTA_ADD = b'A'
+DELTA_COPY_OPERATION = struct.Struct('>QI')
+DELTA_ADD_OPERATION = struct.Struct('>I')
+
 
 def save_config(protocol, addr, port):
     config_path = get_config_path()
@@ -63,11 +78,11 @@ def handle_unexpected_status(response):
     print(f"Unexpected status code {response.status_code}")
 
 
-def do_api_call(method, endpoint, payload=None):
+def do_api_call(method, endpoint, payload=None, headers=None):
     warnings.filterwarnings("ignore", category=urllib3.exceptions.InsecureRequestWarning)
     try:
         if method == 'get':
-            return requests.get(f"{devmate_server.base_url}/{endpoint}", verify=False)
+            return requests.get(f"{devmate_server.base_url}/{endpoint}", headers=headers, verify=False)
         elif method == 'post':
             return requests.post(f"{devmate_server.base_url}/{endpoint}", json=payload, verify=False)
         elif method == 'delete':
@@ -219,6 +234,103 @@ def delete_device(device_name):
         handle_unexpected_status(response)
 
 
+def apply_delta(current, delta):
+    try:
+        magic, current_digest, new_digest, new_size = DELTA_HEADER.unpack_from(delta)
+        operations = lzma.decompress(delta[DELTA_HEADER.size:])
+    except (struct.error, lzma.LZMAError) as e:
+        raise ValueError(f"Invalid update: {e}")
+    if magic != DELTA_MAGIC:
+        raise ValueError("Invalid update: not a devmate delta")
+    if hashlib.sha256(current).digest() != current_digest:
+        raise ValueError("The update is not for this version")
+
+    new = bytearray()
+    position = 0
+    while position < len(operations):
+        operation = operations[position:position + 1]
+        position += 1
+        if operation == DELTA_COPY:
+            offset, length = DELTA_COPY_OPERATION.unpack_from(operations, position)
+            position += DELTA_COPY_OPERATION.size
+            new += current[offset:offset + length]
+        elif operation == DELTA_ADD:
+            length, = DELTA_ADD_OPERATION.unpack_from(operations, position)
+            position += DELTA_ADD_OPERATION.size
+            new += operations[position:position + length]
+            position += length
+        else:
+            raise ValueError(f"Invalid update operation {operation}")
+    if len(new) != new_size or hashlib.sha256(new).digest() != new_digest:
+        raise ValueError("The updated binary has a wrong digest")
+    return bytes(new)
+
+
+def current_platform():
+    if sys.platform.startswith('win'):
+        return 'windows'
+    if sys.platform == 'darwin':
+        return 'macos'
+    return 'linux'
+
+
+def replace_binary(binary_path, content):
+    # The new binary is written next to the current one, then moved in its place
+    fd, new_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(binary_path)), prefix='.devmate-update-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.chmod(new_path, os.stat(binary_path).st_mode)
+    if os.name == 'nt':
+        # A running executable can't be replaced on Windows, but it can be renamed
+        old_path = binary_path + '.old'
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        os.replace(binary_path, old_path)
+    os.replace(new_path, binary_path)
+
+
+def self_update(binary_path=None):
+    if binary_path is None:
+        # The binary built with PyInstaller
+        if not getattr(sys, 'frozen', False):
+            print("Only the devmate binary can update itself. Please pass the binary with --path.")
+            return False
+        binary_path = sys.executable
+
+    with open(binary_path, 'rb') as f:
+        current = f.read()
+    current_digest = hashlib.sha256(current).hexdigest()
+    response = do_api_call('get', f'cli/get?platform={current_platform()}',
+                           headers={'A-IM': DELTA_ENCODING, 'If-None-Match': f'"{current_digest}"'})
+    if response.status_code == 304:
+        print("devmate is up to date.")
+        return True
+    elif response.status_code == 226:
+        try:
+            new = apply_delta(current, response.content)
+        except ValueError as e:
+            print(f"Failed to apply the update: {e}")
+            return False
+    elif response.status_code == 200:
+        new = response.content
+    elif response.status_code == 404:
+        print("The server has no devmate binary for this platform.")
+        return False
+    else:
+        handle_unexpected_status(response)
+        return False
+
+    # The ETag is the sha256 of the binary, with the content encoding if it was compressed
+    expected_digest = response.headers.get('ETag', '').strip('"').split('-')[0]
+    if hashlib.sha256(new).hexdigest() != expected_digest:
+        print("The downloaded binary is corrupted, devmate was not updated.")
+        return False
+    replace_binary(binary_path, new)
+    print(f"devmate updated, downloaded {humanize.naturalsize(len(response.content))} "
+          f"for {humanize.naturalsize(len(new))}.")
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Device Management CLI: A tool for managing, reserving, and monitoring devices."
@@ -279,6 +391,14 @@ def main():
     )
     delete_parser.add_argument("device")
 
+    update_parser = subparsers.add_parser(
+        "self-update",
+        help="Update devmate to the latest version from the server.",
+        usage="self-update [--path]"
+    )
+    update_parser.add_argument("--path", required=False, default=None,
+                               help="The devmate binary to update, by default the running one.")
+
     config_parser = subparsers.add_parser(
         'configure',
         help='Configure the server protocol, address, and port. Must be run before using other commands.',
@@ -319,6 +439,9 @@ def main():
         set_device_online(args.device)
     elif args.command == "delete":
         delete_device(args.device)
+    elif args.command == "self-update":
+        if not self_update(args.path):
+            sys.exit(1)
 
 
 if __name__ == "__main__":
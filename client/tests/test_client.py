@@ -1,5 +1,9 @@
+import hashlib
 import io
+import lzma
+import os
 import sys
+import tempfile
 import unittest
 from unittest.mock import patch, Mock
 from http import HTTPStatus
@@ -459,5 +463,100 @@ class TestClientCommands(unittest.TestCase):
         mock_set_device_online.assert_called_once_with('device1')
 
 
+def make_delta(current, new):
+    # A delta in the format of the backend: copies the first half of the current binary, then adds the rest
+    half = len(current) // 2
+    operations = (b'C' + (0).to_bytes(8, 'big') + half.to_bytes(4, 'big') +
+                  b'A' + (len(new) - half).to_bytes(4, 'big') + new[half:])
+    return (b'DMDELTA1' + hashlib.sha256(current).digest() + hashlib.sha256(new).digest() +
+            len(new).to_bytes(8, 'big') + lzma.compress(operations))
+
+
+class TestSelfUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.binary_path = os.path.join(self.work_dir.name, 'devmate')
+        self.current = b'devmate version 1 ' * 100
+        with open(self.binary_path, 'wb') as f:
+            f.write(self.current)
+        os.chmod(self.binary_path, 0o755)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def read_binary(self):
+        with open(self.binary_path, 'rb') as f:
+            return f.read()
+
+    def mock_response(self, mock_get, status_code, content=b'', etag=None):
+        mock_get.return_value.status_code = status_code
+        mock_get.return_value.content = content
+        mock_get.return_value.headers = {'ETag': f'"{etag}"'} if etag else {}
+
+    @patch('requests.get')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_up_to_date(self, mock_stdout, mock_get):
+        self.mock_response(mock_get, HTTPStatus.NOT_MODIFIED)
+        self.assertTrue(device_management.self_update(self.binary_path))
+        self.assertEqual("devmate is up to date.\n", mock_stdout.getvalue())
+        headers = mock_get.call_args.kwargs['headers']
+        self.assertEqual('devmate-delta', headers['A-IM'])
+        self.assertEqual(f'"{hashlib.sha256(self.current).hexdigest()}"', headers['If-None-Match'])
+        self.assertEqual(self.current, self.read_binary())
+
+    @patch('requests.get')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_delta_update(self, mock_stdout, mock_get):
+        new = self.current[:900] + b'devmate version 2 ' * 60
+        self.mock_response(mock_get, HTTPStatus.IM_USED, make_delta(self.current, new),
+                           hashlib.sha256(new).hexdigest())
+        self.assertTrue(device_management.self_update(self.binary_path))
+        self.assertEqual(new, self.read_binary())
+        self.assertEqual(0o755, os.stat(self.binary_path).st_mode & 0o777)
+        self.assertIn("devmate updated", mock_stdout.getvalue())
+
+    @patch('requests.get')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_full_update(self, mock_stdout, mock_get):
+        new = b'devmate version 2 ' * 100
+        self.mock_response(mock_get, HTTPStatus.OK, new, f'{hashlib.sha256(new).hexdigest()}-gzip')
+        self.assertTrue(device_management.self_update(self.binary_path))
+        self.assertEqual(new, self.read_binary())
+
+    @patch('requests.get')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_corrupted_download(self, mock_stdout, mock_get):
+        self.mock_response(mock_get, HTTPStatus.OK, b'truncated', hashlib.sha256(b'devmate version 2').hexdigest())
+        self.assertFalse(device_management.self_update(self.binary_path))
+        self.assertEqual("The downloaded binary is corrupted, devmate was not updated.\n", mock_stdout.getvalue())
+        self.assertEqual(self.current, self.read_binary())
+
+    @patch('requests.get')
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_delta_for_other_version(self, mock_stdout, mock_get):
+        new = b'devmate version 3 ' * 100
+        self.mock_response(mock_get, HTTPStatus.IM_USED, make_delta(b'devmate version 2 ' * 100, new),
+                           hashlib.sha256(new).hexdigest())
+        self.assertFalse(device_management.self_update(self.binary_path))
+        self.assertEqual("Failed to apply the update: The update is not for this version\n", mock_stdout.getvalue())
+        self.assertEqual(self.current, self.read_binary())
+
+    @patch('sys.stdout', new_callable=io.StringIO)
+    def test_not_a_binary(self, mock_stdout):
+        self.assertFalse(device_management.self_update())
+        self.assertIn("Only the devmate binary can update itself", mock_stdout.getvalue())
+
+    @patch('os.getlogin', Mock(return_value='os_user'))
+    @patch('devmatecli.client.load_config', Mock(return_value=True))
+    @patch('devmatecli.client.self_update')
+    @patch('devmatecli.client.check_server_accessibility')
+    def test_self_update_command(self, mock_check_server_accessibility, mock_self_update):
+        mock_check_server_accessibility.return_value = True
+        with patch.object(sys, 'argv', ['client.py', 'self-update', '--path', self.binary_path]):
+            device_management.main()
+        mock_self_update.assert_called_once_with(self.binary_path)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -45,6 +45,18 @@ const theme = createTheme({
 })
 
 const backendPort = process.env.REACT_APP_DEVMATE_BACKEND_PORT || 8888;
+// How long to wait before opening the device event stream again when the backend has refused it
+const streamRetryDelay = 30000;
+// How often the changes are polled meanwhile
+const changesPollInterval = 5000;
+
+const backendUrl = () => {
+  // Get current domain and protocol
+  const protocol = window.location.protocol;
+  const host = window.location.hostname;
+
+  return `${protocol}//${host}:${backendPort}`;
+};
 
 
 const App = () => {
@@ -81,21 +93,129 @@ const App = () => {
   }, []);
 
   useEffect(() => {
-    let isMounted = true; // Flag to prevent state update on an unmounted component
+    // The list is fetched once, then the backend pushes every change of the devices. When it refuses the stream
+    // (too many open streams), the changes are polled until the stream can be opened again.
+    let eventSource = null;
+    let reconnectTimer = null;
+    let pollTimer = null;
+    let closed = false;
+    // The revision of the list shown, null until it's fetched
+    let revision = null;
+    // The events received while the list is being fetched, null when no fetch is running
+    let pendingEvents = null;
+
+    const applyChange = (change) => {
+      setDevices(prevDevices => {
+        if (!prevDevices.some(device => device.name === change.name)) {
+          return [...prevDevices, change];
+        }
+        return prevDevices.map(device => device.name === change.name ? {...device, ...change} : device);
+      });
+    };
+
+    const applyDelete = (change) => {
+      setDevices(prevDevices => prevDevices.filter(device => device.name !== change.name));
+    };
 
-    const fetchDevicesRepeatedly = async () => {
-      while (isMounted) {
-        const newDevices = await handleList();
-        if (newDevices && JSON.stringify(newDevices) !== JSON.stringify(devices)) {
-          setDevices(newDevices);
+    const applyEvent = (event) => {
+      if (pendingEvents !== null) {
+        pendingEvents.push(event);
+        return;
+      }
+      if (event.type === 'delete') {
+        applyDelete(JSON.parse(event.data));
+      } else {
+        applyChange(JSON.parse(event.data));
+      }
+      revision = Math.max(revision || 0, parseInt(event.lastEventId, 10) || 0);
+    };
+
+    // On start, and when the stream or the polling can't be resumed. The events which come during the fetch
+    // are applied on top of the list, unless the list has them already.
+    const resetList = () => {
+      pendingEvents = [];
+      return handleApiCall(`/devices/list`, 'get', null).then((response) => {
+        const events = pendingEvents;
+        pendingEvents = null;
+        setDevices(response.status === 200 ? response.data.devices : []);
+        setBackendAvailable(true);
+        const listRevision = parseInt(response.headers['x-fleet-revision'], 10);
+        revision = isNaN(listRevision) ? null : listRevision;
+        events.filter(event => revision === null || parseInt(event.lastEventId, 10) > revision).forEach(applyEvent);
+      }).catch(() => {
+        pendingEvents = null;
+        handleHealth();
+      });
+    };
+
+    const pollChanges = () => {
+      if (pendingEvents !== null) {
+        return;
+      }
+      if (revision === null) {
+        resetList();
+        return;
+      }
+      handleApiCall(`/devices/changes?since=${revision}`, 'get', null).then((response) => {
+        response.data.devices.forEach(applyChange);
+        response.data.deleted.forEach(name => applyDelete({name}));
+        revision = Math.max(revision, response.data.revision);
+        setBackendAvailable(true);
+      }).catch((error) => {
+        if (error.response && error.response.status === 410) {
+          resetList();
+        } else {
+          handleHealth();
         }
+      });
+    };
+
+    const stopPolling = () => {
+      clearInterval(pollTimer);
+      pollTimer = null;
+    };
 
-        await new Promise(resolve => setTimeout(resolve, 10000)); // Wait for 10 seconds
+    const connect = () => {
+      if (closed) {
+        return;
       }
+      // Resumed from the revision of the list, so the stream doesn't reset it again
+      const since = revision === null ? '' : `?last_event_id=${revision}`;
+      eventSource = new EventSource(`${backendUrl()}/devices/events${since}`);
+      eventSource.addEventListener('reset', (event) => {
+        if (JSON.parse(event.data).revision !== revision) {
+          resetList();
+        }
+      });
+      ['add', 'reserve', 'release', 'offline', 'online', 'renew', 'expire', 'delete'].forEach(action => {
+        eventSource.addEventListener(action, applyEvent);
+      });
+      eventSource.onopen = () => {
+        stopPolling();
+        setBackendAvailable(true);
+      };
+      eventSource.onerror = () => {
+        if (eventSource.readyState === EventSource.CLOSED) {
+          // Refused, e.g. the backend has too many open streams: the browser doesn't retry that by itself
+          eventSource.close();
+          if (pollTimer === null) {
+            pollTimer = setInterval(pollChanges, changesPollInterval);
+          }
+          reconnectTimer = setTimeout(connect, streamRetryDelay);
+        }
+        // Otherwise the browser reconnects by itself, resuming from the last received event
+        handleHealth();
+      };
     };
-    fetchDevicesRepeatedly();
+    resetList().then(connect);
+
     return () => {
-      isMounted = false
+      closed = true;
+      clearTimeout(reconnectTimer);
+      stopPolling();
+      if (eventSource !== null) {
+        eventSource.close();
+      }
     }; // Cleanup function
   }, []);
 
@@ -135,12 +255,8 @@ const App = () => {
   };
 
   const handleApiCall = async (endpoint, method, payload) => {
-    // Get current domain and protocol
-    const protocol = window.location.protocol;
-    const host = window.location.hostname;
-
     // Construct API URL
-    const apiUrl = `${protocol}//${host}:${backendPort}${endpoint}`;
+    const apiUrl = `${backendUrl()}${endpoint}`;
 
     return axios({method: method, url: apiUrl, data: payload})
   };
@@ -30,7 +30,9 @@ const HelpWindow = ({ platform, setShowHelp, backendPort }) => {
     // Calculate the download link based on the current settings
     const protocol = window.location.protocol;
     const host = window.location.hostname;
-    const downloadLink = `${protocol}//${host}:${backendPort}/cli/get?platform=${platform}`;
+    // The built web UI is served by nginx, which sends the CLI binaries itself (see nginx.conf)
+    const downloadServer = process.env.NODE_ENV === 'production' ? window.location.origin : `${protocol}//${host}:${backendPort}`;
+    const downloadLink = `${downloadServer}/cli/get?platform=${platform}`;
 
 
     const renderPlatformInstructions = () => {